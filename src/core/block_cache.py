@@ -0,0 +1,155 @@
+import os
+import hashlib
+import threading
+import uuid
+from collections import OrderedDict
+
+MB = 1024 * 1024
+
+
+class BlockCache:
+    """
+    On-disk cache of fixed-size blocks of HDFS files, for the range reads of .link files.
+    A block is stored as <cache dir>/<digest of the hdfs path>/<checksum>.<block number>, so that the blocks of a
+    previous version of a file are dropped once its HDFS checksum changes. Blocks are evicted in LRU order when the
+    cache grows over its byte budget. Every block is fetched once, concurrent reads of a missing block wait for
+    the read in progress.
+    """
+    def __init__(self, hdfs_con, cache_dir, block_size=4 * MB, budget=1024 * MB):
+        """
+        :param hdfs_con: from hdfs3
+        :param cache_dir: local dir of the cached blocks, outside the /mrbox folder
+        :param block_size: size in bytes of the blocks that files are read in
+        :param budget: max size in bytes of all the cached blocks
+        """
+        self.hdfsCon = hdfs_con
+        self.cacheDir = cache_dir
+        self.blockSize = block_size
+        self.budget = budget
+        self._lock = threading.Lock()
+        self._blocks = OrderedDict()    # block name -> size in bytes, least recently used first
+        self._bytes = 0
+        self._versions = {}             # digest of an hdfs path -> checksum of its cached blocks
+        self._fetching = {}             # block name -> threading.Event set when it has been fetched
+        self.hits = 0
+        self.misses = 0
+        os.makedirs(self.cacheDir, exist_ok=True)
+        self._load()
+
+    def _load(self):
+        """ Indexes the blocks cached by previous runs, oldest first """
+        found = []
+        for entry in os.scandir(self.cacheDir):
+            if not entry.is_dir():
+                continue
+            for block in os.scandir(entry.path):
+                name = os.path.join(entry.name, block.name)
+                if block.name.startswith('.'):
+                    os.remove(block.path)       # partial write of an interrupted fetch
+                    continue
+                st = block.stat()
+                found.append((st.st_mtime, name, st.st_size))
+        for _, name, size in sorted(found):
+            self._blocks[name] = size
+            self._bytes += size
+        self._evict()
+
+    @staticmethod
+    def _digest(hdfs_path):
+        return hashlib.sha1(hdfs_path.encode()).hexdigest()
+
+    def _drop_other_versions(self, hdfs_path, chk):
+        """ Drops the cached blocks of an hdfs path that were read before its checksum changed to chk """
+        digest = self._digest(hdfs_path)
+        with self._lock:
+            if self._versions.get(digest) == chk:
+                return
+            self._versions[digest] = chk
+            prefix = digest + os.sep
+            keep = prefix + chk + '.'
+            for name in [n for n in self._blocks if n.startswith(prefix) and not n.startswith(keep)]:
+                self._remove(name)
+
+    def _remove(self, name):
+        self._bytes -= self._blocks.pop(name)
+        try:
+            os.remove(os.path.join(self.cacheDir, name))
+        except FileNotFoundError:
+            pass
+
+    def _evict(self):
+        while self._bytes > self.budget and self._blocks:
+            self._remove(next(iter(self._blocks)))
+
+    def read(self, hdfs_path, chk, offset, length, size):
+        """
+        :param chk: the current HDFS checksum of the file, None if unknown
+        :param size: the size of the HDFS file in bytes
+        :return: up to length bytes of the file from offset, empty at the end of the file
+        """
+        chk = chk or 'unknown'
+        end = min(size, offset + length)
+        if offset >= end:
+            return b''
+        self._drop_other_versions(hdfs_path, chk)
+        first, last = offset // self.blockSize, (end - 1) // self.blockSize
+        parts = []
+        for n in range(first, last + 1):
+            start = n * self.blockSize
+            data = self._block(hdfs_path, chk, n)
+            parts.append(data[max(offset - start, 0):end - start])
+        return b''.join(parts)
+
+    def _block(self, hdfs_path, chk, n):
+        name = os.path.join(self._digest(hdfs_path), '%s.%d' % (chk, n))
+        path = os.path.join(self.cacheDir, name)
+        while True:
+            with self._lock:
+                cached = name in self._blocks
+                if cached:
+                    self._blocks.move_to_end(name)
+                    self.hits += 1
+                    fetching = None
+                else:
+                    fetching = self._fetching.get(name)
+                    if fetching is None:
+                        self.misses += 1
+                        self._fetching[name] = threading.Event()
+            if cached:
+                try:
+                    with open(path, 'rb') as f:
+                        return f.read()
+                except FileNotFoundError:
+                    with self._lock:    # evicted meanwhile
+                        if name in self._blocks:
+                            self._bytes -= self._blocks.pop(name)
+                    continue
+            if fetching is not None:
+                fetching.wait()         # fetched by another read
+                continue
+            try:
+                return self._fetch(hdfs_path, n, name, path)
+            finally:
+                with self._lock:
+                    self._fetching.pop(name).set()
+
+    def _fetch(self, hdfs_path, n, name, path):
+        with self.hdfsCon.open(hdfs_path, 'rb', buff=self.blockSize) as f:
+            f.seek(n * self.blockSize)
+            data = f.read(self.blockSize)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = os.path.join(os.path.dirname(path), '.' + uuid.uuid4().hex)
+        with open(tmp_path, 'wb') as f:
+            f.write(data)
+        os.replace(tmp_path, path)
+        with self._lock:
+            if name in self._blocks:
+                self._bytes -= self._blocks[name]
+            self._blocks[name] = len(data)
+            self._bytes += len(data)
+            self._evict()
+        return data
+
+    def stats(self):
+        with self._lock:
+            return {'blocks': len(self._blocks), 'bytes': self._bytes, 'hits': self.hits, 'misses': self.misses}
@@ -0,0 +1,202 @@
+import os
+import zlib
+
+try:
+    import zstandard
+except ImportError:     # optional, the zstd codec is unavailable without it
+    zstandard = None
+try:
+    import lz4.frame
+except ImportError:     # optional, the lz4 codec is unavailable without it
+    lz4 = None
+
+SAMPLE_BYTES = 1024 * 1024      # bytes compressed to estimate the compression ratio of a file
+
+
+class Codec:
+    """
+    Streaming compression of the files moved between /mrbox and HDFS.
+    A stream may hold several concatenated frames, e.g. a file appended to, they are decoded one after the other.
+    """
+    name = None
+    ext = None
+    hadoop_readable = False     # if the input formats of Hadoop decompress it by its extension
+
+    def encoder(self):
+        """ :return: object with compress(bytes) -> bytes and flush() -> bytes """
+        raise NotImplementedError
+
+    def decoder(self):
+        """ :return: object with decompress(bytes) -> bytes, eof and unused_data """
+        raise NotImplementedError
+
+    def encode(self, chunks):
+        """ :return: generator of the compressed chunks of an iterable of bytes """
+        enc = self.encoder()
+        for chunk in chunks:
+            out = enc.compress(chunk)
+            if out:
+                yield out
+        yield enc.flush()
+
+    def decode(self, chunks):
+        """ :return: generator of the decompressed chunks of an iterable of bytes """
+        dec = self.decoder()
+        for chunk in chunks:
+            while chunk:
+                out = dec.decompress(chunk)
+                if out:
+                    yield out
+                chunk = b''
+                if dec.eof:
+                    chunk = dec.unused_data     # the next frame
+                    dec = self.decoder()
+
+    def ratio(self, sample):
+        """ :return: compressed / original size of a sample of a file """
+        if not sample:
+            return 1.0
+        return sum(len(c) for c in self.encode([sample])) / len(sample)
+
+
+class GzipCodec(Codec):
+    name = 'gzip'
+    ext = '.gz'
+    hadoop_readable = True
+
+    def encoder(self):
+        return zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+
+    def decoder(self):
+        return zlib.decompressobj(16 + zlib.MAX_WBITS)
+
+
+class ZstdCodec(Codec):
+    name = 'zstd'
+    ext = '.zst'
+    hadoop_readable = True
+
+    def encoder(self):
+        return zstandard.ZstdCompressor(level=3).compressobj()
+
+    def decoder(self):
+        return zstandard.ZstdDecompressor().decompressobj()
+
+
+class LZ4Codec(Codec):
+    """ LZ4 frames, not the block format of the Lz4Codec of Hadoop, so for the local copies only """
+    name = 'lz4'
+    ext = '.lz4'
+
+    def encoder(self):
+        return _LZ4Encoder()
+
+    def decoder(self):
+        return lz4.frame.LZ4FrameDecompressor()
+
+
+class _LZ4Encoder:
+    def __init__(self):
+        self._enc = lz4.frame.LZ4FrameCompressor()
+        self._header = self._enc.begin()
+
+    def compress(self, data):
+        out, self._header = self._header + self._enc.compress(data), b''
+        return out
+
+    def flush(self):
+        out, self._header = self._header + self._enc.flush(), b''
+        return out
+
+
+CODECS = {'gzip': (GzipCodec, True), 'zstd': (ZstdCodec, zstandard is not None), 'lz4': (LZ4Codec, lz4 is not None)}
+EXTS = {cls.ext: name for name, (cls, _) in CODECS.items()}
+
+
+def read_chunks(f, size):
+    """ :return: generator of the chunks of size bytes of a binary file object """
+    while True:
+        buf = f.read(size)
+        if not buf:
+            return
+        yield buf
+
+
+def transcode(chunks, codec, encode):
+    """ :return: the chunks encoded / decoded by codec, as they are if codec is None """
+    if codec is None:
+        return chunks
+    return codec.encode(chunks) if encode else codec.decode(chunks)
+
+
+def get_codec(name):
+    """ :return: the Codec of a name, None for 'none' """
+    if name is None or name == 'none':
+        return None
+    if name not in CODECS:
+        raise ValueError("Unknown codec %s, expected one of none, %s" % (name, ", ".join(CODECS)))
+    cls, available = CODECS[name]
+    if not available:
+        raise ValueError("Codec %s needs the %s package" % (name, 'zstandard' if name == 'zstd' else 'lz4'))
+    return cls()
+
+
+def codec_of(path):
+    """ :return: the Codec of a compressed file by its extension, None if not compressed or not available """
+    name = EXTS.get(os.path.splitext(path)[1])
+    if name is None or not CODECS[name][1]:
+        return None
+    return CODECS[name][0]()
+
+
+def remote_dest_path(rem_dest_path, loc_src_path, rem_src_path):
+    """
+    The remote path of a moved file keeps the compression of its remote source:
+    :return: rem_dest_path with the codec extension added or removed as between loc_src_path and rem_src_path
+    """
+    loc_ext, rem_ext = os.path.splitext(loc_src_path)[1], os.path.splitext(rem_src_path)[1]
+    if loc_ext == rem_ext:
+        return rem_dest_path
+    if rem_ext in EXTS and not rem_dest_path.endswith(rem_ext):
+        return rem_dest_path + rem_ext          # compressed on HDFS only
+    if loc_ext in EXTS and rem_dest_path.endswith(loc_ext):
+        return rem_dest_path[:-len(loc_ext)]    # compressed locally only
+    return rem_dest_path
+
+
+class Compression:
+    """
+    Where the files are compressed: the uploaded files whose extension is in exts are stored compressed on HDFS,
+    as <name><ext of the upload codec>, and the fetched outputs that are over the local size limit are kept locally
+    compressed, as <name><ext of the local codec>, if their compressed size is under the limit.
+    A file is encoded / decoded in transit when exactly one of its local + remote paths has a codec extension.
+    """
+    def __init__(self, upload_codec=None, local_codec=None, exts=()):
+        """
+        :param upload_codec: name of the codec of the uploads, must be readable by the Hadoop input formats
+        :param local_codec: name of the codec of the local copies of the outputs
+        :param exts: extensions of the local files compressed on upload, e.g. ['.txt', '.csv']
+        """
+        self.uploadCodec = get_codec(upload_codec)
+        self.localCodec = get_codec(local_codec)
+        self.exts = set(exts)
+        if self.uploadCodec is not None and not self.uploadCodec.hadoop_readable:
+            raise ValueError("Codec %s is not readable by Hadoop jobs" % self.uploadCodec.name)
+
+    def remote_path(self, local_path, hdfs_path):
+        """ :return: the path on HDFS of a new local file """
+        if self.uploadCodec is None or codec_of(local_path) is not None \
+                or os.path.splitext(local_path)[1] not in self.exts or os.path.isdir(local_path):
+            return hdfs_path
+        return hdfs_path + self.uploadCodec.ext
+
+    @staticmethod
+    def transit_codec(local_path, hdfs_path):
+        """
+        :return: (Codec, True if the copy on HDFS is the compressed one) of a file whose local + remote copies differ
+        in compression, else (None, None)
+        """
+        loc, rem = codec_of(local_path), codec_of(hdfs_path)
+        if (loc is None) == (rem is None):
+            return None, None
+        return (rem, True) if rem is not None else (loc, False)
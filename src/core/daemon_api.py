@@ -0,0 +1,152 @@
+import os
+import json
+import socket
+import socketserver
+import threading
+
+SOCKET_FILE = 'mrbox.sock'
+MAX_HEADER = 64 * 1024
+MAX_READ = 16 * 1024 * 1024   # max bytes of a single range read
+
+
+# Wire format: a JSON header line, followed by header['length'] raw bytes
+
+def send_msg(wfile, header, data=b''):
+    header = dict(header, length=len(data))
+    wfile.write(json.dumps(header).encode() + b'\n')
+    if data:
+        wfile.write(data)
+    wfile.flush()
+
+
+def recv_msg(rfile):
+    line = rfile.readline(MAX_HEADER)
+    if not line:
+        raise ConnectionError("Connection closed by the mrbox daemon")
+    header = json.loads(line)
+    length = header.get('length', 0)
+    data = rfile.read(length) if length else b''
+    if len(data) != length:
+        raise ConnectionError("Truncated reply from the mrbox daemon")
+    return header, data
+
+
+class DaemonAPI:
+    """
+    The calls that the running mrbox daemon serves to mrview, on its warm HDFS connection + catalog cache.
+    Every call takes keyword params and returns (dict of results, raw bytes).
+    """
+    METHODS = ('ping', 'lookup', 'head', 'tail', 'read', 'line_range')
+
+    def __init__(self, hadoop, lc, line_indexer):
+        """
+        :param hadoop: HadoopInterface
+        :param lc: LocalCatalog
+        :param line_indexer: LineIndexer
+        """
+        self.hadoop = hadoop
+        self.lc = lc
+        self.lineIndexer = line_indexer
+
+    def call(self, method, params):
+        if method not in self.METHODS:
+            raise ValueError("Unknown method " + str(method))
+        return getattr(self, method)(**params)
+
+    def ping(self):
+        return {'pid': os.getpid()}, b''
+
+    def lookup(self, local_path):
+        """ :return: the remote path + local type of a file of the /mrbox folder """
+        hdfs_path = self.lc.get_remote_file_path(local_path)
+        loc_type = self.lc.get_loc_type_by_remote_path(hdfs_path) if hdfs_path is not None else None
+        return {'hdfs_path': hdfs_path, 'type': loc_type}, b''
+
+    def head(self, hdfs_path, nbytes=1024):
+        return {}, self.hadoop.read_head(hdfs_path, nbytes)
+
+    def tail(self, hdfs_path, nbytes=1024):
+        return {}, self.hadoop.read_tail(hdfs_path, nbytes)
+
+    def read(self, hdfs_path, offset, length):
+        """ Range read through the block cache, length is capped to MAX_READ """
+        chk = self.lc.get_val_by_rem_path(self.lc.CHK_HDFS, hdfs_path)
+        size, data = self.hadoop.read_range(hdfs_path, offset, min(length, MAX_READ), chk)
+        return {'size': size}, data
+
+    def line_range(self, hdfs_path, first, count):
+        """ Byte range of count lines from the 0-based line first (None for the last lines), see LineIndexer """
+        chk = self.lc.get_val_by_rem_path(self.lc.CHK_HDFS, hdfs_path)
+        read = lambda offset, length: self.hadoop.read_range(hdfs_path, offset, length, chk)[1]
+        return self.lineIndexer.line_range(hdfs_path, first, count, read), b''
+
+
+class _RequestHandler(socketserver.StreamRequestHandler):
+    def handle(self):
+        try:
+            header, _ = recv_msg(self.rfile)
+        except (ConnectionError, ValueError):
+            return
+        try:
+            result, data = self.server.api.call(header.get('method'), header.get('params', {}))
+            send_msg(self.wfile, dict(result, ok=True), data)
+        except Exception as e:
+            send_msg(self.wfile, {'ok': False, 'error': repr(e)})
+
+
+class APIServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    """ Serves a DaemonAPI on a Unix domain socket, one thread per connection """
+    daemon_threads = True
+
+    def __init__(self, socket_path, api):
+        """
+        :param socket_path: path of the socket file, next to the catalog db
+        :param api: DaemonAPI
+        """
+        self.api = api
+        self.socketPath = socket_path
+        if os.path.exists(socket_path):
+            try:
+                APIClient(socket_path, timeout=1).call('ping')
+            except (ConnectionError, OSError):
+                os.remove(socket_path)      # left behind by a daemon that did not shut down cleanly
+            else:
+                raise RuntimeError("An mrbox daemon is already serving " + socket_path)
+        super().__init__(socket_path, _RequestHandler)
+        os.chmod(socket_path, 0o600)
+        self._thread = None
+
+    def start(self):
+        self._thread = threading.Thread(target=self.serve_forever, name='api-server', daemon=True)
+        self._thread.start()
+        print("Serving mrview on " + self.socketPath)
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+        if os.path.exists(self.socketPath):
+            os.remove(self.socketPath)
+
+
+class APIError(Exception):
+    pass
+
+
+class APIClient:
+    """ Calls the DaemonAPI of a running mrbox daemon, raises ConnectionError / OSError if there is none """
+    def __init__(self, socket_path, timeout=30):
+        self.socketPath = socket_path
+        self.timeout = timeout
+
+    def call(self, method, **params):
+        """ :return: (dict of results, raw bytes) of the call, raises APIError if it failed in the daemon """
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+            sock.settimeout(self.timeout)
+            sock.connect(self.socketPath)
+            with sock.makefile('rwb') as f:
+                send_msg(f, {'method': method, 'params': params})
+                header, data = recv_msg(f)
+        if not header.pop('ok', False):
+            raise APIError(header.get('error'))
+        header.pop('length', None)
+        return header, data
@@ -0,0 +1,145 @@
+import os
+import time
+import uuid
+import threading
+from core.codec import EXTS
+from utils.path_util import customize_path
+
+
+def codec_ext(hdfs_path):
+    """ :return: the codec extension of a remote path, '' if it is not compressed """
+    ext = os.path.splitext(hdfs_path)[1]
+    return ext if ext in EXTS else ''
+
+
+class Dedupe(threading.Thread):
+    """
+    Turns the uploads of content that is already on HDFS into server-side operations, by the (size, CRC32C) of the
+    local files in the catalog:
+    A deleted file is not removed from HDFS right away but renamed to a tombstone in the trash dir for `window` secs.
+    A new file with the same content in that window is renamed from the tombstone instead of uploaded, e.g. a move
+    across the watched folder or by a tool that the observer reports as deleted + created.
+    A new file identical to a live synced file, e.g. a copy inside /mrbox, is copied on the cluster by distcp if it
+    is at least distcp_size, smaller copies are uploaded as usual.
+    The tombstones left by a crash are removed at start-up.
+    """
+    def __init__(self, hadoop, lc, trash_dir, window=30, distcp_size=256 * 1024 * 1024):
+        """
+        :param hadoop: HadoopInterface
+        :param lc: LocalCatalog
+        :param trash_dir: dir on HDFS of the tombstones, outside the remote /mrbox folder
+        :param window: secs that a deleted file is kept as a tombstone
+        :param distcp_size: size in bytes from which a copy of a live file is made by distcp, 0 to never use distcp
+        """
+        super().__init__(name='tombstones', daemon=True)
+        self.hadoop = hadoop
+        self.lc = lc
+        self.trashDir = trash_dir
+        self.window = window
+        self.distcpSize = distcp_size
+        self._cond = threading.Condition()
+        self._tombs = {}        # (size, loc chk, codec ext) -> list of [trash path, expiry] in deletion order
+        self._stopping = False
+        if self.hadoop.exists(self.trashDir):
+            self.hadoop.rm(self.trashDir)
+        self.hadoop.mkdir(self.trashDir)
+
+    def bury(self, hdfs_path, row):
+        """
+        Renames a deleted file to a tombstone if its copy on HDFS is known to hold its content
+        :param row: the catalog tuple of the file before it was deleted, see LocalCatalog.get_tuple
+        :return: True if the file was buried, else it is still to be removed
+        """
+        size, loc_chk, hdfs_chk = row[self.lc.SIZE_LOC], row[self.lc.CHK_LOC], row[self.lc.CHK_HDFS]
+        ext = codec_ext(hdfs_path)
+        # a copy compressed on HDFS has another checksum than the local file
+        if not self.window or row[self.lc.TYPE_LOC] != 'file' or size is None or loc_chk is None \
+                or hdfs_chk is None or (not ext and hdfs_chk != loc_chk):
+            return False
+        trash_path = customize_path(self.trashDir, uuid.uuid4().hex + ext)
+        self.hadoop.mv(hdfs_path, trash_path)
+        self.hadoop.metadata.forget(hdfs_path)
+        with self._cond:
+            self._tombs.setdefault((size, loc_chk, ext), []).append([trash_path, time.monotonic() + self.window])
+            self._cond.notify()
+        return True
+
+    def claim(self, size, loc_chk, hdfs_path):
+        """ :return: the trash path of a tombstone of the same content + compression, None if there is none """
+        key = (size, loc_chk, codec_ext(hdfs_path))
+        with self._cond:
+            tombs = self._tombs.get(key)
+            if not tombs:
+                return None
+            trash_path = tombs.pop()[0]      # the latest, most likely the other half of a move
+            if not tombs:
+                del self._tombs[key]
+            return trash_path
+
+    def find_live(self, local_path, size, loc_chk, hdfs_path):
+        """ :return: the remote path of a live synced file with the same content + compression, None if none """
+        for lp, rp in self.lc.find_by_content(size, loc_chk):
+            if lp != local_path and rp != hdfs_path and codec_ext(rp) == codec_ext(hdfs_path) \
+                    and self.hadoop.exists(rp):
+                return rp
+        return None
+
+    def place(self, local_path, hdfs_path, size, loc_chk):
+        """
+        Creates the copy on HDFS of a new local file from identical content already on HDFS
+        :return: True if it was renamed / copied there, False if it is still to be uploaded
+        """
+        if size is None or loc_chk is None:
+            return False
+        trash_path = self.claim(size, loc_chk, hdfs_path)
+        if trash_path is not None:
+            print("renaming tombstone to " + hdfs_path)
+            self.hadoop.mv(trash_path, hdfs_path)
+            return True
+        if not self.distcpSize or size < self.distcpSize:
+            return False
+        src = self.find_live(local_path, size, loc_chk, hdfs_path)
+        if src is None:
+            return False
+        print("copying " + src + " to " + hdfs_path + " on the cluster")
+        try:
+            self.hadoop.distcp(src, hdfs_path)
+        except Exception as e:
+            print("distcp failed, uploading instead: " + repr(e))
+            return False
+        return True
+
+    def run(self):
+        while True:
+            with self._cond:
+                if self._stopping:
+                    return
+                now = time.monotonic()
+                expired = [(key, t) for key, tombs in self._tombs.items() for t in tombs if t[1] <= now]
+                for key, t in expired:
+                    self._tombs[key].remove(t)
+                    if not self._tombs[key]:
+                        del self._tombs[key]
+                if not expired:
+                    expiries = [t[1] for tombs in self._tombs.values() for t in tombs]
+                    self._cond.wait(min(expiries) - now if expiries else None)
+                    continue
+            # removed out of the lock, so that deletes + creates are not held up by HDFS
+            for _, t in expired:
+                self._remove(t[0])
+
+    def _remove(self, trash_path):
+        try:
+            self.hadoop.rm(trash_path)
+        except Exception as e:
+            print("Removal of tombstone " + trash_path + " failed: " + repr(e))
+
+    def stop(self):
+        """ Removes all the tombstones """
+        with self._cond:
+            self._stopping = True
+            tombs = [t for ts in self._tombs.values() for t in ts]
+            self._tombs = {}
+            self._cond.notify()
+        for t in tombs:
+            self._remove(t[0])
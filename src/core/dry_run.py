@@ -0,0 +1,209 @@
+import os
+import sys
+import time
+import heapq
+import shutil
+import tempfile
+import subprocess
+import zlib
+import multiprocessing
+import yaml
+from core.job_scheduler import STATUS_EXT
+
+RUN_BYTES = 64 * 1024 * 1024       # map output sorted in memory per run, larger outputs are spilled in several runs
+PREVIEW_LINES = 10
+
+
+def report_path(yaml_path):
+    """ The report of the dry run of a job, a status file so that it is not synced to HDFS """
+    return yaml_path + '.dryrun' + STATUS_EXT
+
+
+def script_cmd(script_path):
+    return [sys.executable, script_path] if script_path.endswith('.py') else [script_path]
+
+
+def shuffle_key(line):
+    """ The key of a streaming record, up to the first tab as in Hadoop streaming """
+    return line.split(b'\t', 1)[0].rstrip(b'\n')
+
+
+def _check(proc, script_path, err):
+    """ :param err: temp file of the stderr of the script, not a pipe that a noisy script would fill + block on """
+    if proc.returncode != 0:
+        err.seek(0)
+        raise RuntimeError("%s exited with %d: %s" % (os.path.basename(script_path), proc.returncode,
+                                                      err.read().decode(errors='replace')[-2000:]))
+
+
+def _spill(lines, run_path):
+    lines.sort(key=shuffle_key)
+    with open(run_path, 'wb') as f:
+        f.writelines(lines)
+    return run_path
+
+
+def map_task(args):
+    """
+    Runs the mapper on a partition of the sample, its output is sorted in runs of up to RUN_BYTES
+    :return: (paths of the sorted runs, number of output records)
+    """
+    mapper_path, in_path, run_prefix = args
+    with open(in_path, 'rb') as fin, tempfile.TemporaryFile() as err:
+        proc = subprocess.Popen(script_cmd(mapper_path), stdin=fin, stdout=subprocess.PIPE, stderr=err)
+        runs, lines, size, records = [], [], 0, 0
+        for line in proc.stdout:
+            if not line.endswith(b'\n'):
+                line += b'\n'
+            lines.append(line)
+            size += len(line)
+            records += 1
+            if size >= RUN_BYTES:
+                runs.append(_spill(lines, '%s.%d' % (run_prefix, len(runs))))
+                lines, size = [], 0
+        if lines:
+            runs.append(_spill(lines, '%s.%d' % (run_prefix, len(runs))))
+        proc.stdout.close()
+        proc.wait()
+        _check(proc, mapper_path, err)
+    return runs, records
+
+
+def reduce_task(args):
+    """ Runs the reducer on a sorted partition of the map output :return: number of output records """
+    reducer_path, in_path, out_path = args
+    with open(in_path, 'rb') as fin, open(out_path, 'wb') as fout, tempfile.TemporaryFile() as err:
+        proc = subprocess.Popen(script_cmd(reducer_path), stdin=fin, stdout=fout, stderr=err)
+        proc.wait()
+        _check(proc, reducer_path, err)
+    with open(out_path, 'rb') as f:
+        return sum(1 for _ in f)
+
+
+class DryRun:
+    """
+    Runs `mapper | sort | reducer` locally on a sample of the input of a job, before it is submitted to the cluster.
+    The sample is split in one partition per worker and mapped on a process pool, the map outputs are sorted in runs
+    that are merged (external merge sort) and hash partitioned by key to the reducers, also run on the pool.
+    The report has the throughput of the sample and a preview of the output.
+    """
+    def __init__(self, workers=None, reducers=2, sample_bytes=16 * 1024 * 1024):
+        """
+        :param workers: processes of the pool, one per CPU if None
+        :param reducers: number of reduce partitions
+        :param sample_bytes: default size of the sample of the input, in whole lines
+        """
+        self.workers = workers or os.cpu_count() or 1
+        self.reducers = reducers
+        self.sampleBytes = sample_bytes
+
+    def sample(self, sources, sample_bytes, tmp_dir):
+        """
+        Takes an even share of the sample from the start of every input file, split in one partition per worker
+        :param sources: list of callables (offset, length) -> bytes of an input file, empty at its end
+        :return: (paths of the partitions, bytes, records)
+        """
+        share = max(sample_bytes // max(len(sources), 1), 1)
+        part_bytes = max(sample_bytes // self.workers, 1)
+        parts, out, out_size = [], None, 0
+        total = records = 0
+        for read in sources:
+            offset, taken, rest = 0, 0, b''
+            while taken < share:
+                buf = read(offset, min(share - taken, 1024 * 1024))
+                offset += len(buf)
+                data = rest + buf
+                if not buf:
+                    lines, rest = ([data] if data else []), b''     # unterminated last line of the file
+                else:
+                    nl = data.rfind(b'\n')
+                    lines, rest = data[:nl + 1].splitlines(keepends=True), data[nl + 1:]
+                for line in lines:
+                    if not line.endswith(b'\n'):
+                        line += b'\n'
+                    if out is None or out_size >= part_bytes:
+                        if out is not None:
+                            out.close()
+                        parts.append(os.path.join(tmp_dir, 'input.%d' % len(parts)))
+                        out, out_size = open(parts[-1], 'wb'), 0
+                    out.write(line)
+                    out_size += len(line)
+                    total += len(line)
+                    records += 1
+                    taken += len(line)
+                if not buf:
+                    break
+        if out is not None:
+            out.close()
+        return parts, total, records
+
+    def run(self, mapper_path, reducer_path, sources, sample_bytes=None):
+        """
+        :param sources: list of callables (offset, length) -> bytes of an input file, empty at its end
+        :return: dict of the report
+        """
+        sample_bytes = sample_bytes or self.sampleBytes
+        tmp_dir = tempfile.mkdtemp(prefix='mrbox-dryrun-')
+        # spawned, as forking the multi-threaded daemon may copy locks held by its other threads
+        pool = multiprocessing.get_context('spawn').Pool(self.workers)
+        report = {'state': 'ok'}
+        try:
+            t0 = time.time()
+            parts, size, records = self.sample(sources, sample_bytes, tmp_dir)
+            report.update(sample_bytes=size, input_records=records)
+            if not parts:
+                raise RuntimeError("the input is empty")
+
+            t1 = time.time()
+            mapped = pool.map(map_task, [(mapper_path, p, p + '.run') for p in parts])
+            runs = [r for part_runs, _ in mapped for r in part_runs]
+            report['map_output_records'] = sum(n for _, n in mapped)
+
+            # merge the sorted runs + partition them by key, every partition stays sorted
+            t2 = time.time()
+            reduce_in = [os.path.join(tmp_dir, 'shuffle.%d' % i) for i in range(self.reducers)]
+            files = [open(r, 'rb') for r in runs]
+            outs = [open(p, 'wb') for p in reduce_in]
+            try:
+                for line in heapq.merge(*files, key=shuffle_key):
+                    outs[zlib.crc32(shuffle_key(line)) % self.reducers].write(line)
+            finally:
+                for f in files + outs:
+                    f.close()
+
+            t3 = time.time()
+            reduce_out = [p + '.out' for p in reduce_in]
+            report['output_records'] = sum(pool.map(reduce_task, [(reducer_path, i, o)
+                                                                  for i, o in zip(reduce_in, reduce_out)]))
+            t4 = time.time()
+
+            report.update(map_secs=round(t2 - t1, 3), shuffle_secs=round(t3 - t2, 3), reduce_secs=round(t4 - t3, 3),
+                          throughput_mb_s=round(size / 1024 ** 2 / max(t4 - t0, 1e-6), 3),
+                          preview=self.preview(reduce_out))
+        except Exception as e:
+            report.update(state='failed', error=str(e))
+        finally:
+            pool.terminate()
+            pool.join()
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+        return report
+
+    @staticmethod
+    def preview(out_paths, n=PREVIEW_LINES):
+        lines = []
+        for path in out_paths:
+            with open(path, 'rb') as f:
+                for line in f:
+                    if len(lines) == n:
+                        return lines
+                    lines.append(line.rstrip(b'\n').decode(errors='replace'))
+        return lines
+
+    @staticmethod
+    def write_report(yaml_path, report):
+        """ Writes the report next to the .yaml of the job """
+        try:
+            with open(report_path(yaml_path), 'w') as f:
+                yaml.safe_dump(report, f, default_flow_style=False, sort_keys=False)
+        except OSError as e:
+            print("Dry run report not written: " + repr(e))
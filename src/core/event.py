@@ -4,16 +4,41 @@ import errno
 import subprocess
 from watchdog.events import FileSystemEventHandler
 from utils.path_util import customize_path, remove_prefix
-from utils.hdfs_util import hdfs_file_checksum, compare_local_hdfs_copy
-from utils.file_util import crc32c_file_checksum, rm_link_extension, to_link
+from utils.hdfs_util import compare_local_hdfs_copy
+from utils.file_util import ChecksumPool, crc32c_stream, rm_link_extension, bytes_to_mb
 from core.mrbox_object import MRBoxObject
+from core.job_scheduler import is_status_file
+from core.dry_run import DryRun
+from core.codec import remote_dest_path
+
+STAGE_REF = 'stage:'      # input of a pipeline stage that is the output of another stage
 
 
 class Event(FileSystemEventHandler):
-    def __init__(self, local_dir, hadoop, lc):
+    def __init__(self, local_dir, hadoop, lc, hash_pool=None, delta_sync=True, jobs=None, dry_run=None,
+                 dedupe=None):
+        """
+        :param delta_sync: if True, append-only growth of a modified file is uploaded with an HDFS append of its tail
+        :param jobs: JobScheduler that runs the MR jobs in the background, if None a job blocks the event handling
+        :param dry_run: DryRun of the jobs with dry_run: true in their .yaml
+        :param dedupe: Dedupe that renames / copies identical content on HDFS instead of uploading it, optional
+        """
         self.local = local_dir
         self.hadoop = hadoop
         self.lc = lc
+        self.hashPool = hash_pool if hash_pool is not None else ChecksumPool()
+        self.deltaSync = delta_sync
+        self.jobs = jobs
+        self.dryRun = dry_run if dry_run is not None else DryRun()
+        self.dedupe = dedupe
+        # intermediate outputs of the pipelines, next to the remote /mrbox folder
+        self.stageDir = customize_path(os.path.dirname(self.local.remotePath), '.mrbox-stages')
+
+    def dispatch(self, event):
+        # the status files of the jobs are local only
+        if is_status_file(event.src_path) or is_status_file(getattr(event, 'dest_path', '') or ''):
+            return
+        super().dispatch(event)
 
     def issue_mr_job(self, filepath):
         """
@@ -27,6 +52,9 @@ class Event(FileSystemEventHandler):
 
         with open(filepath, 'r') as f:
             data = yaml.load(f, Loader=yaml.FullLoader)
+            if 'stages' in data:
+                self.issue_pipeline(filepath, data['stages'])
+                return
             mapper_path = data.get('mapper')
             reducer_path = data.get('reducer')
             input_path = customize_path(self.local.localPath, data.get('input'))
@@ -38,28 +66,190 @@ class Event(FileSystemEventHandler):
             if not os.path.exists(f):
                 raise FileNotFoundError(errno.ENOENT, os.strerror(errno.ENOENT), f)
 
+        # dry run on a local sample of the input, the job is only submitted with submit: true and if it succeeds
+        if data.get('dry_run'):
+            if not self.dry_run_job(filepath, mapper_path, reducer_path, input_path, data.get('sample_mb')) \
+                    or not data.get('submit', False):
+                return
+
         # to issue MR job, the input file should be on hdfs --> need to get the remote path
         hdfs_input_path = self.lc.get_remote_file_path(customize_path(self.local.localPath, input_path))
         print("hdfs_input_path: " + hdfs_input_path)
+        self.prepare_input(input_path, hdfs_input_path)
 
         # need to generate local + remote output paths
         local_output_path = customize_path(self.local.localPath, output_path)
         hdfs_output_path = customize_path(self.local.remotePath, output_path)
 
         # issue MR job
-        cmd_mr = customize_path(self.hadoop.hadoopPath, 'bin/hadoop') + " jar " \
-                 + customize_path(self.hadoop.hadoopPath, 'share/hadoop/tools/lib/hadoop-streaming-3.2.0.jar') \
-                 + " -files " + mapper_path + "," + reducer_path + " -mapper 'mapper.py'" + " -reducer 'reducer.py'" \
-                 + " -input " + hdfs_input_path + " -output " + hdfs_output_path
+        cmd_mr = self.streaming_cmd(mapper_path, reducer_path, [hdfs_input_path], hdfs_output_path)
 
+        output_dir = MRBoxObject(local_output_path, self.local.localFileLimit, hdfs_output_path,
+                                 remote_file_type='dir')
+        if self.jobs is not None:
+            # run + fetched in the background, unless the same job already ran on the same input
+            fingerprint = None
+            if self.jobs.cache is not None:
+                fingerprint = self.jobs.cache.fingerprint(mapper_path, reducer_path, input_path)
+            self.jobs.submit(filepath, cmd_mr, output_dir, fingerprint)
+            return
         try:
-            output_dir = MRBoxObject(local_output_path, self.local.localFileLimit, hdfs_output_path,
-                                     remote_file_type='dir')
             self.hadoop.create_locally_synced_dir(cmd_mr, self.lc, output_dir)
         except subprocess.CalledProcessError as e:
             print("Map-Reduce job failed!")
             print(e.output)
 
+    def streaming_cmd(self, mapper_path, reducer_path, hdfs_input_paths, hdfs_output_path):
+        """ :return: the bash command of a Hadoop streaming job """
+        return customize_path(self.hadoop.hadoopPath, 'bin/hadoop') + " jar " \
+            + customize_path(self.hadoop.hadoopPath, 'share/hadoop/tools/lib/hadoop-streaming-3.2.0.jar') \
+            + " -files " + mapper_path + "," + reducer_path \
+            + " -mapper '" + os.path.basename(mapper_path) + "'" \
+            + " -reducer '" + os.path.basename(reducer_path) + "'" \
+            + "".join(" -input " + p for p in hdfs_input_paths) + " -output " + hdfs_output_path
+
+    def issue_pipeline(self, filepath, stages):
+        """
+        Issues the stages of a pipeline, a .yaml with a dict of stages of mapper, reducer, input(s) + optional output.
+        An input is a local path or stage:<name> for the output of another stage on HDFS.
+        Only the outputs of stages with an output are fetched in /mrbox, the others are intermediates that are kept
+        on HDFS only, in the stage dir out of the remote /mrbox folder, and are tracked by their job in the catalog.
+        :param stages: dict of stage name -> dict of the stage
+        """
+        print("issue_pipeline")
+        order = self.stage_order(stages)
+
+        # check that all files exist before issuing any stage
+        for name in order:
+            stage = stages[name]
+            paths = [stage.get('mapper'), stage.get('reducer')] + [customize_path(self.local.localPath, i)
+                                                                  for i in self.stage_inputs(stage)
+                                                                  if not i.startswith(STAGE_REF)]
+            for f in paths:
+                if f is None or not os.path.exists(f):
+                    raise FileNotFoundError(errno.ENOENT, os.strerror(errno.ENOENT), f)
+
+        intermediate_dir = customize_path(self.stageDir, os.path.splitext(remove_prefix(self.local.localPath,
+                                                                                        filepath))[0])
+        hdfs_outputs, job_ids = {}, {}
+        for name in order:
+            stage = stages[name]
+            hdfs_inputs, local_inputs, depends = [], [], []
+            for i in self.stage_inputs(stage):
+                if i.startswith(STAGE_REF):
+                    depends.append(i[len(STAGE_REF):])
+                    hdfs_inputs.append(hdfs_outputs[depends[-1]])
+                else:
+                    local_inputs.append(customize_path(self.local.localPath, i))
+                    hdfs_inputs.append(self.lc.get_remote_file_path(local_inputs[-1]))
+                    self.prepare_input(local_inputs[-1], hdfs_inputs[-1])
+            output_dir = None
+            hdfs_outputs[name] = customize_path(intermediate_dir, name)
+            if stage.get('output'):
+                hdfs_outputs[name] = customize_path(self.local.remotePath, stage['output'])
+                output_dir = MRBoxObject(customize_path(self.local.localPath, stage['output']),
+                                         self.local.localFileLimit, hdfs_outputs[name], remote_file_type='dir')
+            cmd_mr = self.streaming_cmd(stage['mapper'], stage['reducer'], hdfs_inputs, hdfs_outputs[name])
+
+            if self.jobs is not None:
+                fingerprint = None
+                if self.jobs.cache is not None and not depends and len(local_inputs) == 1:
+                    fingerprint = self.jobs.cache.fingerprint(stage['mapper'], stage['reducer'], local_inputs[0])
+                job_ids[name] = self.jobs.submit(filepath, cmd_mr, output_dir, fingerprint, name,
+                                                 [job_ids[d] for d in depends], hdfs_outputs[name])
+                continue
+            # without a scheduler the stages run one after the other
+            try:
+                if output_dir is not None:
+                    self.hadoop.create_locally_synced_dir(cmd_mr, self.lc, output_dir)
+                else:
+                    if self.hadoop.exists(hdfs_outputs[name]):
+                        self.hadoop.rm(hdfs_outputs[name])
+                    subprocess.run(cmd_mr, shell=True, check=True)
+            except subprocess.CalledProcessError as e:
+                print("Map-Reduce job of stage " + name + " failed!")
+                print(e.output)
+                return
+
+    def prepare_input(self, input_path, hdfs_input_path):
+        """
+        The pending uploads of the input of a job are moved ahead of the other transfers.
+        The packed files of the input are read from their containers: the containers of an input dir are
+        compacted so that the job reads no dead files, a packed input file is written as a file of its own
+        """
+        if self.hadoop.transfers is not None:
+            self.hadoop.transfers.prioritize(input_path)
+        packer = self.hadoop.packer
+        if packer is None:
+            return
+        if os.path.isdir(input_path):
+            packer.compact_subtree(hdfs_input_path)
+        else:
+            packer.unpack(hdfs_input_path)
+
+    @staticmethod
+    def stage_inputs(stage):
+        inputs = stage.get('input')
+        return inputs if isinstance(inputs, list) else [inputs]
+
+    @staticmethod
+    def stage_order(stages):
+        """ :return: the names of the stages, every stage after the stages of its inputs """
+        deps = {}
+        for name, stage in stages.items():
+            deps[name] = {i[len(STAGE_REF):] for i in Event.stage_inputs(stage) if i.startswith(STAGE_REF)}
+            unknown = deps[name] - set(stages)
+            if unknown:
+                raise ValueError("Stage %s reads the output of unknown stage %s" % (name, unknown.pop()))
+        order = []
+        while deps:
+            ready = [name for name, d in deps.items() if not d - set(order)]
+            if not ready:
+                raise ValueError("Cycle between the stages " + ", ".join(sorted(deps)))
+            order.extend(ready)
+            for name in ready:
+                del deps[name]
+        return order
+
+    def dry_run_job(self, filepath, mapper_path, reducer_path, input_path, sample_mb=None):
+        """
+        Runs the job locally on a sample of its input, the sample of a .link file is read from HDFS
+        :return: True if the dry run succeeded
+        """
+        print("dry run of " + filepath)
+        sources = []
+        for lp in self.input_files(input_path):
+            obj = MRBoxObject(lp, self.local.localFileLimit, self.lc.get_remote_file_path(lp))
+            if obj.is_link():
+                chk = self.lc.get_hdfs_chk(lp)
+                sources.append(lambda offset, length, rp=obj.remotePath, chk=chk:
+                               self.hadoop.read_range(rp, offset, length, chk)[1])
+            else:
+                sources.append(self.local_reader(lp))
+        report = self.dryRun.run(mapper_path, reducer_path, sources, bytes_to_mb(sample_mb) if sample_mb else None)
+        self.dryRun.write_report(filepath, report)
+        print("Dry run %s: %s" % (report['state'], report.get('error', '%s MB/s' % report.get('throughput_mb_s'))))
+        return report['state'] == 'ok'
+
+    @staticmethod
+    def input_files(input_path):
+        """ :return: the input files of a job, the hidden + _SUCCESS-like files of a dir are skipped as by Hadoop """
+        if not os.path.isdir(input_path):
+            return [input_path]
+        files = []
+        for root, dirs, names in os.walk(input_path):
+            dirs[:] = sorted(d for d in dirs if not d.startswith(('.', '_')))
+            files.extend(os.path.join(root, n) for n in sorted(names) if not n.startswith(('.', '_')))
+        return files
+
+    @staticmethod
+    def local_reader(local_path):
+        def read(offset, length):
+            with open(local_path, 'rb') as f:
+                f.seek(offset)
+                return f.read(length)
+        return read
+
     def on_any_event(self, event):
         print(event.event_type, event.src_path)
 
@@ -71,55 +261,123 @@ class Event(FileSystemEventHandler):
         if obj.is_dir() or obj.is_link():
             return
 
-        # if file, update the local checksum
-        loc_chk = crc32c_file_checksum(obj.localPath, obj.localType)
-        self.lc.update_tuple_local(obj.localPath, loc_chk)
+        # if file, update the local checksum + size, only the first loc_size bytes are hashed in case it still grows
+        loc_stat = os.stat(obj.localPath)
+        loc_size = loc_stat.st_size
+        row = self.lc.get_tuple(obj.localPath)
+        if row is not None and (row[self.lc.SIZE_LOC], row[self.lc.MTIME_LOC]) == (loc_size, loc_stat.st_mtime_ns) \
+                and row[self.lc.CHK_LOC] is not None and row[self.lc.CHK_LOC] == row[self.lc.CHK_HDFS]:
+            print("file already in sync")     # e.g. fetched again from HDFS by the RemotePoller
+            return
+        packed = self.hadoop.is_packed(obj.remotePath)
+        appended_chk = self.appended_checksum(obj.localPath, loc_size) if self.deltaSync and not packed else None
+        if appended_chk is not None:
+            loc_chk = appended_chk
+        else:
+            # hashed in the background while the copy on HDFS is updated
+            loc_chk = self.hashPool.submit(obj.localPath, obj.localType, loc_size)
 
         # update the copy on HDFS + the hdfs checksum
         try:
-            self.hadoop.rm(obj.remotePath)
-            self.hadoop.put(obj.localPath, obj.remotePath)
-            hdfs_chk = hdfs_file_checksum(self.hadoop.hadoopPath, obj.remotePath, obj.localType)
-            self.lc.update_tuple_hdfs(obj.localPath, hdfs_chk)
+            if appended_chk is not None:
+                # the file only grew: upload its tail, the copy on HDFS is now identical to the local one
+                print("appending to file on hdfs")
+                old_size = self.lc.get_loc_size(obj.localPath)
+                self.hadoop.append(obj.localPath, obj.remotePath, old_size, loc_size - old_size)
+                synced = self.hadoop.synced_checksum(obj.remotePath, obj.localType, appended_chk)
+            else:
+                # a packed file is packed again, unless it outgrew the threshold
+                hdfs_chk = self.hadoop.packer.replace(obj.localPath, obj.remotePath) if packed else None
+                synced = (hdfs_chk,)
+                if hdfs_chk is None:
+                    self.hadoop.replace(obj.localPath, obj.remotePath)
+                    synced = self.hadoop.synced_checksum(obj.remotePath, obj.localType)
+            # the size + mtime of the copy on HDFS, so that the RemotePoller does not take the upload for a change
+            self.lc.update_tuple_hdfs(obj.localPath, *synced)
         except:
             print("HDFS operation to update modified file failed!")
 
+        if appended_chk is None:
+            loc_chk = loc_chk.result()
+        self.lc.update_tuple_local(obj.localPath, loc_chk, loc_size, loc_stat.st_mtime_ns)
+
         # compare_local_hdfs_copy(self.lc, event.src_path)
 
+    def appended_checksum(self, local_path, loc_size):
+        """
+        Checks if a modified file only grew since it was last synced, i.e. its copy on HDFS is in sync with the
+        catalog and the checksum of its first size_local bytes is still chk_local
+        :return: the checksum of the first loc_size bytes of the file if it only grew, else None
+        """
+        old_size = self.lc.get_loc_size(local_path)
+        old_chk = self.lc.get_loc_chk(local_path)
+        if not old_size or old_size >= loc_size or old_chk is None or old_chk != self.lc.get_hdfs_chk(local_path):
+            return None
+        prefix_crc = crc32c_stream(local_path, old_size)
+        if "%08x" % prefix_crc != old_chk:
+            return None
+        # continue hashing from the end of the unchanged prefix
+        return "%08x" % crc32c_stream(local_path, loc_size - old_size, old_size, prefix_crc)
+
     def on_created(self, event):
         """ Creates dir / file on HDFS & adds mapping with mapping between local + hdfs path in the local db
         If created file is .yaml issues a MR job"""
         print("on_created")
 
         if self.lc.check_local_path_exists(event.src_path):
+            if not event.is_directory and self.lc.get_loc_chk(event.src_path) is not None:
+                # a synced file replaced by a rename over it, e.g. a save through a temp file
+                self.on_modified(event)
+                return
             print("file/dir already exists on hdfs - mapped on db")
             remote_file_path = self.lc.get_remote_file_path(event.src_path)
             obj = MRBoxObject(event.src_path, self.local.localFileLimit, remote_file_path)  # do we want remote file size?
             # obj.file_info()
             # update needed to insert the loc_chk in existent db record
             # in case of link: loc_chk != hdfs_chk
-            loc_chk = crc32c_file_checksum(obj.localPath, obj.localType)
-            self.lc.update_tuple_local(obj.localPath, loc_chk)
+            loc_stat = os.stat(obj.localPath) if obj.is_file() else None
+            loc_size = loc_stat.st_size if loc_stat else None
+            loc_chk = self.hashPool.submit(obj.localPath, obj.localType, loc_size)
+            pack = False
         else:
             print("file/dir needs to be created on hdfs - not mapped on db")
             filename = remove_prefix(self.local.localPath, event.src_path)
             remote_file_path = customize_path(self.local.remotePath, filename)
             obj = MRBoxObject(event.src_path, self.local.localFileLimit, remote_file_path)
             # obj.file_info()
-            loc_chk = crc32c_file_checksum(obj.localPath, obj.localType)
-            self.lc.insert_tuple_local(obj.localPath, obj.remotePath, loc_chk, obj.localType)
+            loc_stat = os.stat(obj.localPath) if obj.is_file() else None
+            loc_size = loc_stat.st_size if loc_stat else None
+            # small files are packed into the containers of their dir as they are, the others may be compressed
+            pack = obj.is_file() and self.hadoop.packer is not None and self.hadoop.packer.should_pack(loc_size)
+            if not pack:
+                obj.remotePath = self.hadoop.compression.remote_path(obj.localPath, obj.remotePath)
+            remote_file_path = obj.remotePath
+            loc_chk = self.hashPool.submit(obj.localPath, obj.localType, loc_size)
+            self.lc.insert_tuple_local(obj.localPath, obj.remotePath, None, obj.localType)
+
+        if pack:
+            print("packing file on hdfs")
+            hdfs_chk = self.hadoop.packer.add(obj.localPath, obj.remotePath)
+            self.lc.update_tuple_hdfs(obj.localPath, hdfs_chk)
 
         if not self.hadoop.exists(remote_file_path) and obj.is_dir():
             print("creating dir on hdfs")
             self.hadoop.mkdir(remote_file_path)
-            hdfs_chk = hdfs_file_checksum(self.hadoop.hadoopPath, obj.remotePath, obj.localType)
+            hdfs_chk = self.hadoop.checksum(obj.remotePath, obj.localType)
             self.lc.update_tuple_hdfs(obj.localPath, hdfs_chk)
 
-        if not self.hadoop.exists(remote_file_path) and obj.is_file():
-            print("creating file on hdfs")
-            self.hadoop.put(obj.localPath, obj.remotePath)
-            hdfs_chk = hdfs_file_checksum(self.hadoop.hadoopPath, obj.remotePath, obj.localType)
-            self.lc.update_tuple_hdfs(obj.localPath, hdfs_chk)
+        if not pack and obj.is_file() and not self.hadoop.exists(remote_file_path) \
+                and not self.hadoop.is_packed(remote_file_path):
+            # content already on HDFS, e.g. the other half of a move seen as deleted + created, is not uploaded
+            if self.dedupe is None or not self.dedupe.place(obj.localPath, obj.remotePath, loc_size,
+                                                            loc_chk.result()):
+                print("creating file on hdfs")
+                self.hadoop.put(obj.localPath, obj.remotePath)
+            self.lc.update_tuple_hdfs(obj.localPath, *self.hadoop.synced_checksum(obj.remotePath, obj.localType))
+
+        # the local checksum is hashed in parallel to the HDFS operations
+        self.lc.update_tuple_local(obj.localPath, loc_chk.result(), loc_size,
+                                   loc_stat.st_mtime_ns if loc_stat else None)
 
         # if it is a link, it already exists
 
@@ -130,54 +388,48 @@ class Event(FileSystemEventHandler):
 
     def on_deleted(self, event):
         """ Deletes dir / file from HDFS & removes the corresponding tuple from the local db
-        In case of a non-empty dir, the db records of its files and subdirectories are also deleted
-        the dir file structure does not exist locally anymore
-        need to find it through calls to HDFS to delete all related db records"""
+        In case of a non-empty dir, the db records of its files and subdirectories are also deleted,
+        found by their local path prefix in the db without listing HDFS"""
         print("on_deleted")
         remote_path = self.lc.get_remote_file_path(event.src_path)
-        if event.is_directory:
-            list_of_paths = self.hadoop.find_remote_paths(remote_path)
-            self.lc.delete_by_remote_path(list_of_paths)
-        else:
-            self.lc.delete_by_local_path([event.src_path])
-        self.hadoop.rm(remote_path)
+        if remote_path is None:
+            return
+        packed = self.hadoop.packer.locate(remote_path) if self.hadoop.packer is not None else None
+        row = self.lc.get_tuple(event.src_path) if self.dedupe is not None and not event.is_directory else None
+        self.lc.delete_subtree(event.src_path)
+        if packed is not None:
+            # its bytes are dead in its container
+            self.hadoop.packer.maybe_compact(packed['container'])
+            return
+        # the outputs of cached jobs are kept on HDFS, out of the remote /mrbox folder
+        if self.jobs is not None and self.jobs.cache is not None and self.jobs.cache.park(remote_path):
+            return
+        # kept as a tombstone for a while, in case the same content is created again
+        if row is None or not self.dedupe.bury(remote_path, row):
+            self.hadoop.rm(remote_path)
 
     def on_moved(self, event):
-        """ for non-empty dir: the db records of its files and subdirectories are also modified
-        the dir file structure does not exist locally anymore so need to find it through calls to HDFS to update all
-        related db records (local + remote path)
+        """ for non-empty dir: the db records of its files and subdirectories are also modified,
+        their local + remote paths are updated in the db by prefix in a single transaction
         for link: the corresponding remote file should be moved + the path in the link file should be changed
         """
         print("on_moved")
-        try:
-            rem_src_path = self.lc.get_remote_file_path(event.src_path)
-            tmp = customize_path(self.local.remotePath, remove_prefix(self.local.localPath, event.dest_path))
-            rem_dest_path = rm_link_extension(tmp)
-            existing_main_obj = MRBoxObject(event.dest_path, self.local.localFileLimit, rem_src_path)
-            if rem_src_path is not None:
-
-                if existing_main_obj.is_dir():
-                    # get all the remote paths of the files in the dir
-                    remote_src_paths = self.hadoop.find_remote_paths(rem_src_path)
-                    local_remote_tuples = []
-                    for rp in remote_src_paths:
-                        if rp == rem_src_path:
-                            local_remote_tuples.append((rp, event.dest_path, rem_dest_path))
-                        else:
-                            file_hierarchy = remove_prefix(rem_src_path, rp)
-                            new_remote_path = customize_path(rem_dest_path, file_hierarchy)
-                            loc_type = self.lc.get_loc_type_by_remote_path(rp)
-                            new_local_path = to_link(customize_path(event.dest_path, file_hierarchy), loc_type)
-                            local_remote_tuples.append((rp, new_local_path, new_remote_path))
-                            # modify links' content
-                            existing_obj = MRBoxObject(new_local_path, self.local.localFileLimit, rp)
-                            existing_obj.replace_loc_content(new_remote_path)
-                    self.lc.update_by_remote_path(local_remote_tuples)
+        rem_src_path = self.lc.get_remote_file_path(event.src_path)
+        if rem_src_path is None:
+            print("Move already handled!")      # e.g. a file of a dir whose move was already handled
+            return
+        tmp = customize_path(self.local.remotePath, remove_prefix(self.local.localPath, event.dest_path))
+        rem_dest_path = remote_dest_path(rm_link_extension(tmp), event.src_path, rem_src_path)
+        packed = not event.is_directory and self.hadoop.is_packed(rem_src_path)
+        self.lc.move_subtree(event.src_path, event.dest_path, rem_src_path, rem_dest_path)
+        if packed:
+            # only in the catalog, unless it moved to another dir
+            self.hadoop.packer.moved(rem_dest_path)
+            return
 
-                else:
-                    existing_main_obj.replace_loc_content(rem_dest_path)
-                    self.lc.update_by_remote_path([(rem_src_path, event.dest_path, rem_dest_path)])
+        # modify links' content
+        for lp, rp in self.lc.get_links_in_subtree(event.dest_path):
+            existing_obj = MRBoxObject(lp, self.local.localFileLimit, rp)
+            existing_obj.replace_loc_content(rp)
 
-                self.hadoop.mv(rem_src_path, rem_dest_path)
-        except FileNotFoundError:
-            print("Move already handled!")
+        self.hadoop.mv(rem_src_path, rem_dest_path)
@@ -0,0 +1,197 @@
+import os
+import time
+import threading
+from watchdog.events import FileSystemEventHandler, FileCreatedEvent, FileModifiedEvent, FileDeletedEvent, \
+    DirCreatedEvent, DirDeletedEvent, EVENT_TYPE_CREATED, EVENT_TYPE_MODIFIED, EVENT_TYPE_DELETED, EVENT_TYPE_MOVED
+from core.ignore import IGNORE_FILE
+
+HANDLED_EVENT_TYPES = (EVENT_TYPE_CREATED, EVENT_TYPE_MODIFIED, EVENT_TYPE_DELETED, EVENT_TYPE_MOVED)
+
+
+class QueuedEvent:
+    def __init__(self, event, due):
+        self.event = event
+        self.due = due          # the event is not handled before this time, pushed back by every coalesced event
+        self.paths = (event.src_path, event.dest_path) if event.event_type == EVENT_TYPE_MOVED else (event.src_path,)
+
+    def is_subtree_event(self):
+        """ dir deletes and moves affect all the paths under them """
+        return self.event.is_directory and self.event.event_type in (EVENT_TYPE_DELETED, EVENT_TYPE_MOVED)
+
+
+class EventQueue(FileSystemEventHandler):
+    """
+    Decouples the watchdog observer from the handling of the events.
+    The observer thread only queues the events, coalescing the pending events of the same path:
+        created + modified -> created, modified + modified -> modified, modified + deleted -> deleted,
+        file created + deleted -> deleted, file deleted + created -> modified,
+        file created A + moved A -> B -> deleted A + created B,
+        file moved A -> B + deleted B -> deleted A, or modified A if A was created again meanwhile
+    so that saves through a temp file or a backup copy end up as a single upload.
+    The created event of a file may be a temp file renamed over a file already on HDFS, so its delete is kept: the
+    handler skips the deletes of the paths that are not in the catalog, which is not read on the observer thread.
+    The events of ignored paths are dropped before they are queued: a move from an ignored path is a create at its
+    dest, a move to an ignored path is a delete of its src.
+    A pool of workers hands the events to the handler once they have been quiet for `delay` secs.
+    The events of a path are handled in order, and never concurrently to an earlier event of one of its ancestors,
+    or, for dir deletes / moves, of one of its descendants.
+    """
+    def __init__(self, handler, workers=4, delay=0.5, ignore=None):
+        """
+        :param handler: the FileSystemEventHandler that does the work, e.g. Event
+        :param workers: number of events handled concurrently
+        :param delay: secs that an event waits for more events of the same path to be coalesced with
+        :param ignore: IgnoreMatcher of the paths that are not synced, optional
+        """
+        self.handler = handler
+        self.delay = delay
+        self.ignore = ignore
+        self._cond = threading.Condition()
+        self._pending = []          # QueuedEvents in arrival order
+        self._by_path = {}          # src path -> list of its pending QueuedEvents
+        self._moved_to = {}         # dest path -> pending QueuedEvent of a file moved there
+        self._running = []          # QueuedEvents currently handled by a worker
+        self._stopping = False
+        self._workers = [threading.Thread(target=self._work, name='event-worker-%d' % i, daemon=True)
+                         for i in range(workers)]
+        for w in self._workers:
+            w.start()
+
+    def dispatch(self, event):
+        """ Called by the observer thread for every event """
+        if event.event_type not in HANDLED_EVENT_TYPES:
+            return
+        if self.ignore is not None:
+            event = self._unignored(event)
+            if event is None:
+                return
+        with self._cond:
+            self._coalesce(event)
+            self._cond.notify_all()
+
+    def _unignored(self, event):
+        """ :return: the event without its ignored paths, None if it only concerns ignored paths """
+        paths = (event.src_path, event.dest_path) if event.event_type == EVENT_TYPE_MOVED else (event.src_path,)
+        for p in paths:
+            if os.path.basename(p) == IGNORE_FILE:
+                self.ignore.update(p)
+        ignored = [self.ignore.is_ignored(p, event.is_directory) for p in paths]
+        if all(ignored):
+            return None
+        if not any(ignored):
+            return event
+        if ignored[0]:
+            # e.g. a temp file renamed over the file it saves
+            return DirCreatedEvent(event.dest_path) if event.is_directory else FileCreatedEvent(event.dest_path)
+        return DirDeletedEvent(event.src_path) if event.is_directory else FileDeletedEvent(event.src_path)
+
+    def _coalesce(self, event):
+        now = time.monotonic()
+        if event.event_type == EVENT_TYPE_DELETED and not event.is_directory and event.src_path in self._moved_to:
+            # a file moved aside + deleted, e.g. the backup copy of an editor save
+            moved = self._moved_to[event.src_path]
+            self._remove(moved)
+            src = moved.event.src_path
+            queue = self._by_path.get(src)
+            if queue and queue[-1].event.event_type == EVENT_TYPE_CREATED:
+                self._remove(queue[-1])     # written again under its name meanwhile
+                self._add(QueuedEvent(FileModifiedEvent(src), now + self.delay))
+            else:
+                self._coalesce(FileDeletedEvent(src))
+            return
+        queue = self._by_path.get(event.src_path)
+        last = queue[-1] if queue else None
+        prev_type = last.event.event_type if last else None
+        etype = event.event_type
+
+        if etype == EVENT_TYPE_MODIFIED and prev_type in (EVENT_TYPE_CREATED, EVENT_TYPE_MODIFIED):
+            last.due = now + self.delay
+            return
+        if etype == EVENT_TYPE_DELETED and prev_type == EVENT_TYPE_MODIFIED:
+            self._remove(last)
+        elif etype == EVENT_TYPE_DELETED and prev_type == EVENT_TYPE_CREATED and not event.is_directory:
+            self._remove(last)      # a no-op for the handler if it never reached HDFS
+        elif etype == EVENT_TYPE_CREATED and prev_type == EVENT_TYPE_DELETED and not event.is_directory:
+            self._remove(last)      # replaced by a new version
+            event = FileModifiedEvent(event.src_path)
+        elif etype == EVENT_TYPE_MOVED and prev_type == EVENT_TYPE_CREATED and not event.is_directory:
+            self._remove(last)      # upload it directly under its new name
+            self._coalesce(FileDeletedEvent(event.src_path))
+            self._coalesce(FileCreatedEvent(event.dest_path))
+            return
+        self._add(QueuedEvent(event, now + self.delay))
+
+    def _add(self, qe):
+        self._pending.append(qe)
+        self._by_path.setdefault(qe.event.src_path, []).append(qe)
+        if qe.event.event_type == EVENT_TYPE_MOVED and not qe.event.is_directory:
+            self._moved_to[qe.event.dest_path] = qe
+
+    def _remove(self, qe):
+        self._pending.remove(qe)
+        if self._moved_to.get(getattr(qe.event, 'dest_path', None)) is qe:
+            del self._moved_to[qe.event.dest_path]
+        queue = self._by_path[qe.event.src_path]
+        queue.remove(qe)
+        if not queue:
+            del self._by_path[qe.event.src_path]
+
+    @staticmethod
+    def _ancestors(path):
+        parent = os.path.dirname(path)
+        while parent and parent != path:
+            yield parent
+            path, parent = parent, os.path.dirname(parent)
+
+    def _next_ready(self):
+        """
+        :return: (the first pending event that can be handled now or None, secs to wait for the next due event)
+        """
+        now = time.monotonic()
+        blocked = set()
+        for qe in self._running:
+            blocked.update(qe.paths)
+        wait = None
+        for qe in self._pending:
+            conflict = any(p in blocked or any(a in blocked for a in self._ancestors(p)) for p in qe.paths)
+            if not conflict and qe.is_subtree_event():
+                prefixes = tuple(os.path.join(p, '') for p in qe.paths)
+                conflict = any(b.startswith(prefixes) for b in blocked)
+            if not conflict and (qe.due <= now or self._stopping):
+                return qe, None
+            if not conflict:
+                wait = qe.due - now if wait is None else min(wait, qe.due - now)
+            blocked.update(qe.paths)    # later events of the same paths wait for this one
+        return None, wait
+
+    def _work(self):
+        while True:
+            with self._cond:
+                qe, wait = self._next_ready()
+                while qe is None:
+                    if self._stopping and not self._pending:
+                        return
+                    self._cond.wait(wait)
+                    qe, wait = self._next_ready()
+                self._remove(qe)
+                self._running.append(qe)
+            try:
+                self.handler.dispatch(qe.event)
+            except Exception as e:
+                print("Handling of " + qe.event.event_type + " " + qe.event.src_path + " failed: " + repr(e))
+            finally:
+                with self._cond:
+                    self._running.remove(qe)
+                    self._cond.notify_all()
+
+    def pending(self):
+        with self._cond:
+            return len(self._pending) + len(self._running)
+
+    def stop(self):
+        """ Handles the pending events without waiting for their delay and stops the workers """
+        with self._cond:
+            self._stopping = True
+            self._cond.notify_all()
+        for w in self._workers:
+            w.join()
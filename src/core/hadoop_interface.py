@@ -1,35 +1,169 @@
 import subprocess
 import os
+import sys
+import crc32c
+from concurrent.futures import ThreadPoolExecutor
 from core.mrbox_object import MRBoxObject
+from core.hdfs_metadata import HDFSMetadata
+from core.codec import Compression, SAMPLE_BYTES, codec_of, read_chunks, transcode
 from utils.path_util import customize_path, remove_prefix
-from utils.hdfs_util import hdfs_file_checksum, hdfs_file_size
+
+TRANSFER_CHUNK = 4 * 1024 * 1024
+TMP_PREFIX = '.mrbox-tmp.'
+HEAD_TAIL_BYTES = 1024     # as hdfs dfs -head / -tail
+OUTPUT_SKIP = ('_', '.')   # _SUCCESS, _logs + hidden files of a job output are not fetched
+MERGED_PART = 'part-merged'
+CHECKSUM_WORKERS = 4       # HDFS checksums of the linked outputs computed concurrently
 
 
 class HadoopInterface:
-    def __init__(self, hdfs_con, hadoop_path):
+    def __init__(self, hdfs_con, hadoop_path, checksum_stream_limit=16 * 1024 * 1024, transfers=None,
+                 block_cache=None, line_indexer=None, merge_parts=False, compression=None, packer=None):
         """
         :param hdfs_con: from hdfs3
         :param hadoop_path: the local hadoop path
+        :param checksum_stream_limit: max size in bytes of the HDFS files checksummed in-process
+        :param transfers: TransferEngine for concurrent uploads / downloads, if None files are copied by hdfs3
+        :param block_cache: BlockCache for the range reads of links, if None every read goes to HDFS
+        :param line_indexer: LineIndexer that indexes the remote files of new links in the background, optional
+        :param merge_parts: if True the part-* files of the job outputs are merged into one before they are fetched
+        :param compression: Compression of the uploads + local copies of the outputs, if None files are copied as is
+        :param packer: Packer of the small files into containers, if None every file is a file of its own on HDFS
         """
         self.hdfsCon = hdfs_con
         self.hadoopPath = hadoop_path
+        self.metadata = HDFSMetadata(hdfs_con, hadoop_path, checksum_stream_limit)
+        self.transfers = transfers
+        self.blockCache = block_cache
+        self.lineIndexer = line_indexer
+        self.mergeParts = merge_parts
+        self.compression = compression if compression is not None else Compression()
+        self.packer = packer
 
     def head(self, hdfs_path):
-        cmd = customize_path(self.hadoopPath, 'bin/hdfs') + " dfs -head " + hdfs_path
-        subprocess.run(cmd, shell=True, check=True)
+        sys.stdout.buffer.write(self.read_head(hdfs_path))
+        sys.stdout.flush()
 
     def tail(self, hdfs_path):
-        cmd = customize_path(self.hadoopPath, 'bin/hdfs') + " dfs -tail " + hdfs_path
-        subprocess.run(cmd, shell=True, check=True)
+        sys.stdout.buffer.write(self.read_tail(hdfs_path))
+        sys.stdout.flush()
+
+    def read_head(self, hdfs_path, nbytes=HEAD_TAIL_BYTES):
+        """ :return: the first nbytes of an HDFS file, as `hdfs dfs -head` without starting a JVM """
+        if self.is_packed(hdfs_path):
+            return self.packer.read(hdfs_path, 0, nbytes)
+        with self.hdfsCon.open(hdfs_path, 'rb') as f:
+            return f.read(nbytes)
+
+    def read_tail(self, hdfs_path, nbytes=HEAD_TAIL_BYTES):
+        """ :return: the last nbytes of an HDFS file, as `hdfs dfs -tail` without starting a JVM """
+        if self.is_packed(hdfs_path):
+            size = self.packer.locate(hdfs_path)['length']
+            return self.packer.read(hdfs_path, max(0, size - nbytes), nbytes)
+        size = self.hdfsCon.info(hdfs_path)['size']
+        with self.hdfsCon.open(hdfs_path, 'rb') as f:
+            f.seek(max(0, size - nbytes))
+            return f.read(nbytes)
+
+    def read_range(self, hdfs_path, offset, length, chk=None):
+        """
+        :param chk: the HDFS checksum of the file in the catalog, the cached blocks of other versions are dropped
+        :return: (size of the file, up to length bytes of the file from offset)
+        """
+        if self.is_packed(hdfs_path):
+            # not cached, the offsets of a packed file change when its container is compacted
+            return self.packer.locate(hdfs_path)['length'], self.packer.read(hdfs_path, offset, length)
+        size = self.metadata.stat(hdfs_path)['size']
+        if self.blockCache is not None:
+            return size, self.blockCache.read(hdfs_path, chk, offset, length, size)
+        if offset >= size:
+            return size, b''
+        with self.hdfsCon.open(hdfs_path, 'rb') as f:
+            f.seek(offset)
+            return size, f.read(min(length, size - offset))
+
+    def is_packed(self, hdfs_path):
+        """ :return: True if the file is packed in a container, see core.packing """
+        return self.packer is not None and self.packer.locate(hdfs_path) is not None
 
     def mv(self, hdfs_src_path, hdfs_dest_path):
         self.hdfsCon.mv(hdfs_src_path, hdfs_dest_path)
 
     def rm(self, hdfs_path):
         self.hdfsCon.rm(hdfs_path)
+        self.metadata.forget(hdfs_path)
 
     def put(self, local_path, hdfs_path):
-        self.hdfsCon.put(local_path, hdfs_path)
+        """ Uploads a local file, compressed / decompressed on the way if only one of the paths has a codec ext """
+        codec, encode = self.compression.transit_codec(local_path, hdfs_path)
+        if self.transfers is not None:
+            self.transfers.upload(local_path, hdfs_path, codec, encode).result()
+        elif codec is None:
+            self.hdfsCon.put(local_path, hdfs_path)
+        else:
+            with open(local_path, 'rb') as lf, self.hdfsCon.open(hdfs_path, 'wb', buff=TRANSFER_CHUNK) as hf:
+                for buf in transcode(read_chunks(lf, TRANSFER_CHUNK), codec, encode):
+                    hf.write(buf)
+
+    def append(self, local_path, hdfs_path, offset, length):
+        """
+        Appends length bytes of a local file, starting from offset, to a file on hdfs
+        """
+        with open(local_path, 'rb') as lf, self.hdfsCon.open(hdfs_path, 'ab') as hf:
+            lf.seek(offset)
+            while length > 0:
+                buf = lf.read(min(TRANSFER_CHUNK, length))
+                if not buf:
+                    break
+                hf.write(buf)
+                length -= len(buf)
+
+    def replace(self, local_path, hdfs_path):
+        """
+        Uploads a local file to a temp path next to hdfs_path and renames it over hdfs_path,
+        so that hdfs_path is never missing while the upload is in progress
+        """
+        tmp_path = customize_path(os.path.dirname(hdfs_path), TMP_PREFIX + os.path.basename(hdfs_path))
+        self.put(local_path, tmp_path)
+        if self.hdfsCon.exists(hdfs_path):
+            self.rm(hdfs_path)      # HDFS rename does not overwrite
+        self.hdfsCon.mv(tmp_path, hdfs_path)
+
+    def copy_tree(self, hdfs_src_path, hdfs_dest_path):
+        """
+        Copies a file / dir on hdfs, streaming the files through the client
+        :return: the number of bytes copied
+        """
+        if self.metadata.stat(hdfs_src_path)['kind'] == 'file':
+            return self._copy_file(hdfs_src_path, hdfs_dest_path)
+        self.hdfsCon.mkdir(hdfs_dest_path)
+        copied = 0
+        for meta in self.metadata.stat_dir(hdfs_src_path):
+            dest = customize_path(hdfs_dest_path, os.path.basename(meta['path'].rstrip('/')))
+            copied += self.copy_tree(meta['path'], dest)
+        return copied
+
+    def _copy_file(self, hdfs_src_path, hdfs_dest_path, mode='wb'):
+        copied = 0
+        with self.hdfsCon.open(hdfs_src_path, 'rb', buff=TRANSFER_CHUNK) as src, \
+                self.hdfsCon.open(hdfs_dest_path, mode, buff=TRANSFER_CHUNK) as dest:
+            while True:
+                buf = src.read(TRANSFER_CHUNK)
+                if not buf:
+                    break
+                dest.write(buf)
+                copied += len(buf)
+        return copied
+
+    def distcp(self, hdfs_src_path, hdfs_dest_path):
+        """ Copies a file / dir on the cluster by a distcp job, without streaming it through the client """
+        subprocess.run([customize_path(self.hadoopPath, 'bin/hadoop'), 'distcp', hdfs_src_path, hdfs_dest_path],
+                       check=True, stdout=subprocess.DEVNULL)
+        self.metadata.forget(hdfs_dest_path)
+
+    def du(self, hdfs_path):
+        """ :return: total size in bytes of a file / dir on hdfs """
+        return self.hdfsCon.du(hdfs_path, total=True, deep=True)
 
     def walk(self, path):
         return self.hdfsCon.walk(path)
@@ -43,16 +177,80 @@ class HadoopInterface:
     def mkdir(self, hdfs_path):
         self.hdfsCon.mkdir(hdfs_path)
 
+    def checksum(self, hdfs_path, ftype, meta=None):
+        """ COMPOSITE-CRC32C checksum of an HDFS file, see HDFSMetadata.checksum """
+        return self.metadata.checksum(hdfs_path, ftype, meta)
+
+    def synced_checksum(self, hdfs_path, ftype, chk=None):
+        """
+        :param chk: the checksum of the file if already known, e.g. computed while appending to it
+        :return: (checksum, size, mtime) of an HDFS file just written, as recorded by LocalCatalog.update_tuple_hdfs
+        """
+        meta = self.metadata.stat(hdfs_path)
+        if chk is None:
+            chk = self.checksum(hdfs_path, ftype, meta)
+        return chk, meta['size'], meta['mtime']
+
+    def fetched_checksum(self, hdfs_path, meta, chk=None):
+        """
+        :param meta: the metadata of the file as returned by HDFSMetadata.stat()
+        :param chk: the CRC32C of the bytes read from HDFS by the fetch of the file, None if not known
+        :return: the HDFS checksum of a fetched file, computed on the way if possible so that it is not read twice
+        """
+        if chk is None:
+            return self.checksum(hdfs_path, 'file', meta)
+        self.metadata.remember(hdfs_path, meta, chk)
+        return chk
+
     def get(self, mrboxf):
         """
         Get a file locally from hdfs, triggers on_created()
         :param mrboxf: the mrbox_file object
         :return:
         """
+        transfer = self.get_async(mrboxf)
+        if transfer is not None:
+            transfer.result()
+
+    def get_async(self, mrboxf, on_staged=None):
+        """
+        Starts getting a file locally from hdfs, links are created right away and their checksum is recorded by the
+        caller, see record_link
+        :param mrboxf: the mrbox_file object
+        :param on_staged: called with (path of the complete file, HDFS checksum, local checksum) before it is moved
+        to its local path, see TransferEngine.download, not called for links. Without a TransferEngine the file is
+        written in place first and the checksums are None.
+        :return: the Transfer in progress, None if already done
+        """
         if mrboxf.is_link():
             mrboxf.create_loc_link()
+        elif self.is_packed(mrboxf.remotePath):
+            staging_path = self.transfers.staging_path() if self.transfers is not None else mrboxf.localPath
+            data = self.packer.read(mrboxf.remotePath)
+            with open(staging_path, 'wb') as lf:
+                lf.write(data)
+            if on_staged is not None:
+                chk = "%08x" % crc32c.crc32c(data)
+                on_staged(staging_path, chk, chk)
+            if staging_path != mrboxf.localPath:
+                os.replace(staging_path, mrboxf.localPath)
         else:
-            self.hdfsCon.get(mrboxf.remotePath, mrboxf.localPath)
+            # a compressed copy on one side only is decoded / encoded on the way
+            codec, on_hdfs = self.compression.transit_codec(mrboxf.localPath, mrboxf.remotePath)
+            encode = None if codec is None else not on_hdfs
+            if self.transfers is not None:
+                return self.transfers.download(mrboxf.remotePath, mrboxf.localPath,
+                                               None if codec else mrboxf.remoteFileSize, codec, encode, on_staged)
+            if codec is None:
+                self.hdfsCon.get(mrboxf.remotePath, mrboxf.localPath)
+            else:
+                with self.hdfsCon.open(mrboxf.remotePath, 'rb', buff=TRANSFER_CHUNK) as hf, \
+                        open(mrboxf.localPath, 'wb') as lf:
+                    for buf in transcode(read_chunks(hf, TRANSFER_CHUNK), codec, encode):
+                        lf.write(buf)
+            if on_staged is not None:
+                on_staged(mrboxf.localPath, None, None)
+        return None
 
     def find_remote_paths(self, starting_path):
         """
@@ -80,19 +278,92 @@ class HadoopInterface:
         # create on hdfs --> tracked file: put on db --> create locally
         print("create locally synced dir")
         subprocess.run(cmd, shell=True, check=True)
-        hdfs_chk = hdfs_file_checksum(self.hadoopPath, mrbox_dir.remotePath, mrbox_dir.remoteType)
-        lc.insert_tuple_hdfs(mrbox_dir.localPath, mrbox_dir.remotePath, hdfs_chk, mrbox_dir.localType)
+        self.sync_remote_dir(lc, mrbox_dir)
+
+    def sync_remote_dir(self, lc, mrbox_dir, merge_parts=None):
+        """
+        Creates a local copy of a dir created on hdfs, e.g. the output dir of a MR job.
+        The dir is listed once, the _SUCCESS marker, hidden files and empty parts are not fetched. The catalog rows of
+        all the files are written in one transaction, then the files are fetched concurrently while their HDFS
+        checksums are computed.
+        :param lc: sqlite3 db class instance
+        :param mrbox_dir: MRBox file object with the info regarding the dir that will be created locally
+        :param merge_parts: if True the part-* files are merged into one on HDFS first, fetched as one file or link,
+        if None as set for the interface
+        :return:
+        """
+        merge_parts = self.mergeParts if merge_parts is None else merge_parts
+        metas = [m for m in self.metadata.stat_dir(mrbox_dir.remotePath)
+                 if m['kind'] == 'file' and m['size'] > 0 and not os.path.basename(m['path']).startswith(OUTPUT_SKIP)]
+        if merge_parts:
+            metas = self.merge_parts(mrbox_dir.remotePath, metas)
+        files = []
+        local_codec = self.compression.localCodec
+        for meta in metas:
+            lp = customize_path(mrbox_dir.localPath, remove_prefix(mrbox_dir.remotePath, meta['path']))
+            size = meta['size']
+            if local_codec is not None and size > mrbox_dir.localFileLimit and codec_of(meta['path']) is None:
+                # kept compressed locally instead of as a link if it fits, by the ratio of a sample of its head
+                compressed = int(size * local_codec.ratio(self.read_head(meta['path'], SAMPLE_BYTES)))
+                if compressed <= mrbox_dir.localFileLimit:
+                    lp, size = lp + local_codec.ext, compressed
+            files.append((MRBoxObject(lp, mrbox_dir.localFileLimit, meta['path'], size, 'file'), meta))
+
+        # the rows exist before the files do, so the events of the fetched files find them
+        lc.insert_tuples_hdfs([(mrbox_dir.localPath, mrbox_dir.remotePath, None, mrbox_dir.localType)]
+                              + [(f.localPath, f.remotePath, None, f.localType) for f, _ in files])
         os.mkdir(mrbox_dir.localPath)  # creates an empty directory of hdfs outputs locally, triggers on_created()
         print("folder created")
 
-        for rp in self.ls(mrbox_dir.remotePath):
-            hdfs_chk = hdfs_file_checksum(self.hadoopPath, rp, 'file')
-            file_size = hdfs_file_size(self.hadoopPath, rp)
-            f = remove_prefix(mrbox_dir.remotePath, rp)
-            lp = customize_path(mrbox_dir.localPath, f)
-            mrbox_file = MRBoxObject(lp, mrbox_dir.localFileLimit, rp, file_size, 'file')
-
-            # todo: insert in batch
-            lc.insert_tuple_hdfs(mrbox_file.localPath, mrbox_file.remotePath, hdfs_chk, mrbox_file.localType)
-            mrbox_file.file_info()
-            self.get(mrbox_file)
+        # the checksums of the fetched files are computed on the way, only the remote files of links are read for it
+        with ThreadPoolExecutor(max_workers=CHECKSUM_WORKERS, thread_name_prefix='output-chk') as pool:
+            chks = [(f, meta, pool.submit(self.checksum, f.remotePath, 'file', meta))
+                    for f, meta in files if f.is_link()]
+            transfers = [t for t in (self.get_async(f, self._record_checksum(lc, f, meta)) for f, meta in files)
+                         if t is not None]
+            for f, meta, chk in chks:
+                self.record_link(lc, f.localPath, f.remotePath, meta, chk.result())
+            if self.transfers is not None:
+                self.transfers.wait_all(transfers)
+                print("outputs fetched: " + self.transfers.progress.report())
+
+    def record_link(self, lc, local_path, hdfs_path, meta, chk):
+        """
+        Records the HDFS checksum of the remote file of a link, then indexes its lines in the background:
+        an index is stale once the checksum in the catalog differs from the one it was built for
+        """
+        lc.update_tuple_hdfs(local_path, chk, meta['size'], meta['mtime'])
+        if self.lineIndexer is not None:
+            self.lineIndexer.submit(hdfs_path)
+
+    def _record_checksum(self, lc, mrboxf, meta):
+        """ :return: the on_staged callback of a fetched output, that records its HDFS checksum """
+        def record(staged_path, hdfs_chk, local_chk):
+            lc.update_tuple_hdfs(mrboxf.localPath, self.fetched_checksum(mrboxf.remotePath, meta, hdfs_chk),
+                                 meta['size'], meta['mtime'])
+        return record
+
+    def merge_parts(self, hdfs_dir, metas):
+        """
+        Merges the part-* files of a job output into one file on HDFS, by a concat of their blocks if the namenode
+        accepts it else by appending them through the client
+        :param metas: list of dicts of the files of the output dir as returned by stat_dir()
+        :return: metas with the part files replaced by the merged one
+        """
+        parts = sorted((m for m in metas if os.path.basename(m['path']).startswith('part-')), key=lambda m: m['path'])
+        if len(parts) < 2:
+            return metas
+        merged = customize_path(hdfs_dir, MERGED_PART)
+        print("merging %d parts of %s" % (len(parts), hdfs_dir))
+        self.mv(parts[0]['path'], merged)
+        try:
+            self.hdfsCon.concat(merged, [m['path'] for m in parts[1:]])
+        except Exception:
+            # concat requires whole blocks on most namenodes, a part is removed once appended
+            for m in parts[1:]:
+                self._copy_file(m['path'], merged, 'ab')
+                self.rm(m['path'])
+        for m in parts:
+            self.metadata.forget(m['path'])
+        self.metadata.forget(merged)
+        return [m for m in metas if m not in parts] + [self.metadata.stat(merged)]
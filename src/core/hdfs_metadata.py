@@ -0,0 +1,100 @@
+import threading
+import crc32c
+from utils.hdfs_util import hdfs_file_checksum
+
+READ_BUFFER = 4 * 1024 * 1024
+
+
+class HDFSMetadata:
+    """
+    Size, modification time and checksum of HDFS files through the existing hdfs3 connection,
+    instead of a `bin/hdfs dfs` JVM per call.
+    The COMPOSITE-CRC32C of a file is the CRC32C of its content, so small files are checksummed by streaming them
+    in-process. Files larger than stream_limit fall back to `hdfs dfs -checksum`, which is computed by the datanodes.
+    The checksum of a file that is fetched is computed on the way by the TransferEngine and remembered here instead.
+    """
+    def __init__(self, hdfs_con, hadoop_path, stream_limit=16 * 1024 * 1024):
+        """
+        :param hdfs_con: from hdfs3
+        :param hadoop_path: the local hadoop path, for the checksum of large files
+        :param stream_limit: max size in bytes of the files checksummed in-process
+        """
+        self.hdfsCon = hdfs_con
+        self.hadoopPath = hadoop_path
+        self.streamLimit = stream_limit
+        self._chk_cache = {}                # hdfs path -> (size, mtime, checksum)
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def to_meta(info):
+        return {'path': info['name'],
+                'kind': 'dir' if info['kind'] == 'directory' else 'file',
+                'size': info['size'],
+                'mtime': info['last_mod']}
+
+    def stat(self, hdfs_path):
+        """
+        :return: dict with the path, kind ('dir' or 'file'), size in bytes and mtime in epoch secs of an HDFS path
+        """
+        return self.to_meta(self.hdfsCon.info(hdfs_path))
+
+    def stat_dir(self, hdfs_dir):
+        """
+        Metadata of all the entries of a directory with a single listing
+        :return: list of dicts as returned by stat()
+        """
+        return [self.to_meta(info) for info in self.hdfsCon.ls(hdfs_dir, detail=True)]
+
+    def checksum(self, hdfs_path, ftype, meta=None):
+        """
+        Returns the COMPOSITE-CRC32C checksum of an HDFS file as a hex str, None for dirs
+        :param hdfs_path: the path of the file on hdfs
+        :param ftype: the type of the local copy of the file ('dir', 'file', 'link')
+        :param meta: the metadata of the file if already listed, saves a call to stat()
+        :return:
+        """
+        if ftype == 'dir':
+            return None
+        if meta is None:
+            meta = self.stat(hdfs_path)
+        if meta['kind'] == 'dir':
+            return None
+        with self._lock:
+            cached = self._chk_cache.get(hdfs_path)
+        if cached is not None and cached[:2] == (meta['size'], meta['mtime']):
+            return cached[2]
+
+        if meta['size'] <= self.streamLimit:
+            chk = "%08x" % self.stream_crc32c(hdfs_path)
+        else:
+            chk = hdfs_file_checksum(self.hadoopPath, hdfs_path, ftype)
+        with self._lock:
+            self._chk_cache[hdfs_path] = (meta['size'], meta['mtime'], chk)
+        return chk
+
+    def checksums(self, metas):
+        """
+        :param metas: list of dicts as returned by stat_dir()
+        :return: dict of hdfs path -> checksum of the listed files
+        """
+        return {m['path']: self.checksum(m['path'], m['kind'], m) for m in metas}
+
+    def stream_crc32c(self, hdfs_path):
+        crc = 0
+        with self.hdfsCon.open(hdfs_path, 'rb', buff=READ_BUFFER) as f:
+            while True:
+                buf = f.read(READ_BUFFER)
+                if not buf:
+                    break
+                crc = crc32c.crc32c(buf, crc)
+        return crc & 0xFFFFFFFF
+
+    def remember(self, hdfs_path, meta, chk):
+        """ Caches the checksum of a file computed elsewhere, e.g. from the bytes of its download """
+        with self._lock:
+            self._chk_cache[hdfs_path] = (meta['size'], meta['mtime'], chk)
+
+    def forget(self, hdfs_path):
+        """ Drops the cached checksum of a path that was removed or rewritten """
+        with self._lock:
+            self._chk_cache.pop(hdfs_path, None)
@@ -0,0 +1,120 @@
+import os
+import re
+import threading
+
+IGNORE_FILE = '.mrboxignore'
+# editor swap + lock files, partial downloads and OS metadata, ignored in every dir unless disabled
+DEFAULT_PATTERNS = ['*.swp', '*.swo', '*.swx', '*~', '.#*', '#*#', '.~lock.*#', '4913', '*.tmp', '*.part',
+                    '*.crdownload', '.DS_Store', '__pycache__/']
+
+
+def pattern_to_regex(pattern):
+    """
+    Translates a gitignore-style pattern to a regex of the paths relative to the dir of its ignore file:
+    * and ? do not match /, ** matches across dirs, a pattern with a / before its end is anchored to the dir,
+    a trailing / matches dirs only. The paths under a matched dir match too.
+    """
+    dir_only = pattern.endswith('/')
+    pattern = pattern.rstrip('/')
+    anchored = '/' in pattern
+    pattern = pattern.lstrip('/')
+    out, i = [], 0
+    while i < len(pattern):
+        c = pattern[i]
+        if pattern.startswith('**/', i):
+            out.append('(?:.*/)?')
+            i += 3
+            continue
+        if pattern.startswith('**', i):
+            out.append('.*')
+            i += 2
+            continue
+        if c == '*':
+            out.append('[^/]*')
+        elif c == '?':
+            out.append('[^/]')
+        elif c == '[':
+            end = pattern.find(']', i + 1)
+            if end == -1:
+                out.append(re.escape(c))
+            else:
+                body = pattern[i + 1:end]
+                out.append('[' + ('^' + body[1:] if body.startswith('!') else body) + ']')
+                i = end
+        else:
+            out.append(re.escape(c))
+        i += 1
+    # dirs are matched with a trailing /, so a dir-only pattern needs one
+    return ('' if anchored else '(?:.*/)?') + ''.join(out) + ('/.*' if dir_only else '(?:/.*)?')
+
+
+class IgnoreMatcher:
+    """
+    The paths of the /mrbox folder that are not synced: the gitignore-style patterns of the .mrboxignore files,
+    which apply to the dir of their file and its subdirs, + the default patterns in every dir.
+    As in gitignore the last rule that matches a path decides, a !pattern re-includes the paths it matches: the default
+    patterns come first, then the rules of every ignore file in order, the files of the parent dirs before the ones of
+    their subdirs. All the rules are compiled into one regex of the absolute paths, with one alternative per rule from
+    the last to the first, so that the alternative that matches is the last rule that matches.
+    The ignore files are read at start-up and again when one of them changes.
+    """
+    def __init__(self, root, defaults=True):
+        """
+        :param root: the local /mrbox folder
+        :param defaults: if True the DEFAULT_PATTERNS are ignored everywhere
+        """
+        self.root = root.rstrip('/')
+        self.defaults = defaults
+        self._patterns = {}         # dir -> list of patterns of its ignore file
+        self._lock = threading.Lock()
+        self._rules = (None, [])    # the regex + per alternative of it, True for a !pattern, swapped at once
+        for dirpath, _, filenames in os.walk(self.root):
+            if IGNORE_FILE in filenames:
+                self._patterns[dirpath] = self.read(os.path.join(dirpath, IGNORE_FILE))
+        self.compile()
+
+    @staticmethod
+    def read(ignore_path):
+        try:
+            with open(ignore_path, 'r') as f:
+                lines = [line.rstrip('\n').rstrip() for line in f]
+        except OSError:
+            return []
+        return [line for line in lines if line and not line.startswith('#')]
+
+    def update(self, ignore_path):
+        """ Reads again an ignore file that was created, modified or deleted """
+        dirpath = os.path.dirname(ignore_path)
+        with self._lock:
+            if os.path.exists(ignore_path):
+                self._patterns[dirpath] = self.read(ignore_path)
+            else:
+                self._patterns.pop(dirpath, None)
+        self.compile()
+        print("Ignore rules of %s reloaded" % dirpath)
+
+    def compile(self):
+        with self._lock:
+            scoped = sorted(self._patterns.items(), key=lambda item: item[0].count('/'))
+        if self.defaults:
+            scoped.insert(0, (self.root, DEFAULT_PATTERNS))
+        rules = []          # (regex, keep) in order of precedence, the last one wins
+        for dirpath, patterns in scoped:
+            prefix = re.escape(dirpath.rstrip('/') + '/')
+            for p in patterns:
+                if p.startswith('!'):
+                    rules.append((prefix + pattern_to_regex(p[1:]), True))
+                else:
+                    rules.append((prefix + pattern_to_regex(p.lstrip('\\')), False))
+        rules.reverse()
+        regex = re.compile('|'.join('(?P<r%d>%s$)' % (i, r) for i, (r, _) in enumerate(rules))) if rules else None
+        self._rules = (regex, [keep for _, keep in rules])
+
+    def is_ignored(self, path, is_dir=False):
+        regex, keep = self._rules
+        if regex is None:
+            return False
+        if is_dir:
+            path += '/'
+        m = regex.match(path)
+        return m is not None and not keep[int(m.lastgroup[1:])]
@@ -0,0 +1,115 @@
+import os
+import time
+import hashlib
+import threading
+from utils.file_util import crc32c_file_checksum
+from utils.path_util import customize_path
+
+DAY = 24 * 60 * 60
+
+
+class JobCache:
+    """
+    Outputs of the MR jobs by job fingerprint: the CRC32C of the mapper + reducer and the HDFS checksums of the
+    input in the catalog. A job with a known fingerprint is not run again, its previous output is renamed or copied
+    to the new output path instead.
+    The output of a job stays where the job wrote it while it is in /mrbox. When it is deleted from /mrbox it is
+    parked in the cache dir on HDFS instead of being removed, and renamed back into /mrbox on the next hit.
+    Entries older than max_age and parked outputs over max_bytes in total are evicted, least recently used first.
+    """
+    def __init__(self, hadoop, lc, cache_dir, max_age_days=30, max_bytes=10 * 1024 ** 3):
+        """
+        :param hadoop: HadoopInterface
+        :param lc: LocalCatalog
+        :param cache_dir: dir on HDFS of the parked outputs, outside the remote /mrbox folder
+        :param max_age_days: days after its last use that an output is evicted
+        :param max_bytes: max size in bytes of the parked outputs
+        """
+        self.hadoop = hadoop
+        self.lc = lc
+        self.cacheDir = cache_dir
+        self.maxAge = max_age_days * DAY
+        self.maxBytes = max_bytes
+        self._lock = threading.Lock()
+        self.hadoop.mkdir(self.cacheDir)
+
+    def fingerprint(self, mapper_path, reducer_path, local_input_path):
+        """ :return: the fingerprint of a job, None if the input is not synced to HDFS yet """
+        inputs = self.lc.get_subtree_checksums(local_input_path)
+        if not inputs or any(chk is None and os.path.isfile(lp) for lp, chk in inputs):
+            return None
+        h = hashlib.sha1()
+        h.update(('mapper:%s\nreducer:%s\n' % (crc32c_file_checksum(mapper_path, 'file'),
+                                               crc32c_file_checksum(reducer_path, 'file'))).encode())
+        for lp, chk in inputs:
+            h.update(('%s:%s\n' % (os.path.relpath(lp, local_input_path), chk)).encode())
+        return h.hexdigest()
+
+    def lookup(self, fingerprint):
+        """ :return: dict of the cached output of a fingerprint, None if not cached or no longer on HDFS """
+        if fingerprint is None:
+            return None
+        entry = self.lc.get_cached_job(fingerprint)
+        if entry is None:
+            return None
+        if not self.hadoop.exists(customize_path(entry['hdfs_output'], '_SUCCESS')) \
+                or self.hadoop.du(entry['hdfs_output']) != entry['bytes']:
+            self.lc.delete_cached_job(fingerprint)      # removed / changed on HDFS meanwhile
+            return None
+        return entry
+
+    def materialize(self, entry, hdfs_output):
+        """ Makes the cached output of a job available at hdfs_output, by rename if parked else by copy """
+        with self._lock:
+            if entry['hdfs_output'] != hdfs_output:
+                if entry['parked']:
+                    print("Job cache hit, renaming " + entry['hdfs_output'])
+                    self.hadoop.mv(entry['hdfs_output'], hdfs_output)
+                    entry = dict(entry, hdfs_output=hdfs_output, parked=0)
+                else:
+                    print("Job cache hit, copying " + entry['hdfs_output'])
+                    self.hadoop.copy_tree(entry['hdfs_output'], hdfs_output)
+            self.lc.set_cached_job(dict(entry, last_used=int(time.time())))
+
+    def record(self, fingerprint, hdfs_output):
+        """ Caches the output of a job that completed """
+        if fingerprint is None:
+            return
+        now = int(time.time())
+        self.lc.set_cached_job({'fingerprint': fingerprint, 'hdfs_output': hdfs_output, 'parked': 0,
+                                'bytes': self.hadoop.du(hdfs_output), 'created': now, 'last_used': now})
+        self.evict()
+
+    def park(self, hdfs_path):
+        """
+        Called instead of removing a path from HDFS
+        :return: True if hdfs_path is a cached output that was moved into the cache dir, so it must not be removed
+        """
+        with self._lock:
+            entries = self.lc.get_cached_jobs('WHERE hdfs_output=? AND parked=0', [hdfs_path])
+            if not entries:
+                return False
+            entry = entries[0]
+            parked_path = customize_path(self.cacheDir, entry['fingerprint'])
+            self.hadoop.mv(hdfs_path, parked_path)
+            self.lc.set_cached_job(dict(entry, hdfs_output=parked_path, parked=1))
+            for other in entries[1:]:
+                self.lc.delete_cached_job(other['fingerprint'])
+        self.evict()
+        return True
+
+    def evict(self):
+        """ Drops the entries not used for max_age and the least recently used parked outputs over max_bytes """
+        with self._lock:
+            now = int(time.time())
+            entries = self.lc.get_cached_jobs()
+            parked_bytes = sum(e['bytes'] or 0 for e in entries if e['parked'])
+            for e in entries:
+                expired = now - e['last_used'] > self.maxAge
+                if not expired and not (e['parked'] and parked_bytes > self.maxBytes):
+                    continue
+                if e['parked']:
+                    self.hadoop.rm(e['hdfs_output'])
+                    parked_bytes -= e['bytes'] or 0
+                self.lc.delete_cached_job(e['fingerprint'])
+                print("Evicted job output " + e['fingerprint'])
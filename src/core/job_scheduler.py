@@ -0,0 +1,309 @@
+import os
+import time
+import threading
+import subprocess
+import yaml
+from concurrent.futures import ThreadPoolExecutor
+from core.mrbox_object import MRBoxObject
+from utils.path_util import customize_path
+
+STATUS_EXT = '.status'      # written next to the .yaml of a job, never synced to HDFS
+
+QUEUED = 'queued'
+RUNNING = 'running'
+FETCHING = 'fetching'
+DONE = 'done'
+FAILED = 'failed'
+
+
+def status_path(yaml_path):
+    return yaml_path + STATUS_EXT
+
+
+def is_status_file(path):
+    return path.endswith(STATUS_EXT)
+
+
+def stage_status_path(yaml_path, stage):
+    return yaml_path + '.' + stage + STATUS_EXT
+
+
+def process_running(pid, cmd):
+    """ :return: True if the process of a job started by an earlier run of mrbox still runs the command of the job """
+    if not pid:
+        return False
+    if os.path.isdir('/proc'):
+        try:
+            with open('/proc/%d/cmdline' % pid, 'rb') as f:
+                return cmd.encode() in f.read().replace(b'\0', b' ')     # else the pid was reused
+        except OSError:
+            return False
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+class Job:
+    def __init__(self, row, local_file_limit):
+        """
+        :param row: dict of the job tuple in the catalog
+        """
+        self.id = row['id']
+        self.yamlPath = row['yaml']
+        self.cmd = row['cmd']
+        self.stage = row['stage']
+        self.depends = [int(i) for i in row['depends'].split(',')] if row['depends'] else []
+        self.hdfsOutput = row['hdfs_output']
+        # None for an intermediate stage of a pipeline, its output is not fetched
+        self.outputDir = None
+        if row['local_output'] is not None:
+            self.outputDir = MRBoxObject(row['local_output'], local_file_limit, row['hdfs_output'],
+                                         remote_file_type='dir')
+        self.state = row['state']
+        self.times = {'submitted': row['submitted'], 'started': row['started'], 'finished': row['finished']}
+        self.returncode = row['returncode']
+        self.error = row['error']
+        self.fingerprint = row['fingerprint']
+        self.pid = row.get('pid')
+        self.cached = None      # the entry of the job cache that the output is taken from
+        self.proc = None
+        self.log = None
+
+
+class JobScheduler(threading.Thread):
+    """
+    Runs the MR jobs issued by .yaml files outside of the event handling, so that the sync of /mrbox keeps flowing.
+    Jobs are queued in the catalog and run up to max_jobs at a time, each as a `hadoop jar` process that is polled
+    by the scheduler thread. Once a job succeeds its output dir is fetched locally on a pool of max_jobs workers.
+    The state of every job is written in a <name>.yaml.status file next to its .yaml.
+    Jobs that were queued when mrbox stopped are run at start-up. The `hadoop jar` process of a job runs in its own
+    session, so that it outlives mrbox: a job that was running is re-attached if its process still runs, and is
+    done once its output is complete on HDFS, else it is fetched if its output is complete, else it failed.
+    A job whose fingerprint is in the job cache is not run, the cached output is used instead.
+    The stages of a pipeline are jobs that depend on the jobs whose output they read: a stage is started once these
+    are done and fails if one of them failed, stages that do not depend on each other run concurrently.
+    """
+    def __init__(self, hadoop, lc, local_file_limit, log_dir, max_jobs=2, poll_interval=1.0, cache=None):
+        """
+        :param hadoop: HadoopInterface
+        :param lc: LocalCatalog
+        :param local_file_limit: local size limit in bytes of the fetched outputs
+        :param log_dir: local dir of the stdout + stderr of the jobs, outside the /mrbox folder
+        :param max_jobs: number of jobs running concurrently on the cluster
+        :param poll_interval: secs between two checks of the running jobs
+        :param cache: JobCache of the outputs of completed jobs, optional
+        """
+        super().__init__(name='job-scheduler', daemon=True)
+        self.hadoop = hadoop
+        self.lc = lc
+        self.localFileLimit = local_file_limit
+        self.logDir = log_dir
+        self.maxJobs = max_jobs
+        self.pollInterval = poll_interval
+        self.cache = cache
+        self._cond = threading.Condition()
+        self._queued = []
+        self._running = []
+        self._stopping = False
+        self.fetchers = ThreadPoolExecutor(max_workers=max_jobs, thread_name_prefix='job-fetch')
+        os.makedirs(self.logDir, exist_ok=True)
+        self.recover()
+
+    def recover(self):
+        for row in self.lc.get_jobs([QUEUED, RUNNING, FETCHING]):
+            job = Job(row, self.localFileLimit)
+            if job.state == QUEUED:
+                self._queued.append(job)
+            elif job.state == RUNNING and process_running(job.pid, job.cmd):
+                print("Job %d still running, re-attached" % job.id)
+                self._running.append(job)
+            elif self.succeeded(job):
+                if job.outputDir is None or os.path.exists(job.outputDir.localPath):
+                    self._finish(job, DONE)     # fetched, the reconciliation syncs what is missing
+                else:
+                    print("Job %d completed while mrbox was down" % job.id)
+                    self._fetch(job)
+            else:
+                self._finish(job, FAILED, error="interrupted, its process stopped without a complete output")
+
+    def succeeded(self, job):
+        return self.hadoop.exists(customize_path(job.hdfsOutput, '_SUCCESS'))
+
+    def submit(self, yaml_path, cmd, output_dir, fingerprint=None, stage=None, depends=(), hdfs_output=None):
+        """
+        Queues a job
+        :param yaml_path: the .yaml that issued the job
+        :param cmd: the bash command that runs the job
+        :param output_dir: MRBoxObject of the output dir of the job, fetched locally on completion,
+        None for an intermediate stage of a pipeline
+        :param fingerprint: the fingerprint of the job in the job cache, None to always run it
+        :param stage: the name of the stage in a pipeline
+        :param depends: ids of the jobs that must be done before the job is started
+        :param hdfs_output: the output dir on HDFS of an intermediate stage
+        :return: the id of the job
+        """
+        row = {'yaml': yaml_path, 'state': QUEUED, 'cmd': cmd,
+               'local_output': output_dir.localPath if output_dir is not None else None,
+               'hdfs_output': output_dir.remotePath if output_dir is not None else hdfs_output,
+               'submitted': int(time.time()), 'started': None, 'finished': None, 'returncode': None, 'error': None,
+               'fingerprint': fingerprint, 'stage': stage, 'depends': ','.join(str(i) for i in depends) or None}
+        row['id'] = self.lc.insert_job(dict(row))
+        job = Job(row, self.localFileLimit)
+        self.write_status(job)
+        with self._cond:
+            self._queued.append(job)
+            self._cond.notify_all()
+        print("Job %d queued: %s%s" % (job.id, yaml_path, " stage " + stage if stage else ""))
+        return job.id
+
+    def run(self):
+        while True:
+            with self._cond:
+                if self._stopping:
+                    return
+                starting = []
+                while len(self._running) + len(starting) < self.maxJobs:
+                    job = self._next_runnable()
+                    if job is None:
+                        break
+                    starting.append(job)
+                running = list(self._running)
+            # the cache lookup + launch call HDFS, out of the lock so that submit() + stop() are not held up
+            for job in starting:
+                self._start(job)
+            finished = [job for job in running if self._exited(job)]
+            with self._cond:
+                for job in finished:
+                    self._running.remove(job)
+            for job in finished:
+                if job.log is not None:
+                    job.log.close()
+                if job.returncode == 0:
+                    self._fetch(job)
+                elif job.proc is None:
+                    self._finish(job, FAILED, error="its process stopped without a complete output, see %s"
+                                                    % self.log_path(job))
+                else:
+                    self._finish(job, FAILED, error="exit code %d, see %s" % (job.returncode, self.log_path(job)))
+            with self._cond:
+                if not finished:
+                    self._cond.wait(self.pollInterval)
+
+    def _next_runnable(self):
+        """ :return: the first queued job whose dependencies are done, the jobs of failed dependencies fail """
+        for job in list(self._queued):
+            states = self.lc.get_job_states(job.depends) if job.depends else {}
+            failed = [i for i in job.depends if states.get(i) in (FAILED, None)]
+            if failed:
+                self._queued.remove(job)
+                self._finish(job, FAILED, error="job %d of its input failed" % failed[0])
+            elif all(states[i] == DONE for i in job.depends):
+                self._queued.remove(job)
+                return job
+        return None
+
+    def _exited(self, job):
+        """
+        Sets the return code of a job whose process exited. A job re-attached after a restart is not a child
+        process of mrbox, its return code is 0 if its output is complete on HDFS
+        :return: True if the process of the job exited
+        """
+        if job.proc is not None:
+            job.returncode = job.proc.poll()
+        elif not process_running(job.pid, job.cmd):
+            job.returncode = 0 if self.succeeded(job) else 1
+        return job.returncode is not None
+
+    def log_path(self, job):
+        return os.path.join(self.logDir, 'job-%d.log' % job.id)
+
+    def _start(self, job):
+        if self.cache is not None:
+            job.cached = self.cache.lookup(job.fingerprint)
+            if job.cached is not None:
+                print("Job %d found in the job cache" % job.id)
+                job.returncode = 0
+                self._fetch(job)
+                return
+        print("Job %d started" % job.id)
+        if job.outputDir is None and self.hadoop.exists(job.hdfsOutput):
+            self.hadoop.rm(job.hdfsOutput)      # left by a previous run of the pipeline
+        job.log = open(self.log_path(job), 'wb')
+        try:
+            job.proc = subprocess.Popen(job.cmd, shell=True, stdout=job.log, stderr=subprocess.STDOUT,
+                                        start_new_session=True)
+        except OSError as e:
+            job.log.close()
+            self._finish(job, FAILED, error=repr(e))
+            return
+        job.times['started'] = int(time.time())
+        job.pid = job.proc.pid
+        self._set_state(job, RUNNING, {'started': job.times['started'], 'pid': job.pid})
+        with self._cond:
+            self._running.append(job)
+
+    def _fetch(self, job):
+        self._set_state(job, FETCHING, {'returncode': job.returncode})
+        self.fetchers.submit(self._fetch_output, job)
+
+    def _fetch_output(self, job):
+        try:
+            if job.cached is not None:
+                self.cache.materialize(job.cached, job.hdfsOutput)
+            if job.outputDir is not None and not os.path.exists(job.outputDir.localPath):
+                self.hadoop.sync_remote_dir(self.lc, job.outputDir)
+        except Exception as e:
+            self._finish(job, FAILED, error="output fetch failed: " + repr(e))
+            return
+        if self.cache is not None and job.cached is None:
+            try:
+                self.cache.record(job.fingerprint, job.hdfsOutput)
+            except Exception as e:
+                print("Output of job %d not cached: %s" % (job.id, repr(e)))
+        self._finish(job, DONE)
+
+    def _finish(self, job, state, error=None):
+        job.times['finished'] = int(time.time())
+        job.error = error
+        print("Job %d %s%s" % (job.id, state, ": " + error if error else ""))
+        self._set_state(job, state, {'finished': job.times['finished'], 'returncode': job.returncode,
+                                     'error': error})
+        with self._cond:
+            self._cond.notify_all()     # the jobs that depend on it can be started
+
+    def _set_state(self, job, state, dic):
+        job.state = state
+        self.lc.update_job(job.id, dict(dic, state=state))
+        self.write_status(job)
+
+    def write_status(self, job):
+        """ Writes the state of a job next to its .yaml, one per stage of a pipeline, skipped by the event handler """
+        status = {'job': job.id, 'state': job.state,
+                  'output': job.outputDir.localPath if job.outputDir is not None else job.hdfsOutput}
+        for k, t in job.times.items():
+            if t is not None:
+                status[k] = time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(t))
+        if job.returncode is not None:
+            status['returncode'] = job.returncode
+        if job.cached is not None:
+            status['cached'] = True
+        if job.error:
+            status['error'] = job.error
+        try:
+            path = stage_status_path(job.yamlPath, job.stage) if job.stage else status_path(job.yamlPath)
+            with open(path, 'w') as f:
+                yaml.safe_dump(status, f, default_flow_style=False, sort_keys=False)
+        except OSError as e:
+            print("Status of job %d not written: %s" % (job.id, repr(e)))
+
+    def stop(self):
+        """ Stops scheduling, the running jobs keep running and are re-attached at the next start-up """
+        with self._cond:
+            self._stopping = True
+            self._cond.notify_all()
+        self.join()
+        self.fetchers.shutdown(wait=True)
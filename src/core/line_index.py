@@ -0,0 +1,140 @@
+import bisect
+import queue
+import threading
+from array import array
+
+STEP = 1024 * 1024      # bytes read per call, also the granularity of the index
+
+
+class LineIndex:
+    """
+    Sparse line number -> byte offset index of a remote file: the start of one line per STEP bytes of the file.
+    A line is found by a lookup in the index and a forward scan of at most STEP bytes.
+    """
+    def __init__(self, size, lines, line_nos, offsets):
+        """
+        :param size: size of the file in bytes
+        :param lines: number of lines of the file, counting an unterminated last line
+        :param line_nos: array of 0-based line numbers, starting with line 0
+        :param offsets: array of the byte offsets that these lines start at
+        """
+        self.size = size
+        self.lines = lines
+        self.lineNos = line_nos
+        self.offsets = offsets
+
+    @classmethod
+    def from_row(cls, row):
+        """ :param row: dict as returned by LocalCatalog.get_line_index() """
+        line_nos, offsets = array('Q'), array('Q')
+        line_nos.frombytes(row['line_nos'])
+        offsets.frombytes(row['offsets'])
+        return cls(row['size'], row['lines'], line_nos, offsets)
+
+    def offset_of(self, line, read):
+        """
+        :param line: 0-based line number
+        :param read: callable (offset, length) -> bytes of the file
+        :return: the byte offset that the line starts at, the size of the file past the last line
+        """
+        if line >= self.lines:
+            return self.size
+        i = bisect.bisect_right(self.lineNos, line) - 1
+        cur, pos = self.lineNos[i], self.offsets[i]
+        while cur < line:
+            buf = read(pos, STEP)
+            if not buf:
+                return self.size
+            n = buf.count(b'\n')
+            if cur + n < line:
+                cur += n
+                pos += len(buf)
+                continue
+            idx = -1
+            while cur < line:
+                idx = buf.index(b'\n', idx + 1)
+                cur += 1
+            pos += idx + 1
+        return pos
+
+    def line_range(self, first, count, read):
+        """ :return: (start, end) byte offsets of count lines from the 0-based line first """
+        return self.offset_of(first, read), self.offset_of(first + count, read)
+
+
+class LineIndexer(threading.Thread):
+    """
+    Streams large remote files once in the background and stores their line index in the catalog,
+    so that mrview can jump to a line, count the lines or tail a .link file without scanning it.
+    """
+    def __init__(self, hdfs_con, lc):
+        """
+        :param hdfs_con: from hdfs3
+        :param lc: LocalCatalog
+        """
+        super().__init__(name='line-indexer', daemon=True)
+        self.hdfsCon = hdfs_con
+        self.lc = lc
+        self._queue = queue.Queue()
+        self._lock = threading.Lock()
+
+    def submit(self, hdfs_path):
+        """ Indexes a remote file in the background """
+        self._queue.put(hdfs_path)
+
+    def run(self):
+        while True:
+            hdfs_path = self._queue.get()
+            if hdfs_path is None:
+                return
+            try:
+                self.get(hdfs_path)
+            except Exception as e:
+                print("Line indexing of " + hdfs_path + " failed: " + repr(e))
+
+    def stop(self):
+        self._queue.put(None)
+
+    def get(self, hdfs_path):
+        """ :return: the LineIndex of the current version of a remote file, indexed now if missing or stale """
+        hdfs_chk = self.lc.get_val_by_rem_path(self.lc.CHK_HDFS, hdfs_path)
+        with self._lock:    # a file is indexed once, even if requested while indexed in the background
+            row = self.lc.get_line_index(hdfs_path)
+            if row is None or row[self.lc.CHK_HDFS] != hdfs_chk:
+                row = self.index(hdfs_path, hdfs_chk)
+        return LineIndex.from_row(row)
+
+    def line_range(self, hdfs_path, first, count, read):
+        """
+        :param first: 0-based line number, None for the last count lines
+        :param read: callable (offset, length) -> bytes of the file
+        :return: dict of the lines + size of the file and the offset + length in bytes of the requested lines
+        """
+        index = self.get(hdfs_path)
+        if first is None:
+            first = max(index.lines - count, 0)
+        start, end = index.line_range(first, count, read)
+        return {'lines': index.lines, 'size': index.size, 'offset': start, 'length': end - start}
+
+    def index(self, hdfs_path, hdfs_chk):
+        print("Indexing lines of " + hdfs_path)
+        size = lines = 0
+        line_nos, offsets = array('Q', [0]), array('Q', [0])
+        last = b'\n'
+        with self.hdfsCon.open(hdfs_path, 'rb', buff=STEP) as f:
+            while True:
+                buf = f.read(STEP)
+                if not buf:
+                    break
+                lines += buf.count(b'\n')
+                nl = buf.rfind(b'\n')
+                if nl != -1 and lines > line_nos[-1]:
+                    line_nos.append(lines)              # the line after the last newline of the block
+                    offsets.append(size + nl + 1)
+                size += len(buf)
+                last = buf[-1:]
+        if last != b'\n':
+            lines += 1      # unterminated last line
+        self.lc.set_line_index(hdfs_path, hdfs_chk, size, lines, line_nos.tobytes(), offsets.tobytes())
+        return {self.lc.CHK_HDFS: hdfs_chk, 'size': size, 'lines': lines,
+                'line_nos': line_nos.tobytes(), 'offsets': offsets.tobytes()}
@@ -1,89 +1,546 @@
 import sqlite3
+import threading
+import calendar
+import time
+from collections import OrderedDict
 from sqlite3 import Error
-from utils.db_util import insert_substr, update_substr, asstr
+from utils.db_util import insert_substr, update_substr, epoch_now
 
 # todo: handle query failures
 # todo: might need to specify which HDFS in case multiple
 
 
+def split_path(path):
+    return [p for p in path.split('/') if p]
+
+
+class RowCache:
+    """
+    Size-bounded LRU cache of catalog tuples, keyed by (column, path) for both the local and the remote path
+    of a tuple. A path known not to be in the catalog is cached as None.
+    Every write bumps the generation, so that a tuple read from the db before a concurrent write is not cached.
+    """
+    MISSING = object()
+
+    def __init__(self, key_cols, max_rows=10000):
+        """
+        :param key_cols: the path columns of a tuple that it is looked up by
+        :param max_rows: max number of cached keys, 0 to disable the cache
+        """
+        self.keyCols = key_cols
+        self.maxRows = max_rows
+        self._rows = OrderedDict()      # (col, path) -> dict of the tuple or None
+        self._lock = threading.Lock()
+        self.generation = 0
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        """ :return: the cached tuple, None if cached as missing, MISSING if not cached """
+        with self._lock:
+            row = self._rows.get(key, self.MISSING)
+            if row is self.MISSING:
+                self.misses += 1
+            else:
+                self._rows.move_to_end(key)
+                self.hits += 1
+            return row
+
+    def put(self, key, row, generation):
+        """ Caches a tuple read from the db under all of its paths, or a missing one under key """
+        keys = [key] if row is None else [(col, row[col]) for col in self.keyCols if row[col] is not None]
+        with self._lock:
+            if generation != self.generation or self.maxRows <= 0:
+                return
+            for key in keys:
+                self._rows[key] = row
+                self._rows.move_to_end(key)
+            while len(self._rows) > self.maxRows:
+                self._drop(self._rows.popitem(last=False)[1])     # a tuple is cached under all of its paths or none
+
+    def invalidate(self, col, path):
+        """ Drops the tuple cached under (col, path), under both of its paths """
+        with self._lock:
+            self.generation += 1
+            self._drop(self._rows.pop((col, path), None))
+
+    def invalidate_subtree(self, *paths):
+        """ Drops the tuples at or under the given paths, locally or on hdfs """
+        prefixes = tuple(p.rstrip('/') + '/' for p in paths if p is not None)
+        exact = set(p for p in paths if p is not None)
+        with self._lock:
+            self.generation += 1
+            for key in [k for k in self._rows if k[1] in exact or k[1].startswith(prefixes)]:
+                self._drop(self._rows.pop(key, None))
+
+    def _drop(self, row):
+        if row is not None:
+            for col in self.keyCols:
+                self._rows.pop((col, row[col]), None)
+
+    def clear(self):
+        with self._lock:
+            self.generation += 1
+            self._rows = OrderedDict()
+
+    def stats(self):
+        with self._lock:
+            return {'rows': len(self._rows), 'hits': self.hits, 'misses': self.misses}
+
+
 class LocalCatalog:
+    SCHEMA_VERSION = 11
     TABLE_NAME = 'mrbox_files'
+    PATHS_TABLE = 'mrbox_paths'     # interned path components: every path is a chain of (parent id, name) nodes
+    ROOT = 0                        # id of the '/' node, not stored
+    LINE_INDEX_TABLE = 'mrbox_line_index'   # sparse line number -> byte offset index of remote files
+    JOBS_TABLE = 'mrbox_jobs'               # MR jobs issued by .yaml files, see core.job_scheduler
+    JOB_CACHE_TABLE = 'mrbox_job_cache'     # outputs of MR jobs by job fingerprint, see core.job_cache
+    CONTAINERS_TABLE = 'mrbox_containers'   # container files of packed small files on HDFS, see core.packing
+    PACKED_TABLE = 'mrbox_packed'           # (container, offset, length) of the packed files by remote path
+    REMOTE_DIRS_TABLE = 'mrbox_remote_dirs'  # mtime + listing fingerprint of the polled remote dirs, see core.poller
 
     # Column names: #####################################
 
     ID = 'id'
-    LOC = 'local'                   # local path of file/folder
-    HDFS = 'hdfs'                   # hdfs path of file/folder
-    TIME_LOC = 'time_local'         # time of latest modification locally
-    TIME_HDFS = 'time_hdfs'         # time of latest modification on hdfs
-    CHK_LOC = 'chk_local'           # CRC32C checksum of local file copy
-    CHK_HDFS = 'chk_hdfs'           # CRC32C checksum of HDFS file copy
+    LOC = 'local'                   # path node of the local file/folder
+    HDFS = 'hdfs'                   # path node of the hdfs file/folder
+    TIME_LOC = 'time_local'         # time of latest modification locally, epoch secs
+    TIME_HDFS = 'time_hdfs'         # time of latest modification on hdfs, epoch secs
+    CHK_LOC = 'chk_local'           # CRC32C checksum of local file copy, as an integer
+    CHK_HDFS = 'chk_hdfs'           # CRC32C checksum of HDFS file copy, as an integer
     TYPE_LOC = 'type_loc'           # the type of the local file copy: 'file', 'link', 'dir'
+    SIZE_LOC = 'size_local'         # size in bytes of the local file copy that chk_local was computed on
+    MTIME_LOC = 'mtime_local'       # mtime in ns of the local file copy that chk_local was computed on
+    SIZE_HDFS = 'size_hdfs'         # size in bytes of the HDFS file copy that chk_hdfs was computed on
+    MTIME_HDFS = 'mtime_hdfs'       # mtime on the namenode of the HDFS file copy that chk_hdfs was computed on
+
+    PATH_COLS = (LOC, HDFS)
+    ROW_COLS = (LOC, HDFS, TIME_LOC, TIME_HDFS, CHK_LOC, CHK_HDFS, TYPE_LOC, SIZE_LOC, MTIME_LOC, SIZE_HDFS,
+                MTIME_HDFS)
+    CHK_COLS = (CHK_LOC, CHK_HDFS)
+
+    # Connection settings: ##############################
+
+    BUSY_TIMEOUT_S = 30             # wait for the writer lock instead of failing with 'database is locked'
+    CACHED_STATEMENTS = 256         # prepared statements kept per connection
+    PRAGMAS = ['PRAGMA journal_mode=WAL',       # readers do not block the writer and vice versa
+               'PRAGMA synchronous=NORMAL',     # fsync on checkpoint only, safe in WAL mode
+               'PRAGMA temp_store=MEMORY',
+               'PRAGMA cache_size=-16000',      # 16MB page cache per connection
+               'PRAGMA mmap_size=268435456']    # 256MB memory mapped reads
 
     #################################################################
 
-    def __init__(self, full_db_path):
+    def __init__(self, full_db_path, flush_rows=500, flush_interval=1.0, cache_rows=10000):
+        """
+        :param full_db_path: path of the sqlite db file
+        :param flush_rows: number of buffered inserts / updates that triggers a flush to the db
+        :param flush_interval: max seconds that an insert / update stays buffered, 0 to write through
+        :param cache_rows: max number of paths whose tuples are kept in memory, 0 to disable the cache
+        """
         self.db_path = full_db_path
+        self._local = threading.local()     # one long-lived connection per thread
+        self._conns = []                    # all the opened connections, to close them on shutdown
+        self._conns_lock = threading.Lock()
+
+        # write-behind buffer, guarded by _lock which is also held while a flush is committed
+        self.flushRows = flush_rows
+        self.flushInterval = flush_interval
+        self._lock = threading.RLock()
+        self._pending_inserts = OrderedDict()   # local path -> dict of the row to insert
+        self._pending_updates = OrderedDict()   # local path -> dict of the columns to update
+        self._pending_remote = {}               # remote path -> local path of the pending inserts
+        self._closed = threading.Event()
+        self._flusher = None
+
+        # ids of the dir nodes already resolved, so that resolving a path costs a single query for its last component
+        self._dir_ids = {}                      # 'a/b/c' -> node id
+        self._dir_ids_gen = 0                   # bumped by every invalidation, see _dir_id()
+        self._dir_ids_lock = threading.Lock()
+
+        # tuples read by path, invalidated by every insert / update / move / delete
+        self.rowCache = RowCache(self.PATH_COLS, cache_rows)
+
         print('DB created successfully')
-        if not self.check_table_exists():
-            self.create_table()
-        else:
-            print('Table already exists')
+        self.init_schema()
+        if self.flushInterval > 0:
+            self._flusher = threading.Thread(target=self._flush_periodically, name='catalog-flusher', daemon=True)
+            self._flusher.start()
 
     def create_connection(self):
-        """ creates a db connection to the SQLite db of the local catalogue
+        """ returns the db connection of the calling thread to the SQLite db of the local catalogue,
+        the connection is created on first use and reused afterwards
         :return: Connection object or raises exception"""
-        try:
-            conn = sqlite3.connect(self.db_path)
+        conn = getattr(self._local, 'conn', None)
+        if conn is not None:
             return conn
+        try:
+            conn = sqlite3.connect(self.db_path, timeout=self.BUSY_TIMEOUT_S, check_same_thread=False,
+                                   cached_statements=self.CACHED_STATEMENTS)
+            for pragma in self.PRAGMAS:
+                conn.execute(pragma)
         except Error as e:
             print(e)
             raise e
+        self._local.conn = conn
+        with self._conns_lock:
+            self._conns.append(conn)
+        return conn
 
-    def check_table_exists(self):  # todo: check error
-        cmd = "SELECT name FROM sqlite_master WHERE type='table' AND name=%s" % asstr(self.TABLE_NAME)
+    def close(self):
+        """ Flushes the buffered writes and closes the connections of all threads, called on shutdown """
+        self._closed.set()
+        if self._flusher is not None:
+            self._flusher.join()
+        self.flush()
+        print('Catalog cache: ' + str(self.rowCache.stats()))
+        with self._conns_lock:
+            for conn in self._conns:
+                conn.close()
+            self._conns = []
+        self._local = threading.local()
+
+    # Schema: ###########################################
+
+    def check_table_exists(self, table_name=TABLE_NAME):  # todo: check error
+        cmd = "SELECT name FROM sqlite_master WHERE type='table' AND name=?"
         conn = self.create_connection()
-        c = conn.cursor()
-        ret = len(c.execute(cmd).fetchall()) > 0
-        conn.close()
-        return ret
+        return conn.execute(cmd, (table_name,)).fetchone() is not None
 
-    def create_table(self):  # todo: check error
-        cmd = 'CREATE TABLE IF NOT EXISTS %s (%s INTEGER PRIMARY KEY,' % (self.TABLE_NAME, self.ID)
-        cmd += '%s TEXT UNIQUE,' % self.LOC
-        cmd += '%s TEXT UNIQUE,' % self.HDFS
-        cmd += '%s DATETIME,' % self.TIME_LOC
-        cmd += '%s DATETIME,' % self.TIME_HDFS
-        cmd += '%s TEXT,' % self.CHK_LOC
-        cmd += '%s TEXT,' % self.CHK_HDFS
-        cmd += '%s TEXT)' % self.TYPE_LOC
+    def init_schema(self):
         conn = self.create_connection()
-        c = conn.cursor()
-        c.execute(cmd)
-        print('Table created successfully')
-        conn.close()
+        version = conn.execute('PRAGMA user_version').fetchone()[0]
+        if version >= self.SCHEMA_VERSION:
+            print('Table already exists')
+        elif version >= 2:
+            # tables added since v2
+            with conn:
+                conn.execute('BEGIN')
+                if version < 3:
+                    self.create_line_index_table(conn)
+                if version < 4:
+                    self.create_jobs_table(conn)
+                else:
+                    if version < 5:
+                        conn.execute('ALTER TABLE %s ADD COLUMN fingerprint TEXT' % self.JOBS_TABLE)
+                    if version < 6:
+                        conn.execute('ALTER TABLE %s ADD COLUMN stage TEXT' % self.JOBS_TABLE)
+                        conn.execute('ALTER TABLE %s ADD COLUMN depends TEXT' % self.JOBS_TABLE)
+                    if version < 10:
+                        conn.execute('ALTER TABLE %s ADD COLUMN pid INTEGER' % self.JOBS_TABLE)
+                if version < 11:
+                    conn.execute('ALTER TABLE %s ADD COLUMN %s INTEGER' % (self.TABLE_NAME, self.SIZE_HDFS))
+                    conn.execute('ALTER TABLE %s ADD COLUMN %s INTEGER' % (self.TABLE_NAME, self.MTIME_HDFS))
+                if version < 5:
+                    self.create_job_cache_table(conn)
+                if version < 7:
+                    self.create_packing_tables(conn)
+                if version < 8:
+                    self.create_content_index(conn)
+                if version < 9:
+                    self.create_remote_dirs_table(conn)
+                if version < 10:
+                    # the lookups by path read whole tuples, these indexes covered nothing + slowed every flush
+                    conn.execute('DROP INDEX IF EXISTS %s_local_cov' % self.TABLE_NAME)
+                    conn.execute('DROP INDEX IF EXISTS %s_hdfs_cov' % self.TABLE_NAME)
+                conn.execute('PRAGMA user_version=%d' % self.SCHEMA_VERSION)
+        elif self.check_table_exists():
+            self.migrate_v1()
+        else:
+            with conn:
+                conn.execute('BEGIN')
+                self.create_tables(conn)
+            print('Table created successfully')
+
+    def create_tables(self, conn):  # todo: check error
+        conn.execute('CREATE TABLE %s (id INTEGER PRIMARY KEY, parent INTEGER NOT NULL, name TEXT NOT NULL, '
+                     'UNIQUE (parent, name))' % self.PATHS_TABLE)
+        cmd = 'CREATE TABLE %s (%s INTEGER PRIMARY KEY,' % (self.TABLE_NAME, self.ID)
+        cmd += '%s INTEGER UNIQUE,' % self.LOC
+        cmd += '%s INTEGER UNIQUE,' % self.HDFS
+        cmd += '%s INTEGER,' % self.TIME_LOC
+        cmd += '%s INTEGER,' % self.TIME_HDFS
+        cmd += '%s INTEGER,' % self.CHK_LOC
+        cmd += '%s INTEGER,' % self.CHK_HDFS
+        cmd += '%s TEXT,' % self.TYPE_LOC
+        cmd += '%s INTEGER,' % self.SIZE_LOC
+        cmd += '%s INTEGER,' % self.MTIME_LOC
+        cmd += '%s INTEGER,' % self.SIZE_HDFS
+        cmd += '%s INTEGER)' % self.MTIME_HDFS
+        conn.execute(cmd)
+        # the lookups by path use the UNIQUE autoindexes of the local + remote path columns
+        self.create_content_index(conn)
+        self.create_line_index_table(conn)
+        self.create_jobs_table(conn)
+        self.create_job_cache_table(conn)
+        self.create_packing_tables(conn)
+        self.create_remote_dirs_table(conn)
+        conn.execute('PRAGMA user_version=%d' % self.SCHEMA_VERSION)
+
+    def create_line_index_table(self, conn):
+        # line_nos + offsets: packed arrays of unsigned 64-bit ints, see core.line_index
+        conn.execute('CREATE TABLE %s (%s INTEGER PRIMARY KEY, %s INTEGER, size INTEGER, lines INTEGER, '
+                     'line_nos BLOB, offsets BLOB)' % (self.LINE_INDEX_TABLE, self.HDFS, self.CHK_HDFS))
+
+    def create_jobs_table(self, conn):
+        # local_output: NULL for the intermediate stages of a pipeline, whose output is only kept on HDFS
+        # depends: comma separated ids of the jobs whose output is input of the job
+        # pid: of the `hadoop jar` process of a running job, re-attached after a restart
+        conn.execute('CREATE TABLE %s (id INTEGER PRIMARY KEY, yaml TEXT, state TEXT, cmd TEXT, local_output TEXT, '
+                     'hdfs_output TEXT, submitted INTEGER, started INTEGER, finished INTEGER, returncode INTEGER, '
+                     'error TEXT, fingerprint TEXT, stage TEXT, depends TEXT, pid INTEGER)' % self.JOBS_TABLE)
+
+    def create_job_cache_table(self, conn):
+        # hdfs_output: where the output is, its path in /mrbox or parked in the cache dir on HDFS once deleted there
+        conn.execute('CREATE TABLE %s (fingerprint TEXT PRIMARY KEY, hdfs_output TEXT, parked INTEGER, '
+                     'bytes INTEGER, created INTEGER, last_used INTEGER)' % self.JOB_CACHE_TABLE)
+
+    def create_content_index(self, conn):
+        # lookup of the files by content, see find_by_content()
+        conn.execute('CREATE INDEX %s_content ON %s (%s, %s)'
+                     % (self.TABLE_NAME, self.TABLE_NAME, self.SIZE_LOC, self.CHK_LOC))
+
+    def create_packing_tables(self, conn):
+        # container + hdfs: path node ids, size: bytes written to the container, gen: bumped by every compaction
+        conn.execute('CREATE TABLE %s (container INTEGER PRIMARY KEY, size INTEGER, gen INTEGER)'
+                     % self.CONTAINERS_TABLE)
+        # pad: 1 if a newline was appended after the file in its container, so that its last line stays its own
+        conn.execute('CREATE TABLE %s (%s INTEGER PRIMARY KEY, container INTEGER, offset INTEGER, length INTEGER, '
+                     'pad INTEGER)' % (self.PACKED_TABLE, self.HDFS))
+        conn.execute('CREATE INDEX idx_packed_container ON %s (container, offset)' % self.PACKED_TABLE)
+
+    def create_remote_dirs_table(self, conn):
+        conn.execute('CREATE TABLE %s (%s INTEGER PRIMARY KEY, mtime INTEGER, fingerprint TEXT)'
+                     % (self.REMOTE_DIRS_TABLE, self.HDFS))
+
+    def migrate_v1(self):
+        """
+        Migrates a catalog with full paths as TEXT, hex checksums and datetime strings to the current schema
+        """
+        print('Migrating catalog to schema v%d' % self.SCHEMA_VERSION)
+        conn = self.create_connection()
+        old_table = self.TABLE_NAME + '_v1'
+        with conn:
+            conn.execute('BEGIN')
+            conn.execute('ALTER TABLE %s RENAME TO %s' % (self.TABLE_NAME, old_table))
+            self.create_tables(conn)
+            old_cols = [row[1] for row in conn.execute('PRAGMA table_info(%s)' % old_table)]
+            cols = [c for c in [self.LOC, self.HDFS, self.TIME_LOC, self.TIME_HDFS, self.CHK_LOC, self.CHK_HDFS,
+                                self.TYPE_LOC, self.SIZE_LOC, self.MTIME_LOC] if c in old_cols]
+            rows = conn.execute('SELECT %s FROM %s' % (', '.join(cols), old_table)).fetchall()
+            for row in rows:
+                dic = dict(zip(cols, row))
+                for col in [self.TIME_LOC, self.TIME_HDFS]:
+                    dic[col] = self.datetime_to_epoch(dic[col])
+                dic = self._to_db(conn, dic)
+                conn.execute("INSERT OR IGNORE INTO %s %s" % (self.TABLE_NAME, insert_substr(list(dic))),
+                             list(dic.values()))
+            conn.execute('DROP TABLE %s' % old_table)
+        conn.execute('VACUUM')
+        print('Migrated %d tuples' % len(rows))
+
+    @staticmethod
+    def datetime_to_epoch(dt):
+        """ '2020-11-05 10:00:00' (UTC, as written by sqlite's datetime("now")) -> epoch secs """
+        if dt is None:
+            return None
+        try:
+            return calendar.timegm(time.strptime(dt, '%Y-%m-%d %H:%M:%S'))
+        except (TypeError, ValueError):
+            return None
+
+    # Path nodes: #######################################
+
+    def _child_id(self, conn, parent, name, create):
+        row = conn.execute('SELECT id FROM %s WHERE parent=? AND name=?' % self.PATHS_TABLE, (parent, name)).fetchone()
+        if row is not None:
+            return row[0]
+        if not create:
+            return None
+        return conn.execute('INSERT INTO %s (parent, name) VALUES (?, ?)' % self.PATHS_TABLE, (parent, name)).lastrowid
+
+    def _dir_id(self, conn, parts, create):
+        key = '/'.join(parts)
+        with self._dir_ids_lock:
+            node = self._dir_ids.get(key)
+            gen = self._dir_ids_gen
+        if node is not None:
+            return node
+        node = self.ROOT
+        for name in parts:
+            node = self._child_id(conn, node, name, create)
+            if node is None:
+                return None
+        with self._dir_ids_lock:
+            # not cached if a move / delete invalidated the dir ids meanwhile
+            if gen == self._dir_ids_gen:
+                self._dir_ids[key] = node
+        return node
+
+    def _node_id(self, conn, path, create=False):
+        """
+        :param create: if True, the missing nodes of the path are inserted
+        :return: the id of the node of a path, None if it does not exist
+        """
+        if path is None:
+            return None
+        parts = split_path(path)
+        if not parts:
+            return self.ROOT
+        parent = self._dir_id(conn, parts[:-1], create)
+        if parent is None:
+            return None
+        return self._child_id(conn, parent, parts[-1], create)
+
+    def _path_of(self, conn, node):
+        """ :return: the path of a node, built from its ancestors """
+        if node is None:
+            return None
+        cmd = 'WITH RECURSIVE anc(id, parent, name, depth) AS (' \
+              'SELECT id, parent, name, 0 FROM {0} WHERE id=? UNION ALL ' \
+              'SELECT p.id, p.parent, p.name, anc.depth + 1 FROM {0} p JOIN anc ON p.id=anc.parent) ' \
+              'SELECT name FROM anc ORDER BY depth DESC'.format(self.PATHS_TABLE)
+        return '/' + '/'.join(row[0] for row in conn.execute(cmd, (node,)))
+
+    def _invalidate_dir_ids(self, *paths):
+        """ Drops the cached dir ids of the given paths and of everything under them """
+        prefixes = ['/'.join(split_path(p)) for p in paths if p is not None]
+        with self._dir_ids_lock:
+            self._dir_ids_gen += 1
+            for key in [k for k in self._dir_ids if any(k == p or k.startswith(p + '/') for p in prefixes)]:
+                del self._dir_ids[key]
+
+    def _clear_dir_ids(self):
+        with self._dir_ids_lock:
+            self._dir_ids_gen += 1
+            self._dir_ids = {}
+
+    def _subtree_cte(self, with_paths=False):
+        """ Recursive CTE 'sub' of the ids (and paths) of a node and all the nodes under it,
+        takes the id (and path) of the node as params """
+        if with_paths:
+            return 'WITH RECURSIVE sub(id, path) AS (VALUES(?, ?) UNION ALL ' \
+                   "SELECT p.id, sub.path || '/' || p.name FROM %s p JOIN sub ON p.parent=sub.id) " % self.PATHS_TABLE
+        return 'WITH RECURSIVE sub(id) AS (VALUES(?) UNION ALL ' \
+               'SELECT p.id FROM %s p JOIN sub ON p.parent=sub.id) ' % self.PATHS_TABLE
+
+    def _delete_nodes(self, conn, node):
+        """ Deletes a node, all the nodes under it and the tuples of all of them """
+        for col in self.PATH_COLS:
+            conn.execute(self._subtree_cte() + 'DELETE FROM %s WHERE %s IN sub' % (self.TABLE_NAME, col), (node,))
+        conn.execute(self._subtree_cte() + 'DELETE FROM %s WHERE %s IN sub' % (self.LINE_INDEX_TABLE, self.HDFS),
+                     (node,))
+        conn.execute(self._subtree_cte() + 'DELETE FROM %s WHERE %s IN sub' % (self.PACKED_TABLE, self.HDFS), (node,))
+        conn.execute(self._subtree_cte() + 'DELETE FROM %s WHERE container IN sub' % self.CONTAINERS_TABLE, (node,))
+        conn.execute(self._subtree_cte() + 'DELETE FROM %s WHERE %s IN sub' % (self.REMOTE_DIRS_TABLE, self.HDFS),
+                     (node,))
+        conn.execute(self._subtree_cte() + 'DELETE FROM %s WHERE id IN sub' % self.PATHS_TABLE, (node,))
+
+    # Value conversions: ################################
+
+    @staticmethod
+    def chk_to_int(chk):
+        if chk is None:
+            return None
+        try:
+            return int(chk, 16)
+        except ValueError:
+            print("Invalid checksum " + str(chk))
+            return None
+
+    @staticmethod
+    def chk_to_str(chk):
+        return None if chk is None else "%08x" % chk
+
+    def _to_db(self, conn, dic, create=True):
+        """ Converts the paths of a dict of column values to node ids and the checksums to integers """
+        ret = {}
+        for col, val in dic.items():
+            if col in self.PATH_COLS:
+                val = self._node_id(conn, val, create)
+            elif col in self.CHK_COLS:
+                val = self.chk_to_int(val)
+            ret[col] = val
+        return ret
+
+    def _from_db(self, conn, col, val):
+        if col in self.PATH_COLS:
+            return self._path_of(conn, val)
+        if col in self.CHK_COLS:
+            return self.chk_to_str(val)
+        return val
+
+    # Write-behind buffer: ##############################
+
+    def _flush_periodically(self):
+        while not self._closed.wait(self.flushInterval):
+            try:
+                self.flush()
+            except sqlite3.Error as e:
+                print("Catalog flush failed: " + str(e))
+
+    def flush(self):
+        """ Writes the buffered inserts and updates to the db in a single transaction,
+        rows with the same columns are written with one executemany """
+        with self._lock:
+            if not self._pending_inserts and not self._pending_updates:
+                return
+            conn = self.create_connection()
+            try:
+                with conn:
+                    inserts = [self._to_db(conn, dic) for dic in self._pending_inserts.values()]
+                    for cols, params in self._group_by_columns(inserts, []).items():
+                        cmd = "INSERT OR IGNORE INTO %s %s" % (self.TABLE_NAME, insert_substr(cols))
+                        conn.executemany(cmd, params)
+                    nodes = [self._node_id(conn, lp) for lp in self._pending_updates]
+                    updates = [self._to_db(conn, dic) for dic in self._pending_updates.values()]
+                    for cols, params in self._group_by_columns(updates, nodes).items():
+                        cmd = 'UPDATE %s SET %s WHERE %s=?' % (self.TABLE_NAME, update_substr(cols), self.LOC)
+                        conn.executemany(cmd, params)
+            except sqlite3.Error:
+                self._clear_dir_ids()   # may hold the ids of nodes that were rolled back
+                raise
+            self._pending_inserts.clear()
+            self._pending_updates.clear()
+            self._pending_remote.clear()
+
+    @staticmethod
+    def _group_by_columns(dicts, keys):
+        """ Groups the given column dicts by their column names, appending the matching key (if any) to the values
+        :return: dict of column names tuple -> list of parameter lists """
+        groups = OrderedDict()
+        keys = list(keys)
+        for i, dic in enumerate(dicts):
+            params = list(dic.values())
+            if keys:
+                params.append(keys[i])
+            groups.setdefault(tuple(dic), []).append(params)
+        return groups
+
+    def _flush_if_pending(self, local_path=None, remote_path=None):
+        """ Read-your-writes: flushes the buffer when a read touches a path with buffered writes """
+        with self._lock:
+            if local_path in self._pending_inserts or local_path in self._pending_updates \
+                    or remote_path in self._pending_remote:
+                self.flush()
+
+    def _buffer_full(self):
+        return len(self._pending_inserts) + len(self._pending_updates) >= self.flushRows
+
+    # Tuples: ###########################################
 
     def check_local_path_exists(self, local_path):
         return self.check_record_exists(self.LOC, local_path)
 
     def check_record_exists(self, col, col_val):
-        conn = None
-        try:
-            conn = self.create_connection()
-            c = conn.cursor()
-            cmd = 'SELECT COUNT(1) FROM %s WHERE %s="%s"' % (self.TABLE_NAME, col, col_val)
-            c.execute(cmd)
-            ret = c.fetchall()  # returns a list
-            conn.commit()
-            if ret[0][0] > 0:
+        """ :param col: LOC or HDFS """
+        with self._lock:
+            if col == self.LOC and col_val in self._pending_inserts:
                 return True
-            else:
-                return False
-        except sqlite3.Error as e:
-            raise e
-        finally:
-            if conn:
-                conn.close()
+            if col == self.HDFS and col_val in self._pending_remote:
+                return True
+        return self._get_row(col, col_val) is not None
 
     def insert_tuple_local(self, loc, rem, loc_chk, type_loc):
         """
@@ -94,13 +551,13 @@ class LocalCatalog:
         :param type_loc: the type of the file locally ('dir', 'file' or 'link')
         :return:
         """
-        dic = {self.LOC: asstr(loc),
-               self.HDFS: asstr(rem),
-               self.TIME_LOC: asstr('datetime("now")', qmark=''),
-               self.TIME_HDFS: asstr(None),
-               self.CHK_LOC: asstr(loc_chk),
-               self.CHK_HDFS: asstr(None),
-               self.TYPE_LOC: asstr(type_loc)}
+        dic = {self.LOC: loc,
+               self.HDFS: rem,
+               self.TIME_LOC: epoch_now(),
+               self.TIME_HDFS: None,
+               self.CHK_LOC: loc_chk,
+               self.CHK_HDFS: None,
+               self.TYPE_LOC: type_loc}
         self.insert_tuple(dic)
 
     def insert_tuple_hdfs(self, loc, rem, hdfs_chk, type_loc):
@@ -112,59 +569,94 @@ class LocalCatalog:
         :param type_loc: the type of the file locally ('dir', 'file' or 'link')
         :return:
         """
-        dic = {self.LOC: asstr(loc),
-               self.HDFS: asstr(rem),
-               self.TIME_LOC: asstr(None),
-               self.TIME_HDFS: asstr('datetime("now")', qmark=''),
-               self.CHK_LOC: asstr(None),
-               self.CHK_HDFS: asstr(hdfs_chk),
-               self.TYPE_LOC: asstr(type_loc)}
+        dic = {self.LOC: loc,
+               self.HDFS: rem,
+               self.TIME_LOC: None,
+               self.TIME_HDFS: epoch_now(),
+               self.CHK_LOC: None,
+               self.CHK_HDFS: hdfs_chk,
+               self.TYPE_LOC: type_loc}
         self.insert_tuple(dic)
 
+    def insert_tuples_hdfs(self, rows):
+        """
+        Inserts the tuples of files created on hdfs in a single transaction, e.g. the files of a job output
+        :param rows: list of (local path, remote path, hdfs checksum, local type)
+        """
+        with self._lock:
+            for loc, rem, hdfs_chk, type_loc in rows:
+                self._buffer_insert({self.LOC: loc,
+                                     self.HDFS: rem,
+                                     self.TIME_LOC: None,
+                                     self.TIME_HDFS: epoch_now(),
+                                     self.CHK_LOC: None,
+                                     self.CHK_HDFS: hdfs_chk,
+                                     self.TYPE_LOC: type_loc})
+            self.flush()
+
     def insert_tuple(self, dic):
-        conn = None
-        try:
-            conn = self.create_connection()
-            c = conn.cursor()
-            cmd = "INSERT OR IGNORE INTO %s %s" % (self.TABLE_NAME, insert_substr(dic))
-            c.execute(cmd)
-            conn.commit()
-        except sqlite3.Error as e:
-            raise e
-        finally:
-            if conn:
-                conn.close()
+        """ Buffers the insert of a tuple, the first buffered insert of a local path wins as in INSERT OR IGNORE """
+        with self._lock:
+            self._buffer_insert(dic)
+            if self.flushInterval <= 0 or self._buffer_full():
+                self.flush()
 
-    def update_tuple_local(self, local_path, loc_chk):
-        dic = {self.TIME_LOC: asstr('datetime("now")', qmark=''),
-               self.CHK_LOC: asstr(loc_chk)}
+    def _buffer_insert(self, dic):
+        loc = dic[self.LOC]
+        self.rowCache.invalidate(self.LOC, loc)
+        self.rowCache.invalidate(self.HDFS, dic[self.HDFS])
+        if loc not in self._pending_inserts:
+            self._pending_inserts[loc] = dict(dic)
+            self._pending_remote[dic[self.HDFS]] = loc
+
+    def update_tuple_local(self, local_path, loc_chk, loc_size=None, loc_mtime=None):
+        dic = {self.TIME_LOC: epoch_now(),
+               self.CHK_LOC: loc_chk}
+        if loc_size is not None:
+            dic[self.SIZE_LOC] = loc_size
+        if loc_mtime is not None:
+            dic[self.MTIME_LOC] = loc_mtime
         self.update_tuple(self.LOC, local_path, dic)
 
-    def update_tuple_hdfs(self, local_path, hdfs_chk):
-        dic = {self.TIME_HDFS: asstr('datetime("now")', qmark=''),
-               self.CHK_HDFS: asstr(hdfs_chk)}
-        self.update_tuple(self.LOC, local_path, dic)            # update by local path, todo: create index
+    def update_tuple_hdfs(self, local_path, hdfs_chk, hdfs_size=None, hdfs_mtime=None):
+        """
+        :param hdfs_size: size of the HDFS file copy that hdfs_chk is the checksum of, None if not known
+        :param hdfs_mtime: its mtime on the namenode, None if not known, i.e. compared by checksum by the RemotePoller
+        """
+        dic = {self.TIME_HDFS: epoch_now(),
+               self.CHK_HDFS: hdfs_chk,
+               self.SIZE_HDFS: hdfs_size,
+               self.MTIME_HDFS: hdfs_mtime}
+        self.update_tuple(self.LOC, local_path, dic)            # update by local path
 
     def update_tuple(self, col, col_val, dic):
         """
         Updates an existing db tuple
-        :param col: the db column by which the update is made
+        :param col: the db column by which the update is made, LOC or HDFS
         :param col_val: the value of the db column
         :param dic: columns to update + their new values
         :return:
         """
-        conn = None
-        try:
-            conn = self.create_connection()
-            c = conn.cursor()
-            cmd = 'UPDATE %s SET %s WHERE %s="%s"' % (self.TABLE_NAME, update_substr(dic), col, col_val)
-            c.execute(cmd)
-            conn.commit()
-        except sqlite3.Error as e:
-            raise e
-        finally:
-            if conn:
-                conn.close()
+        with self._lock:
+            self.rowCache.invalidate(col, col_val)
+            if col != self.LOC:
+                # only updates by local path are buffered
+                self.flush()
+                conn = self.create_connection()
+                node = self._node_id(conn, col_val)
+                if node is None:
+                    return
+                with conn:
+                    dic = self._to_db(conn, dic)
+                    cmd = 'UPDATE %s SET %s WHERE %s=?' % (self.TABLE_NAME, update_substr(list(dic)), col)
+                    conn.execute(cmd, list(dic.values()) + [node])
+                return
+            if col_val in self._pending_inserts:
+                self._pending_inserts[col_val].update(dic)
+            else:
+                self._pending_updates.setdefault(col_val, {}).update(dic)
+            if self.flushInterval <= 0 or self._buffer_full():
+                self.flush()
 
     def get_remote_file_path(self, local_path):
         return self.get_val_by_local_path(self.HDFS, local_path)
@@ -175,6 +667,9 @@ class LocalCatalog:
     def get_hdfs_chk(self, local_path):
         return self.get_val_by_local_path(self.CHK_HDFS, local_path)
 
+    def get_loc_size(self, local_path):
+        return self.get_val_by_local_path(self.SIZE_LOC, local_path)
+
     def get_time_loc(self, local_path):
         return self.get_val_by_local_path(self.TIME_LOC, local_path)
 
@@ -182,98 +677,415 @@ class LocalCatalog:
         return self.get_val_by_local_path(self.TIME_HDFS, local_path)
 
     def get_val_by_local_path(self, col, local_path):  # todo: check error handling
-        conn = self.create_connection()
-        c = conn.cursor()
-        cmd = "SELECT %s FROM %s WHERE %s=%s" % (col, self.TABLE_NAME, self.LOC, asstr(local_path))
-        c.execute(cmd)
-        ret = c.fetchall()  # returns a list of tuples
-        conn.close()
-        try:
-            result = ret[0][0]
-            return result
-        except IndexError:
-            print("Local path " + local_path + " does not exist in the db")
-            return None
+        return self._get_val_by_path(col, self.LOC, local_path, "Local path ")
+
+    def get_tuple(self, local_path):
+        """ :return: dict of the columns of the tuple of a local path, None if it is not in the catalog """
+        row = self._get_row(self.LOC, local_path)
+        return dict(row) if row is not None else None
 
     def get_loc_type_by_remote_path(self, rem_path):
         return self.get_val_by_rem_path(self.TYPE_LOC, rem_path)
 
     def get_val_by_rem_path(self, col, rem_path):  # todo: check error handling
+        return self._get_val_by_path(col, self.HDFS, rem_path, "Remote path ")
+
+    def _get_val_by_path(self, col, path_col, path, name):
+        row = self._get_row(path_col, path)
+        if row is None:
+            print(name + str(path) + " does not exist in the db")
+            return None
+        return row[col]
+
+    def _get_row(self, path_col, path):
+        """
+        Read-through lookup of a tuple in the row cache
+        :param path_col: LOC or HDFS
+        :return: dict of the columns of the tuple, None if the path is not in the catalog
+        """
+        row = self.rowCache.get((path_col, path))
+        if row is not RowCache.MISSING:
+            return row
+        if path_col == self.LOC:
+            self._flush_if_pending(local_path=path)
+        else:
+            self._flush_if_pending(remote_path=path)
+        generation = self.rowCache.generation
         conn = self.create_connection()
-        c = conn.cursor()
-        cmd = "SELECT %s FROM %s WHERE %s=%s" % (col, self.TABLE_NAME, self.HDFS, asstr(rem_path))
-        c.execute(cmd)
-        ret = c.fetchall()  # returns a list of tuples
-        conn.close()
-        try:
-            result = ret[0][0]
-            return result
-        except IndexError:
-            print("Remote path " + rem_path + " does not exist in the db")
+        node = self._node_id(conn, path)
+        ret = None
+        if node is not None:
+            cmd = "SELECT %s FROM %s WHERE %s=?" % (', '.join(self.ROW_COLS), self.TABLE_NAME, path_col)
+            ret = conn.execute(cmd, (node,)).fetchone()
+        row = None
+        if ret is not None:
+            row = {col: path if col == path_col else self._from_db(conn, col, val)
+                   for col, val in zip(self.ROW_COLS, ret)}
+        self.rowCache.put((path_col, path), row, generation)
+        return row
+
+    def get_local_states(self):
+        """
+        Reads the whole catalog in one query, for the reconciliation at start-up
+        :return: dict of local path -> dict of the columns of its tuple
+        """
+        self.flush()
+        cols = [self.LOC, self.HDFS, self.TYPE_LOC, self.CHK_LOC, self.CHK_HDFS, self.SIZE_LOC, self.MTIME_LOC]
+        cmd = "WITH RECURSIVE paths(id, path) AS (SELECT id, '/' || name FROM {0} WHERE parent=? UNION ALL " \
+              "SELECT p.id, paths.path || '/' || p.name FROM {0} p JOIN paths ON p.parent=paths.id) " \
+              "SELECT l.path, h.path, {2} FROM {1} f JOIN paths l ON l.id=f.{3} JOIN paths h ON h.id=f.{4}" \
+            .format(self.PATHS_TABLE, self.TABLE_NAME, ', '.join('f.' + c for c in cols[2:]), self.LOC, self.HDFS)
+        ret = {}
+        for row in self.create_connection().execute(cmd, (self.ROOT,)):
+            dic = dict(zip(cols, row))
+            for col in self.CHK_COLS:
+                dic[col] = self.chk_to_str(dic[col])
+            ret[row[0]] = dic
+        return ret
+
+    # Jobs: ############################################
+
+    def insert_job(self, dic):
+        """ :return: the id of the new job """
+        conn = self.create_connection()
+        with conn:
+            return conn.execute("INSERT INTO %s %s" % (self.JOBS_TABLE, insert_substr(list(dic))),
+                                list(dic.values())).lastrowid
+
+    def update_job(self, job_id, dic):
+        conn = self.create_connection()
+        with conn:
+            conn.execute('UPDATE %s SET %s WHERE id=?' % (self.JOBS_TABLE, update_substr(list(dic))),
+                         list(dic.values()) + [job_id])
+
+    def find_by_content(self, size, loc_chk):
+        """
+        The buffered writes are not searched, a file synced in the last flush interval may be missed
+        :return: list of (local path, remote path) of the files with this size + CRC32C whose copy on HDFS is
+        identical, i.e. has the same checksum and is not packed
+        """
+        conn = self.create_connection()
+        cmd = 'SELECT {0}, {1} FROM {2} WHERE {3}=? AND {4}=? AND {5}={4} AND {6}=? ' \
+              'AND {1} NOT IN (SELECT {1} FROM {7})'.format(self.LOC, self.HDFS, self.TABLE_NAME, self.SIZE_LOC,
+                                                            self.CHK_LOC, self.CHK_HDFS, self.TYPE_LOC,
+                                                            self.PACKED_TABLE)
+        rows = conn.execute(cmd, (size, self.chk_to_int(loc_chk), 'file')).fetchall()
+        return [(self._path_of(conn, lp), self._path_of(conn, rp)) for lp, rp in rows]
+
+    def get_jobs(self, states):
+        """ :return: list of dicts of the jobs in one of the given states, in submission order """
+        conn = self.create_connection()
+        cur = conn.execute('SELECT * FROM %s WHERE state IN (%s) ORDER BY id'
+                           % (self.JOBS_TABLE, ', '.join('?' * len(states))), list(states))
+        cols = [d[0] for d in cur.description]
+        return [dict(zip(cols, row)) for row in cur]
+
+    def get_job_states(self, job_ids):
+        """ :return: dict of job id -> state """
+        conn = self.create_connection()
+        return dict(conn.execute('SELECT id, state FROM %s WHERE id IN (%s)'
+                                 % (self.JOBS_TABLE, ', '.join('?' * len(job_ids))), list(job_ids)).fetchall())
+
+    def get_cached_job(self, fingerprint):
+        """ :return: dict of the cached output of a job fingerprint, None if not cached """
+        rows = self.get_cached_jobs('WHERE fingerprint=?', [fingerprint])
+        return rows[0] if rows else None
+
+    def get_cached_jobs(self, where='', params=()):
+        """ :return: list of dicts of the cached job outputs, least recently used first """
+        conn = self.create_connection()
+        cur = conn.execute('SELECT * FROM %s %s ORDER BY last_used' % (self.JOB_CACHE_TABLE, where), list(params))
+        cols = [d[0] for d in cur.description]
+        return [dict(zip(cols, row)) for row in cur]
+
+    def set_cached_job(self, dic):
+        """ Inserts or replaces the cached output of dic['fingerprint'] """
+        conn = self.create_connection()
+        with conn:
+            conn.execute("INSERT OR REPLACE INTO %s %s" % (self.JOB_CACHE_TABLE, insert_substr(list(dic))),
+                         list(dic.values()))
+
+    def delete_cached_job(self, fingerprint):
+        conn = self.create_connection()
+        with conn:
+            conn.execute('DELETE FROM %s WHERE fingerprint=?' % self.JOB_CACHE_TABLE, (fingerprint,))
+
+    # Line indexes: ####################################
+
+    def set_line_index(self, rem_path, hdfs_chk, size, lines, line_nos, offsets):
+        """
+        Stores the line index of a remote file, replacing the previous one
+        :param hdfs_chk: the checksum of the file version that was indexed
+        :param line_nos: packed line numbers, see core.line_index
+        :param offsets: packed byte offsets of the starts of these lines
+        """
+        conn = self.create_connection()
+        with conn:
+            node = self._node_id(conn, rem_path, create=True)
+            cmd = 'INSERT OR REPLACE INTO %s (%s, %s, size, lines, line_nos, offsets) VALUES (?, ?, ?, ?, ?, ?)' \
+                  % (self.LINE_INDEX_TABLE, self.HDFS, self.CHK_HDFS)
+            conn.execute(cmd, (node, self.chk_to_int(hdfs_chk), size, lines, line_nos, offsets))
+
+    def get_line_index(self, rem_path):
+        """ :return: dict of the line index of a remote file, None if it has not been indexed """
+        conn = self.create_connection()
+        node = self._node_id(conn, rem_path)
+        if node is None:
+            return None
+        cmd = 'SELECT %s, size, lines, line_nos, offsets FROM %s WHERE %s=?' \
+              % (self.CHK_HDFS, self.LINE_INDEX_TABLE, self.HDFS)
+        ret = conn.execute(cmd, (node,)).fetchone()
+        if ret is None:
             return None
+        return {self.CHK_HDFS: self.chk_to_str(ret[0]), 'size': ret[1], 'lines': ret[2],
+                'line_nos': ret[3], 'offsets': ret[4]}
+
+    # Packed files: ####################################
 
-    # todo: how will I handle the already deleted file str locally if transaction fails?
-    #  inconsistency because file str does not exist locally, exist in hdfs + db
-    def delete_by_local_path(self, list_of_local_paths):   # todo: check error handling
-        """ Deletes by given local paths in a transaction """
+    def get_packed(self, rem_path):
+        """ :return: dict of the container, offset, length of a packed file + the gen of its container, or None """
         conn = self.create_connection()
-        conn.isolation_level = None
-        c = conn.cursor()
-        c.execute("begin")
-        try:
-            for lp in list_of_local_paths:
-                cmd = 'DELETE FROM %s WHERE %s="%s"' % (self.TABLE_NAME, self.LOC, lp)
-                c.execute(cmd)
-            # c.execute("fnord")          # to check if transaction rollbacks
-            conn.commit()
-        except sqlite3.Error:
-            print("Transaction failed!")
-            conn.rollback()
-        conn.close()
-
-    # todo: how will I handle the already deleted file str locally if transaction fails?
-    #  inconsistency because file str does not exist locally, exist in hdfs + db
-    def delete_by_remote_path(self, list_of_remote_paths):   # todo: check error handling
-        """ Deletes by given remote paths in a transaction """
+        node = self._node_id(conn, rem_path)
+        if node is None:
+            return None
+        ret = conn.execute('SELECT m.container, m.offset, m.length, c.gen FROM %s m JOIN %s c '
+                           'ON c.container=m.container WHERE m.%s=?'
+                           % (self.PACKED_TABLE, self.CONTAINERS_TABLE, self.HDFS), (node,)).fetchone()
+        if ret is None:
+            return None
+        return {'container': self._path_of(conn, ret[0]), 'offset': ret[1], 'length': ret[2], 'gen': ret[3]}
+
+    def is_packed(self, rem_path):
+        return self.get_packed(rem_path) is not None
+
+    def set_packed(self, rem_path, container, offset, length, pad, container_size):
+        """
+        Records a file appended to a container, in the same transaction as the new size of the container
+        :param pad: 1 if a newline was appended after the file, else 0
+        """
         conn = self.create_connection()
-        conn.isolation_level = None
-        c = conn.cursor()
-        c.execute("begin")
-        try:
-            for rp in list_of_remote_paths:
-                # srp = os.path.join(remote_starting_path, rp)
-                # cmd = 'DELETE FROM %s WHERE %s="%s"' % (self.TABLE_NAME, self.REM, srp)
-                cmd = 'DELETE FROM %s WHERE %s="%s"' % (self.TABLE_NAME, self.HDFS, rp)
-                c.execute(cmd)
-            # c.execute("fnord")          # to check if transaction rollbacks
-            conn.commit()
-        except sqlite3.Error:
-            print("Transaction failed!")
-            conn.rollback()
-        conn.close()
-
-    # todo: check error handling
-    def update_by_remote_path(self, tuples_list):       # todo: can also happen by local if needed
-        """
-        Updates local and remote paths after a file / folder has moved, queries db table by local path
-        :param tuples_list: list of tuples of (cur_remote_path, new_local_path, new_remote_path)
-        :return:
+        with conn:
+            node = self._node_id(conn, rem_path, create=True)
+            cont = self._node_id(conn, container, create=True)
+            conn.execute('INSERT OR REPLACE INTO %s (%s, container, offset, length, pad) VALUES (?, ?, ?, ?, ?)'
+                         % (self.PACKED_TABLE, self.HDFS), (node, cont, offset, length, pad))
+            conn.execute('INSERT INTO %s (container, size, gen) VALUES (?, ?, 0) '
+                         'ON CONFLICT(container) DO UPDATE SET size=excluded.size' % self.CONTAINERS_TABLE,
+                         (cont, container_size))
+
+    def delete_packed(self, rem_path):
+        """ Drops the packed location of a file, its bytes in the container are dead """
+        conn = self.create_connection()
+        node = self._node_id(conn, rem_path)
+        if node is not None:
+            with conn:
+                conn.execute('DELETE FROM %s WHERE %s=?' % (self.PACKED_TABLE, self.HDFS), (node,))
+
+    def _containers(self, conn, where, params):
+        cmd = 'SELECT c.container, c.size, c.gen, COALESCE(SUM(m.length + m.pad), 0) FROM %s c ' \
+              'LEFT JOIN %s m ON m.container=c.container %s GROUP BY c.container ORDER BY c.container' \
+              % (self.CONTAINERS_TABLE, self.PACKED_TABLE, where)
+        return [{'container': self._path_of(conn, row[0]), 'size': row[1], 'gen': row[2], 'live': row[3]}
+                for row in conn.execute(cmd, params).fetchall()]
+
+    def get_containers(self, rem_dir):
+        """ :return: list of dicts of the containers of a remote dir, with the bytes of their live files """
+        conn = self.create_connection()
+        node = self._node_id(conn, rem_dir)
+        if node is None:
+            return []
+        return self._containers(conn, 'JOIN %s p ON p.id=c.container WHERE p.parent=?' % self.PATHS_TABLE, (node,))
+
+    def get_container(self, container):
+        """ :return: dict of a container as in get_containers(), None if unknown """
+        conn = self.create_connection()
+        node = self._node_id(conn, container)
+        if node is None:
+            return None
+        ret = self._containers(conn, 'WHERE c.container=?', (node,))
+        return ret[0] if ret else None
+
+    def get_containers_in_subtree(self, rem_path):
+        """ :return: list of dicts of the containers under a remote dir, as in get_containers() """
+        conn = self.create_connection()
+        node = self._node_id(conn, rem_path)
+        if node is None:
+            return []
+        return self._containers(conn, 'WHERE c.container IN (%s SELECT id FROM sub)' % self._subtree_cte(), (node,))
+
+    def get_container_members(self, container):
+        """ :return: list of (remote path, offset, length) of the live files of a container, by offset """
+        conn = self.create_connection()
+        node = self._node_id(conn, container)
+        if node is None:
+            return []
+        rows = conn.execute('SELECT %s, offset, length FROM %s WHERE container=? ORDER BY offset'
+                            % (self.HDFS, self.PACKED_TABLE), (node,)).fetchall()
+        return [(self._path_of(conn, row[0]), row[1], row[2]) for row in rows]
+
+    def replace_container(self, container, offsets, size):
+        """
+        Records a compacted container in a single transaction
+        :param offsets: dict of remote path -> new offset of the live files
+        :param size: the new size of the container
         """
         conn = self.create_connection()
-        conn.isolation_level = None
-        c = conn.cursor()
-        c.execute("begin")
-        try:
-            for t in tuples_list:
-                cur_rp = t[0]
-                new_lp = t[1]
-                new_rp = t[2]
-                cmd = 'UPDATE %s SET %s="%s", %s="%s" WHERE %s="%s"' % (self.TABLE_NAME, self.LOC, new_lp,
-                                                                        self.HDFS, new_rp, self.HDFS, cur_rp)
-                print(cmd)
-                c.execute(cmd)
-            conn.commit()
-        except sqlite3.Error:
-            print("Transaction failed!")
-            conn.rollback()
-        conn.close()
+        with conn:
+            for rem_path, offset in offsets.items():
+                conn.execute('UPDATE %s SET offset=? WHERE %s=?' % (self.PACKED_TABLE, self.HDFS),
+                             (offset, self._node_id(conn, rem_path)))
+            conn.execute('UPDATE %s SET size=?, gen=gen+1 WHERE container=?' % self.CONTAINERS_TABLE,
+                         (size, self._node_id(conn, container)))
+
+    def delete_container(self, container):
+        conn = self.create_connection()
+        node = self._node_id(conn, container)
+        if node is not None:
+            with conn:
+                conn.execute('DELETE FROM %s WHERE container=?' % self.PACKED_TABLE, (node,))
+                conn.execute('DELETE FROM %s WHERE container=?' % self.CONTAINERS_TABLE, (node,))
+                conn.execute('DELETE FROM %s WHERE id=?' % self.PATHS_TABLE, (node,))
+
+    # Remote dirs: #####################################
+
+    def get_remote_dirs(self):
+        """ :return: dict of remote path -> (local path, polled mtime, listing fingerprint) of the synced dirs """
+        self.flush()
+        conn = self.create_connection()
+        cmd = 'SELECT f.{0}, f.{1}, d.mtime, d.fingerprint FROM {2} f LEFT JOIN {3} d ON d.{1}=f.{1} ' \
+              'WHERE f.{4}=?'.format(self.LOC, self.HDFS, self.TABLE_NAME, self.REMOTE_DIRS_TABLE, self.TYPE_LOC)
+        return {self._path_of(conn, rn): (self._path_of(conn, ln), mtime, fp)
+                for ln, rn, mtime, fp in conn.execute(cmd, ('dir',)).fetchall()}
+
+    def get_remote_dir(self, rem_path):
+        """ :return: (polled mtime, listing fingerprint) of a remote dir, (None, None) if never polled """
+        conn = self.create_connection()
+        node = self._node_id(conn, rem_path)
+        ret = None
+        if node is not None:
+            ret = conn.execute('SELECT mtime, fingerprint FROM %s WHERE %s=?' % (self.REMOTE_DIRS_TABLE, self.HDFS),
+                               (node,)).fetchone()
+        return tuple(ret) if ret is not None else (None, None)
+
+    def set_remote_dir(self, rem_path, mtime, fingerprint):
+        conn = self.create_connection()
+        with conn:
+            node = self._node_id(conn, rem_path, create=True)
+            conn.execute('INSERT OR REPLACE INTO %s (%s, mtime, fingerprint) VALUES (?, ?, ?)'
+                         % (self.REMOTE_DIRS_TABLE, self.HDFS), (node, mtime, fingerprint))
+
+    def get_remote_children(self, rem_dir):
+        """
+        :return: dict of name -> dict of the columns of the tuple of the remote files / dirs in a remote dir,
+        with 'packed': True for the files packed in a container
+        """
+        self.flush()
+        conn = self.create_connection()
+        node = self._node_id(conn, rem_dir)
+        if node is None:
+            return {}
+        cols = [self.LOC, self.TYPE_LOC, self.CHK_LOC, self.CHK_HDFS, self.TIME_HDFS, self.SIZE_LOC, self.MTIME_LOC,
+                self.SIZE_HDFS, self.MTIME_HDFS]
+        cmd = 'SELECT p.name, {0}, p.id IN (SELECT {1} FROM {2}) FROM {3} p JOIN {4} f ON f.{1}=p.id ' \
+              'WHERE p.parent=?'.format(', '.join('f.' + c for c in cols), self.HDFS, self.PACKED_TABLE,
+                                        self.PATHS_TABLE, self.TABLE_NAME)
+        ret = {}
+        for row in conn.execute(cmd, (node,)).fetchall():
+            dic = {col: self._from_db(conn, col, val) for col, val in zip(cols, row[1:-1])}
+            dic['packed'] = bool(row[-1])
+            ret[row[0]] = dic
+        return ret
+
+    # Subtrees: #########################################
+
+    def _move_node(self, conn, src, dest):
+        node = self._node_id(conn, src)
+        if node is None or src == dest:
+            return
+        existing = self._node_id(conn, dest)
+        if existing is not None:
+            self._delete_nodes(conn, existing)      # overwritten
+        parts = split_path(dest)
+        parent = self._dir_id(conn, parts[:-1], True)
+        conn.execute('UPDATE %s SET parent=?, name=? WHERE id=?' % self.PATHS_TABLE, (parent, parts[-1], node))
+
+    def move_subtree(self, src_local, dest_local, src_remote, dest_remote):
+        """
+        Moves a file / dir and everything under it by re-parenting its local + remote path nodes,
+        the tuples under it follow without being updated. Tuples already at the dest paths are overwritten.
+        """
+        with self._lock:
+            self.flush()
+            conn = self.create_connection()
+            try:
+                with conn:
+                    self._move_node(conn, src_local, dest_local)
+                    self._move_node(conn, src_remote, dest_remote)
+            except sqlite3.Error as e:
+                print("Transaction failed! " + str(e))
+                self._clear_dir_ids()   # may hold the ids of the dest ancestors that were rolled back
+            finally:
+                self._invalidate_dir_ids(src_local, dest_local, src_remote, dest_remote)
+                self.rowCache.invalidate_subtree(src_local, dest_local, src_remote, dest_remote)
+
+    def delete_subtree(self, local_path):
+        """ Deletes the tuples + path nodes of a local file / dir and of everything under it, locally + on hdfs """
+        with self._lock:
+            self.flush()
+            conn = self.create_connection()
+            node = self._node_id(conn, local_path)
+            if node is None:
+                return
+            ret = conn.execute('SELECT %s FROM %s WHERE %s=?' % (self.HDFS, self.TABLE_NAME, self.LOC),
+                               (node,)).fetchone()
+            remote_node = ret[0] if ret is not None else None
+            remote_path = self._path_of(conn, remote_node)
+            try:
+                with conn:
+                    self._delete_nodes(conn, node)
+                    if remote_node is not None:
+                        self._delete_nodes(conn, remote_node)
+            except sqlite3.Error as e:
+                print("Transaction failed! " + str(e))
+            finally:
+                self._invalidate_dir_ids(local_path, remote_path)
+                self.rowCache.invalidate_subtree(local_path, remote_path)
+
+    def get_subtree_checksums(self, local_path):
+        """ :return: sorted list of (local path, hdfs checksum) of local_path and of everything under it """
+        with self._lock:
+            self.flush()
+        conn = self.create_connection()
+        node = self._node_id(conn, local_path)
+        if node is None:
+            return []
+        cmd = self._subtree_cte(with_paths=True) + 'SELECT sub.path, f.%s FROM sub JOIN %s f ON f.%s=sub.id ' \
+                                                   'ORDER BY sub.path' % (self.CHK_HDFS, self.TABLE_NAME, self.LOC)
+        return [(lp, self.chk_to_str(chk)) for lp, chk in conn.execute(cmd, (node, local_path))]
+
+    def get_subtree_states(self, local_path):
+        """ :return: dict of local path -> (local type, size, mtime) of local_path and of everything under it """
+        with self._lock:
+            self.flush()
+        conn = self.create_connection()
+        node = self._node_id(conn, local_path)
+        if node is None:
+            return {}
+        cmd = self._subtree_cte(with_paths=True) + 'SELECT sub.path, f.%s, f.%s, f.%s FROM sub JOIN %s f ' \
+                                                   'ON f.%s=sub.id' % (self.TYPE_LOC, self.SIZE_LOC, self.MTIME_LOC,
+                                                                       self.TABLE_NAME, self.LOC)
+        return {row[0]: row[1:] for row in conn.execute(cmd, (node, local_path))}
+
+    def get_links_in_subtree(self, local_path):
+        """ :return: list of (local path, remote path) of the links at or under local_path """
+        with self._lock:
+            self.flush()
+        conn = self.create_connection()
+        node = self._node_id(conn, local_path)
+        if node is None:
+            return []
+        cmd = self._subtree_cte(with_paths=True) + 'SELECT sub.path, f.%s FROM sub JOIN %s f ON f.%s=sub.id ' \
+                                                   'WHERE f.%s=?' % (self.HDFS, self.TABLE_NAME, self.LOC,
+                                                                     self.TYPE_LOC)
+        rows = conn.execute(cmd, (node, local_path, 'link')).fetchall()
+        return [(lp, self._path_of(conn, rn)) for lp, rn in rows]
@@ -7,14 +7,27 @@ from watchdog.observers import Observer
 from hdfs3 import HDFileSystem
 from core.local_catalogue import LocalCatalog
 from core.hadoop_interface import HadoopInterface
+from core.transfer import TransferEngine, TokenBucket
+from core.block_cache import BlockCache
+from core.line_index import LineIndexer
 from utils.path_util import customize_path
-from utils.file_util import bytes_to_mb
+from utils.file_util import bytes_to_mb, ChecksumPool
 from core.event import Event
+from core.event_queue import EventQueue
+from core.ignore import IgnoreMatcher
+from core.reconciler import Reconciler
+from core.poller import RemotePoller
+from core.job_scheduler import JobScheduler
+from core.job_cache import JobCache
+from core.dry_run import DryRun
+from core.codec import Compression
+from core.packing import Packer
+from core.dedupe import Dedupe
+from core.daemon_api import DaemonAPI, APIServer, SOCKET_FILE
 from core.mrbox_object import MRBoxObject
 
 # TODO: create properties obj for hardcoded parameters
-# one thread to observe and more serialized to do the changes
-# start with one thread
+# one thread to observe, a pool of workers to do the changes (serialized per path)
 
 if __name__ == '__main__':
 
@@ -41,28 +54,116 @@ if __name__ == '__main__':
     local_file_size_limit_bytes = bytes_to_mb(int(local_file_size_limit_MB))
     local = MRBoxObject(local_folder, local_file_size_limit_bytes, remote_folder)
 
+    # create sqlite db
+    full_db_path = os.path.join(config['User']['localPath'], config['User']['dbFile'])
+    lc = LocalCatalog(full_db_path, config['User'].getint('dbFlushRows', fallback=500),
+                      config['User'].getfloat('dbFlushSeconds', fallback=1.0),
+                      config['User'].getint('catalogCacheRows', fallback=10000))
+
     # connect to hdfs and create hadoop interface, todo: check how to create list of multiple hadoops
     hdfs_con = HDFileSystem(host=config['User']['hdfsHost'], port=config['User'].getint('hdfsPort'))
     hadoop_path = config['User']['hadoopPath']
     hdfs_con.mkdir(remote_folder)
-    hadoop = HadoopInterface(hdfs_con, hadoop_path)
-
-    # create sqlite db
-    full_db_path = os.path.join(config['User']['localPath'], config['User']['dbFile'])
-    lc = LocalCatalog(full_db_path)
-
-    # todo: run sync thread for initial consistency with local folder
+    checksum_stream_limit = bytes_to_mb(config['User'].getint('checksumStreamMB', fallback=16))
+    # partial downloads are staged next to the /mrbox folder, so that the observer only sees complete files
+    staging_folder = os.path.join(config['User']['localPath'], '.mrbox-staging')
+    # bandwidth caps per direction, e.g. during the business hours of a shared uplink, 0 for no cap
+    limit_hours = config['User'].get('limitHours', fallback='').strip()
+    limit_hours = tuple(int(h) for h in limit_hours.split('-')) if limit_hours else None
+    limits = {d: TokenBucket(config['User'].getint(key, fallback=0) * 1024, hours=limit_hours,
+                             weekdays_only=config['User'].getboolean('limitWeekdaysOnly', fallback=False))
+              for d, key in (('up', 'uploadLimitKBps'), ('down', 'downloadLimitKBps'))}
+    transfers = TransferEngine(hdfs_con, staging_folder, config['User'].getint('transferStreams', fallback=4),
+                               bytes_to_mb(config['User'].getint('transferChunkMB', fallback=64)), limits=limits,
+                               small_size=config['User'].getint('smallFileKB', fallback=1024) * 1024,
+                               bulk_size=bytes_to_mb(config['User'].getint('bulkFileMB', fallback=256)))
+    # blocks of the remote files of links read by mrview
+    block_cache = BlockCache(hdfs_con, os.path.join(config['User']['localPath'],
+                                                    config['User'].get('cacheDir', fallback='.mrbox-cache')),
+                             bytes_to_mb(config['User'].getint('cacheBlockMB', fallback=4)),
+                             bytes_to_mb(config['User'].getint('cacheBudgetMB', fallback=1024)))
+    # line indexes of the remote files of links, built in the background for new links if enabled
+    line_indexer = LineIndexer(hdfs_con, lc)
+    line_indexer.start()
+    background_indexer = line_indexer if config['User'].getboolean('lineIndex', fallback=True) else None
+    # uploads of text files compressed on HDFS, outputs over the size limit kept compressed locally if they fit
+    compress_exts = [e.strip() for e in config['User'].get('compressExts', fallback='').split(',') if e.strip()]
+    compression = Compression(config['User'].get('uploadCodec', fallback='none'),
+                              config['User'].get('localCodec', fallback='none'), compress_exts)
+    # small files packed into container files of their dir on HDFS if enabled
+    packer = None
+    if config['User'].getboolean('packSmallFiles', fallback=False):
+        packer = Packer(hdfs_con, lc, config['User'].getint('packThresholdKB', fallback=512) * 1024,
+                        bytes_to_mb(config['User'].getint('containerMB', fallback=128)),
+                        config['User'].getfloat('compactRatio', fallback=0.5))
+    hadoop = HadoopInterface(hdfs_con, hadoop_path, checksum_stream_limit, transfers, block_cache,
+                             background_indexer, config['User'].getboolean('mergeParts', fallback=False),
+                             compression, packer)
 
     # create thread to monitor /mrbox directory and log events generated
     logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(message)s', datefmt='%Y-%m-%d %H:%M:%S')
 
-    event_handler = Event(local, hadoop, lc)
+    hash_pool = ChecksumPool(config['User'].getint('hashWorkers', fallback=4))
+    # MR jobs run in the background, their logs are kept next to the /mrbox folder
+    job_cache = None
+    if config['User'].getboolean('jobCache', fallback=True):
+        job_cache = JobCache(hadoop, lc, customize_path(config['User']['hdfsPath'], '.mrbox-jobcache'),
+                             config['User'].getint('jobCacheMaxAgeDays', fallback=30),
+                             config['User'].getint('jobCacheMaxGB', fallback=10) * 1024 ** 3)
+    jobs = JobScheduler(hadoop, lc, local_file_size_limit_bytes,
+                        os.path.join(config['User']['localPath'], '.mrbox-jobs'),
+                        config['User'].getint('maxJobs', fallback=2), cache=job_cache)
+    jobs.start()
+    # dry runs of the jobs with dry_run: true in their .yaml, on a local sample of the input
+    dry_run = DryRun(config['User'].getint('dryRunWorkers', fallback=0) or None,
+                     sample_bytes=bytes_to_mb(config['User'].getint('dryRunSampleMB', fallback=16)))
+    # deleted files kept as tombstones for a while, so that deletes + creates of the same content become renames
+    dedupe = None
+    if config['User'].getboolean('dedupe', fallback=True):
+        dedupe = Dedupe(hadoop, lc, customize_path(config['User']['hdfsPath'], '.mrbox-trash'),
+                        config['User'].getint('tombstoneSeconds', fallback=30),
+                        bytes_to_mb(config['User'].getint('distcpMB', fallback=256)))
+        dedupe.start()
+    event_handler = Event(local, hadoop, lc, hash_pool, config['User'].getboolean('deltaSync', fallback=True), jobs,
+                          dry_run, dedupe)
+    # the events of the paths matched by the .mrboxignore files + of editor / temp files are dropped
+    ignore = IgnoreMatcher(local_folder, config['User'].getboolean('ignoreDefaults', fallback=True))
+    event_queue = EventQueue(event_handler, config['User'].getint('eventWorkers', fallback=4),
+                             config['User'].getfloat('eventDelaySeconds', fallback=0.5), ignore)
     observer = Observer()
-    observer.schedule(event_handler, local_folder, recursive=True)
+    observer.schedule(event_queue, local_folder, recursive=True)
     observer.start()
+
+    # sync thread for initial consistency with local folder, runs while the live events are handled
+    reconciler = Reconciler(local, hadoop, lc, hash_pool, event_queue.dispatch,
+                            config['User'].getint('scanWorkers', fallback=8))
+    reconciler.start()
+    # changes made directly on HDFS, polled once the reconciliation is done
+    poller = None
+    if config['User'].getint('remotePollSeconds', fallback=30) > 0:
+        poller = RemotePoller(local, hadoop, lc, config['User'].getint('remotePollSeconds', fallback=30),
+                              config['User'].getint('remoteFullScanEvery', fallback=20),
+                              config['User'].getint('scanWorkers', fallback=8), reconciler)
+        poller.start()
+
+    # mrview is served on the warm HDFS connection + catalog cache through a local socket
+    socket_path = os.path.join(config['User']['localPath'], config['User'].get('socketFile', fallback=SOCKET_FILE))
+    api_server = APIServer(socket_path, DaemonAPI(hadoop, lc, line_indexer))
+    api_server.start()
     try:
         while True:
             time.sleep(1)
     except KeyboardInterrupt:
         observer.stop()
     observer.join()
+    if poller is not None:
+        poller.stop()
+    api_server.stop()
+    line_indexer.stop()
+    event_queue.stop()
+    if dedupe is not None:
+        dedupe.stop()
+    jobs.stop()
+    transfers.shutdown()
+    hash_pool.shutdown()
+    lc.close()
@@ -1,12 +1,301 @@
 import os
 import configparser
+import subprocess
 import sys
-from hdfs3 import HDFileSystem
-from core.local_catalogue import LocalCatalog
-from core.hadoop_interface import HadoopInterface
+from collections import deque
+from itertools import islice
+from core.daemon_api import APIClient, APIError, SOCKET_FILE
+from core.codec import codec_of
 from utils.path_util import customize_path
 
-SUPPORTED_LINK_CMDS = ['head', 'tail']
+SUPPORTED_LINK_CMDS = ['head', 'tail', 'cat', 'less', 'line', 'wc']
+RANGE_OPTS = ['--offset', '--length']
+READ_STEP = 4 * 1024 * 1024     # bytes read per call while paging through a remote file
+HEAD_TAIL_BYTES = 1024          # as hdfs dfs -head / -tail
+
+
+def parse_opts(cmd, opts):
+    """
+    cat [--offset N] [--length M], line N [COUNT], tail [-n K]
+    :return: dict of the options of the cmd
+    """
+    if cmd == 'cat':
+        ret = {'--offset': 0, '--length': None}
+        if len(opts) % 2 != 0:
+            raise ValueError("Expected --offset N and / or --length M")
+        for opt, val in zip(opts[::2], opts[1::2]):
+            if opt not in RANGE_OPTS:
+                raise ValueError("Unknown option " + opt)
+            ret[opt] = int(val)
+            if ret[opt] < 0:
+                raise ValueError(opt + " must not be negative")
+        return {'offset': ret['--offset'], 'length': ret['--length']}
+    if cmd == 'line':
+        if len(opts) not in (1, 2):
+            raise ValueError("Expected line N [COUNT]")
+        ret = {'line': int(opts[0]), 'count': int(opts[1]) if len(opts) == 2 else 1}
+        if ret['line'] < 1 or ret['count'] < 0:
+            raise ValueError("Lines are numbered from 1")
+        return ret
+    if cmd == 'tail' and opts:
+        if len(opts) != 2 or opts[0] != '-n' or int(opts[1]) < 0:
+            raise ValueError("Expected tail -n K")
+        return {'count': int(opts[1])}
+    if opts:
+        raise ValueError("Wrong number of operands.")
+    return {}
+
+
+def copy_range(read, out, offset=0, length=None):
+    """
+    Writes a byte range of a remote file to out, READ_STEP bytes at a time
+    :param read: callable (offset, length) -> bytes of the remote file, empty at its end
+    """
+    end = None if length is None else offset + length
+    while end is None or offset < end:
+        step = READ_STEP if end is None else min(READ_STEP, end - offset)
+        data = read(offset, step)
+        if not data:
+            break
+        out.write(data)
+        offset += len(data)
+    out.flush()
+
+
+def page(read):
+    """ Pipes a remote file into less, the blocks are only read as far as less consumes them """
+    pager = subprocess.Popen([os.environ.get('PAGER', 'less')], stdin=subprocess.PIPE)
+    try:
+        copy_range(read, pager.stdin)
+    except BrokenPipeError:
+        pass        # the pager was closed before the end of the file
+    finally:
+        try:
+            pager.stdin.close()
+        except BrokenPipeError:
+            pass
+        pager.wait()
+
+
+def iter_lines(chunks):
+    """ :return: generator of the lines of an iterable of bytes, with their newline """
+    rest = b''
+    for chunk in chunks:
+        data = rest + chunk
+        nl = data.rfind(b'\n')
+        if nl == -1:
+            rest = data
+            continue
+        for line in data[:nl].split(b'\n'):
+            yield line + b'\n'
+        rest = data[nl + 1:]
+    if rest:
+        yield rest
+
+
+class DecodedFile:
+    """
+    The decompressed content of a compressed local / remote file, decoded on the fly. A read past the previous one
+    continues the decoding, a read before it decodes the file again from its start.
+    """
+    def __init__(self, read, codec):
+        """
+        :param read: callable (offset, length) -> bytes of the compressed file, empty at its end
+        :param codec: Codec of the file
+        """
+        self.rawRead = read
+        self.codec = codec
+        self._restart()
+
+    def _raw_chunks(self):
+        offset = 0
+        while True:
+            data = self.rawRead(offset, READ_STEP)
+            if not data:
+                return
+            offset += len(data)
+            yield data
+
+    def _restart(self):
+        self._decoded = self.codec.decode(self._raw_chunks())
+        self._buf = b''
+        self._pos = 0       # decoded offset of _buf
+
+    def chunks(self):
+        """ :return: generator of the decompressed chunks of the whole file """
+        return self.codec.decode(self._raw_chunks())
+
+    def read(self, offset, length):
+        """ :return: up to length decompressed bytes from offset, empty at the end of the file """
+        if offset < self._pos:
+            self._restart()
+        while offset >= self._pos + len(self._buf):
+            self._pos += len(self._buf)
+            self._buf = next(self._decoded, None)
+            if self._buf is None:
+                self._buf = b''
+                return b''
+        start = offset - self._pos
+        return self._buf[start:start + length]
+
+
+def run_decoded_cmd(cmd, decoded, opts):
+    """ Runs a supported link cmd on a DecodedFile, the line index + block ranges are of the compressed bytes """
+    out = sys.stdout.buffer
+    if cmd == 'head':
+        out.write(decoded.read(0, HEAD_TAIL_BYTES))
+    elif cmd == 'cat':
+        copy_range(decoded.read, out, opts['offset'], opts['length'])
+    elif cmd == 'less':
+        page(decoded.read)
+    elif cmd == 'wc':
+        lines = size = 0
+        last = b'\n'
+        for chunk in decoded.chunks():
+            lines += chunk.count(b'\n')
+            size += len(chunk)
+            last = chunk[-1:]
+        print(lines + (last != b'\n'), size)
+    elif cmd == 'line':
+        out.writelines(islice(iter_lines(decoded.chunks()), opts['line'] - 1, opts['line'] - 1 + opts['count']))
+    elif 'count' in opts:
+        out.writelines(deque(iter_lines(decoded.chunks()), maxlen=opts['count']) if opts['count'] else [])
+    else:
+        tail = b''
+        for chunk in decoded.chunks():
+            tail = (tail + chunk)[-HEAD_TAIL_BYTES:]
+        out.write(tail)
+    out.flush()
+
+
+def local_reader(f):
+    """ :return: callable (offset, length) -> bytes of an open local file """
+    def read(offset, length):
+        f.seek(offset)
+        return f.read(length)
+    return read
+
+
+class DaemonRemote:
+    """ The remote file of a link, read through the running mrbox daemon """
+    def __init__(self, client, hdfs_path):
+        self.client = client
+        self.hdfsPath = hdfs_path
+
+    def head(self):
+        return self.client.call('head', hdfs_path=self.hdfsPath)[1]
+
+    def tail(self):
+        return self.client.call('tail', hdfs_path=self.hdfsPath)[1]
+
+    def read(self, offset, length):
+        return self.client.call('read', hdfs_path=self.hdfsPath, offset=offset, length=length)[1]
+
+    def line_range(self, first, count):
+        return self.client.call('line_range', hdfs_path=self.hdfsPath, first=first, count=count)[0]
+
+
+class StandaloneRemote:
+    """ The remote file of a link, read on a connection of mrview when the mrbox daemon is not running """
+    def __init__(self, hadoop, line_indexer, hdfs_path, hdfs_chk):
+        self.hadoop = hadoop
+        self.lineIndexer = line_indexer
+        self.hdfsPath = hdfs_path
+        self.hdfsChk = hdfs_chk
+
+    def head(self):
+        return self.hadoop.read_head(self.hdfsPath)
+
+    def tail(self):
+        return self.hadoop.read_tail(self.hdfsPath)
+
+    def read(self, offset, length):
+        return self.hadoop.read_range(self.hdfsPath, offset, length, self.hdfsChk)[1]
+
+    def line_range(self, first, count):
+        return self.lineIndexer.line_range(self.hdfsPath, first, count, self.read)
+
+
+def run_standalone(config, cmd, local_path, opts):
+    """ Runs the cmd with its own HDFS connection + catalog, when the mrbox daemon is not running """
+    from hdfs3 import HDFileSystem
+    from core.local_catalogue import LocalCatalog
+    from core.hadoop_interface import HadoopInterface
+    from core.block_cache import BlockCache
+    from core.line_index import LineIndexer
+    from utils.file_util import bytes_to_mb
+
+    # create sqlite db instance
+    full_db_path = os.path.join(config['User']['localPath'], config['User']['dbFile'])
+    lc = LocalCatalog(full_db_path, flush_interval=0)
+    try:
+        # need to query db to get type and remote path if link
+        hdfs_path = lc.get_remote_file_path(local_path)
+        loc_type = lc.get_loc_type_by_remote_path(hdfs_path)
+
+        remote = None
+        if loc_type == 'link' and cmd in SUPPORTED_LINK_CMDS:
+            # connect to hdfs and create hadoop interface, the block cache is shared with the daemon
+            hdfs_con = HDFileSystem(host=config['User']['hdfsHost'], port=config['User'].getint('hdfsPort'))
+            block_cache = BlockCache(hdfs_con, os.path.join(config['User']['localPath'],
+                                                            config['User'].get('cacheDir', fallback='.mrbox-cache')),
+                                     bytes_to_mb(config['User'].getint('cacheBlockMB', fallback=4)),
+                                     bytes_to_mb(config['User'].getint('cacheBudgetMB', fallback=1024)))
+            hadoop = HadoopInterface(hdfs_con, config['User']['hadoopPath'], block_cache=block_cache)
+            remote = StandaloneRemote(hadoop, LineIndexer(hdfs_con, lc), hdfs_path,
+                                      lc.get_val_by_rem_path(lc.CHK_HDFS, hdfs_path))
+        run_cmd(cmd, local_path, loc_type, remote, opts)
+    finally:
+        lc.close()
+
+
+def run_link_cmd(cmd, remote, opts):
+    codec = codec_of(remote.hdfsPath)
+    if codec is not None:
+        run_decoded_cmd(cmd, DecodedFile(remote.read, codec), opts)     # compressed on HDFS
+        return
+    out = sys.stdout.buffer
+    if cmd == 'head' or (cmd == 'tail' and 'count' not in opts):
+        out.write(remote.head() if cmd == 'head' else remote.tail())
+        out.flush()
+    elif cmd == 'cat':
+        copy_range(remote.read, out, opts['offset'], opts['length'])
+    elif cmd == 'less':
+        page(remote.read)
+    elif cmd == 'wc':
+        res = remote.line_range(0, 0)
+        print(res['lines'], res['size'])
+    else:
+        # line N [COUNT] / tail -n K: a lookup in the line index of the file + a read of the lines
+        first = opts['line'] - 1 if cmd == 'line' else None
+        res = remote.line_range(first, opts['count'])
+        copy_range(remote.read, out, res['offset'], res['length'])
+
+
+def run_cmd(cmd, local_path, loc_type, remote, opts):
+    # if link, only the supported cmds can be executed on HDFS copy
+    # if dir or file, UNIX cmds to be executed locally
+    if loc_type == 'link':
+        if cmd not in SUPPORTED_LINK_CMDS:
+            print(cmd, " not supported for links.\nTry 'mrview.py help' for more information.")
+            sys.exit(1)
+        run_link_cmd(cmd, remote, opts)
+    elif cmd in SUPPORTED_LINK_CMDS and loc_type == 'file' and codec_of(local_path) is not None:
+        # local copy kept compressed
+        with open(local_path, 'rb') as f:
+            run_decoded_cmd(cmd, DecodedFile(local_reader(f), codec_of(local_path)), opts)
+    elif cmd == 'cat' and (opts['offset'] or opts['length'] is not None):
+        # byte range of a local file
+        with open(local_path, 'rb') as f:
+            copy_range(local_reader(f), sys.stdout.buffer, opts['offset'], opts['length'])
+    elif cmd == 'line':
+        os.system("sed -n '%d,%dp' %s" % (opts['line'], opts['line'] + opts['count'] - 1, local_path))
+    elif cmd == 'wc':
+        os.system('wc -l -c ' + local_path)
+    elif cmd == 'tail' and opts:
+        os.system('tail -n %d %s' % (opts['count'], local_path))
+    else:
+        os.system(cmd + ' ' + local_path)
 
 
 def main(argv):
@@ -21,16 +310,27 @@ def main(argv):
         sys.exit(1)
 
     # parse arguments
-    if len(argv) == 0 or len(argv) > 2:
+    if len(argv) == 0:
         print("Wrong number of operands.\nTry 'mrview.py help' for more information.")
         sys.exit(1)
     elif argv[0] == 'help':
         print("mrview.py cmd absolute_file_path")
+        print("mrview.py cat absolute_file_path [--offset N] [--length M]")
+        print("mrview.py line absolute_file_path N [COUNT]")
+        print("mrview.py tail absolute_file_path [-n K]")
         print("Supported link commands: ", *SUPPORTED_LINK_CMDS, sep=',')
         sys.exit(1)
+    elif len(argv) < 2:
+        print("Wrong number of operands.\nTry 'mrview.py help' for more information.")
+        sys.exit(1)
 
     cmd = argv[0]
     file_path = argv[1]
+    try:
+        opts = parse_opts(cmd, argv[2:])
+    except ValueError as e:
+        print(str(e) + "\nTry 'mrview.py help' for more information.")
+        sys.exit(1)
 
     # read from mrbox.conf
     config = configparser.ConfigParser()
@@ -43,33 +343,20 @@ def main(argv):
         print("File does not exist in ", local_folder)
         sys.exit(1)
 
-    # connect to hdfs and create hadoop interface
-    hdfs_con = HDFileSystem(host=config['User']['hdfsHost'], port=config['User'].getint('hdfsPort'))
-    hadoop_path = config['User']['hadoopPath']
-    hadoop = HadoopInterface(hdfs_con, hadoop_path)
-
-    # create sqlite db instance
-    full_db_path = os.path.join(config['User']['localPath'], config['User']['dbFile'])
-    lc = LocalCatalog(full_db_path)
-
-    # need to query db to get type and remote path if link
-    hdfs_path = lc.get_remote_file_path(local_path)
-    loc_type = lc.get_loc_type_by_remote_path(hdfs_path)
-
-    # if link, only the supported cmds can be executed on HDFS copy
-    # if dir or file, UNIX cmds to be executed locally
-    if loc_type == 'link':
-        if cmd not in SUPPORTED_LINK_CMDS:
-            print(cmd, " not supported for links.\nTry 'mrview.py help' for more information.")
-            sys.exit(1)
-        elif cmd == 'head':
-            hadoop.head(hdfs_path)
-        elif cmd == 'tail':
-            hadoop.tail(hdfs_path)
-    else:
-        os.system(cmd + ' ' + local_path)
+    # the running mrbox daemon serves the cmd on its warm HDFS connection + catalog cache
+    socket_path = os.path.join(config['User']['localPath'], config['User'].get('socketFile', fallback=SOCKET_FILE))
+    client = APIClient(socket_path)
+    try:
+        res, _ = client.call('lookup', local_path=local_path)
+    except (ConnectionError, FileNotFoundError):
+        run_standalone(config, cmd, local_path, opts)     # the daemon is not running
+        return
+    try:
+        run_cmd(cmd, local_path, res['type'], DaemonRemote(client, res['hdfs_path']), opts)
+    except APIError as e:
+        print("mrbox daemon error: " + str(e))
+        sys.exit(1)
 
 
 if __name__ == "__main__":
     main(sys.argv[1:])
-
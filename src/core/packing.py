@@ -0,0 +1,197 @@
+import os
+import threading
+import crc32c
+from utils.path_util import customize_path
+
+PACK_PREFIX = 'mrbox-pack-'
+TMP_PREFIX = '.mrbox-tmp.'      # hidden, so not read by the jobs over the dir while a container is compacted
+OLD_PREFIX = '.mrbox-old.'      # the container being replaced by its compacted copy, until the catalog records it
+
+
+class Packer:
+    """
+    Packs the small files of a dir into rolling container files on HDFS, mrbox-pack-00000, mrbox-pack-00001, ...
+    next to them, instead of one HDFS file per small file. A container is the plain concatenation of its files,
+    each followed by a newline if it does not end with one, so that a job over the dir reads the same records as
+    over the separate files. The catalog records the (container, offset, length) of every packed file, which is read
+    back individually from its container.
+    A replaced, moved out or deleted file leaves dead bytes in its container, the container is compacted, i.e.
+    rewritten with its live files only, once they reach compact_ratio of its size, and before a job reads the dir.
+    The old container is moved aside until the compacted one is recorded in the catalog, so that a crash in between
+    loses no file: the compactions that were not recorded are rolled back at start-up.
+    """
+    def __init__(self, hdfs_con, lc, threshold=512 * 1024, container_size=128 * 1024 * 1024, compact_ratio=0.5):
+        """
+        :param hdfs_con: from hdfs3
+        :param lc: LocalCatalog
+        :param threshold: size in bytes under which a file is packed
+        :param container_size: max size in bytes of a container
+        :param compact_ratio: fraction of dead bytes of a container that triggers its compaction
+        """
+        self.hdfsCon = hdfs_con
+        self.lc = lc
+        self.threshold = threshold
+        self.containerSize = container_size
+        self.compactRatio = compact_ratio
+        self._lock = threading.RLock()      # containers are appended to + rewritten by one thread at a time
+        self.recover()
+
+    def should_pack(self, size):
+        return size is not None and size < self.threshold
+
+    def locate(self, hdfs_path):
+        """ :return: dict of the container, offset, length of a packed file, None if not packed """
+        return self.lc.get_packed(hdfs_path)
+
+    def add(self, local_path, hdfs_path):
+        """
+        Appends a local file to a container of its remote dir
+        :return: the crc32c checksum of the file, as the HDFS checksum of a file of its own
+        """
+        with open(local_path, 'rb') as f:
+            data = f.read()
+        self._append(hdfs_path, data)
+        return "%08x" % crc32c.crc32c(data)
+
+    def _append(self, hdfs_path, data):
+        pad = b'\n' if data and not data.endswith(b'\n') else b''
+        with self._lock:
+            container, offset = self._container_for(os.path.dirname(hdfs_path), len(data) + len(pad))
+            with self.hdfsCon.open(container, 'ab' if offset else 'wb') as f:
+                f.write(data + pad)
+            self.lc.set_packed(hdfs_path, container, offset, len(data), len(pad), offset + len(data) + len(pad))
+
+    def _container_for(self, hdfs_dir, nbytes):
+        """ :return: (path, size) of the last container of a dir if the bytes fit in it, else of a new one """
+        containers = self.lc.get_containers(hdfs_dir)
+        if containers and containers[-1]['size'] + nbytes <= self.containerSize:
+            return containers[-1]['container'], containers[-1]['size']
+        i = len(containers)
+        while True:
+            path = customize_path(hdfs_dir, '%s%05d' % (PACK_PREFIX, i))
+            if not self.hdfsCon.exists(path) and not self.lc.check_record_exists(self.lc.HDFS, path):
+                return path, 0
+            i += 1
+
+    def read(self, hdfs_path, offset=0, length=None):
+        """ :return: up to length bytes of a packed file from offset, None if it is not packed """
+        with self._lock:
+            loc = self.locate(hdfs_path)
+            if loc is None:
+                return None
+            if offset >= loc['length']:
+                return b''
+            length = loc['length'] - offset if length is None else min(length, loc['length'] - offset)
+            with self.hdfsCon.open(loc['container'], 'rb') as f:
+                f.seek(loc['offset'] + offset)
+                return f.read(length)
+
+    def replace(self, local_path, hdfs_path):
+        """
+        Packs the new version of a modified packed file, the old one is dead
+        :return: the crc32c checksum of the file, None if it outgrew the threshold and is no longer packed
+        """
+        with self._lock:
+            old = self.locate(hdfs_path)
+            if self.should_pack(os.path.getsize(local_path)):
+                chk = self.add(local_path, hdfs_path)
+            else:
+                self.lc.delete_packed(hdfs_path)
+                chk = None
+            if old is not None:
+                self.maybe_compact(old['container'])
+            return chk
+
+    def moved(self, hdfs_path):
+        """ Repacks a packed file that was moved to another dir into a container of its new dir """
+        with self._lock:
+            old = self.locate(hdfs_path)
+            if old is None or os.path.dirname(old['container']) == os.path.dirname(hdfs_path):
+                return
+            self._append(hdfs_path, self.read(hdfs_path))
+            self.maybe_compact(old['container'])
+
+    def unpack(self, hdfs_path):
+        """ Writes a packed file as a file of its own on HDFS, e.g. as the input of a job """
+        with self._lock:
+            old = self.locate(hdfs_path)
+            if old is None:
+                return
+            with self.hdfsCon.open(hdfs_path, 'wb') as f:
+                f.write(self.read(hdfs_path))
+            self.lc.delete_packed(hdfs_path)
+            self.maybe_compact(old['container'])
+
+    def maybe_compact(self, container):
+        """ Removes a container without live files, compacts it if its dead bytes reach compact_ratio of its size """
+        with self._lock:
+            info = self.lc.get_container(container)
+            if info is None:
+                return
+            if info['live'] == 0:
+                print("removing empty container " + container)
+                if self.hdfsCon.exists(container):
+                    self.hdfsCon.rm(container)
+                self.lc.delete_container(container)
+            elif info['size'] - info['live'] >= self.compactRatio * info['size']:
+                self.compact(container)
+
+    @staticmethod
+    def old_path(container):
+        return customize_path(os.path.dirname(container), OLD_PREFIX + os.path.basename(container))
+
+    def recover(self):
+        """ Rolls back / finishes the compactions interrupted by a crash, by the containers moved aside """
+        with self._lock:
+            for info in self.lc.get_containers_in_subtree('/'):
+                self._recover(info)
+
+    def _recover(self, info):
+        container, old = info['container'], self.old_path(info['container'])
+        if not self.hdfsCon.exists(old):
+            return
+        # a compacted container is smaller than the old one, whose size the catalog has until it records the new one
+        if self.hdfsCon.info(old)['size'] == info['size']:
+            print("restoring container " + container + ", its compaction was interrupted")
+            if self.hdfsCon.exists(container):
+                self.hdfsCon.rm(container)
+            self.hdfsCon.mv(old, container)
+        else:
+            self.hdfsCon.rm(old)
+
+    def compact(self, container):
+        """
+        Rewrites a container with its live files only, to a temp file that is renamed over it once the old one is
+        moved aside, the offsets of its files are updated in one transaction before the old one is removed
+        """
+        with self._lock:
+            members = self.lc.get_container_members(container)
+            if not members:
+                self.maybe_compact(container)
+                return
+            tmp_path = customize_path(os.path.dirname(container), TMP_PREFIX + os.path.basename(container))
+            offsets, pos = {}, 0
+            with self.hdfsCon.open(container, 'rb') as src, self.hdfsCon.open(tmp_path, 'wb') as dest:
+                for hdfs_path, offset, length in members:
+                    src.seek(offset)
+                    data = src.read(length)
+                    if data and not data.endswith(b'\n'):
+                        data += b'\n'
+                    dest.write(data)
+                    offsets[hdfs_path] = pos
+                    pos += len(data)
+            old_path = self.old_path(container)
+            if self.hdfsCon.exists(old_path):
+                self.hdfsCon.rm(old_path)   # of a compaction that was recorded
+            self.hdfsCon.mv(container, old_path)    # HDFS rename does not overwrite
+            self.hdfsCon.mv(tmp_path, container)
+            self.lc.replace_container(container, offsets, pos)
+            self.hdfsCon.rm(old_path)
+            print("compacted %s: %d files, %d bytes" % (container, len(members), pos))
+
+    def compact_subtree(self, hdfs_path):
+        """ Compacts every container with dead bytes under a remote dir, so that a job over it reads no dead files """
+        with self._lock:
+            for info in self.lc.get_containers_in_subtree(hdfs_path):
+                if info['live'] < info['size']:
+                    self.compact(info['container'])
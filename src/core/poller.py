@@ -0,0 +1,295 @@
+import os
+import shutil
+import hashlib
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from core.mrbox_object import MRBoxObject
+from core.job_scheduler import QUEUED, RUNNING, FETCHING
+from core.packing import PACK_PREFIX
+from utils.file_util import crc32c_file_checksum
+from utils.path_util import customize_path
+
+SKIP = ('.', '_', PACK_PREFIX)     # temp files, job markers + containers are not synced as files
+
+
+def listing_fingerprint(metas):
+    """ :return: a hash of the (name, kind, size, mtime) of the entries of a dir listing """
+    h = hashlib.sha1()
+    for m in sorted(metas, key=lambda m: m['path']):
+        h.update(('%s\0%s\0%d\0%d\n' % (os.path.basename(m['path']), m['kind'], m['size'], m['mtime'])).encode())
+    return h.hexdigest()
+
+
+class RemotePoller(threading.Thread):
+    """
+    Brings the local /mrbox folder up to date with the changes made directly on HDFS under the remote folder.
+    Every poll stats the synced dirs concurrently, one call per dir and no listing, and only lists the dirs whose
+    mtime changed since the last poll, i.e. whose entries were added, removed or renamed. A listing with the same
+    fingerprint as the previous one is not compared further. The files of a listed dir are compared with the catalog:
+    new files are fetched or linked by the size limit of MRBoxObject. A file whose size or mtime on HDFS differs from
+    the ones recorded at its last upload / fetch is fetched again if its checksum changed too, or only its checksum is
+    updated for links. An entry that is gone is removed locally once it is still missing at the next poll, so that the
+    rename of a file replaced by mrbox is not taken for a delete.
+    Files modified in place, e.g. appended to, do not change the mtime of their dir: all the dirs are listed every
+    full_scan_every polls.
+    The outputs of the queued + running jobs are fetched by the JobScheduler, they are skipped.
+    """
+    def __init__(self, local_dir, hadoop, lc, interval=30, full_scan_every=20, workers=8, wait_for=None):
+        """
+        :param local_dir: MRBoxObject of the local /mrbox folder
+        :param hadoop: HadoopInterface
+        :param lc: LocalCatalog
+        :param interval: secs between two polls
+        :param full_scan_every: number of polls between two listings of all the dirs, 0 for never
+        :param workers: number of dirs stat'ed concurrently
+        :param wait_for: thread that must finish before the first poll, e.g. the Reconciler
+        """
+        super().__init__(name='remote-poller', daemon=True)
+        self.local = local_dir
+        self.hadoop = hadoop
+        self.lc = lc
+        self.interval = interval
+        self.fullScanEvery = full_scan_every
+        self.workers = workers
+        self.waitFor = wait_for
+        self.ops = {'fetched': 0, 'linked': 0, 'updated': 0, 'deleted': 0}
+        self._missing = set()       # remote paths found missing once, removed locally if still missing
+        self._recheck = set()       # remote dirs listed again at the next poll
+        self._stopped = threading.Event()
+
+    def run(self):
+        if self.waitFor is not None:
+            self.waitFor.join()
+        polls = 0
+        while not self._stopped.wait(self.interval):
+            polls += 1
+            try:
+                self.poll(full=bool(self.fullScanEvery) and polls % self.fullScanEvery == 0)
+            except Exception as e:
+                print("Remote poll failed: " + repr(e))
+
+    def stop(self):
+        self._stopped.set()
+
+    @staticmethod
+    def skipped(name):
+        return name.startswith(SKIP)
+
+    @staticmethod
+    def excluded(hdfs_path, outputs):
+        return any(hdfs_path == o or hdfs_path.startswith(o.rstrip('/') + '/') for o in outputs)
+
+    def _mtime(self, hdfs_dir):
+        try:
+            return self.hadoop.metadata.stat(hdfs_dir)['mtime']
+        except (IOError, OSError):
+            return None     # removed, seen in the listing of its parent
+
+    def poll(self, full=False):
+        """ :param full: if True every dir is listed, else only the dirs whose mtime changed """
+        outputs = {row['hdfs_output'] for row in self.lc.get_jobs([QUEUED, RUNNING, FETCHING])
+                   if row['hdfs_output']}
+        dirs = self.lc.get_remote_dirs()
+        dirs[self.local.remotePath] = (self.local.localPath,) + self.lc.get_remote_dir(self.local.remotePath)
+        dirs = {rp: v for rp, v in dirs.items() if not self.excluded(rp, outputs)}
+        with ThreadPoolExecutor(max_workers=self.workers) as executor:
+            mtimes = dict(zip(dirs, executor.map(self._mtime, dirs)))
+        queue = deque((rp, dirs[rp][0], mtime, dirs[rp][2]) for rp, mtime in mtimes.items()
+                      if mtime is not None and (full or mtime != dirs[rp][1] or rp in self._recheck))
+        listed = len(queue)
+        while queue:
+            new_dirs = self.sync_dir(*queue.popleft(), outputs=outputs)
+            listed += len(new_dirs)
+            queue.extend(new_dirs)
+        if listed:
+            print("Remote poll: %d dirs stat'ed, %d listed, %s" % (len(dirs), listed, self.ops))
+
+    def sync_dir(self, hdfs_dir, local_dir, mtime, fingerprint, outputs=()):
+        """
+        Compares the listing of a remote dir with the catalog and applies the differences locally
+        :param mtime: the mtime of the dir before it is listed, stored with its new fingerprint
+        :param fingerprint: the fingerprint of its previous listing, None if never listed
+        :return: list of (remote path, local path, mtime, fingerprint) of the new subdirs, to be synced too
+        """
+        metas = [m for m in self.hadoop.metadata.stat_dir(hdfs_dir)
+                 if not self.skipped(os.path.basename(m['path'].rstrip('/')))]
+        new_fingerprint = listing_fingerprint(metas)
+        if new_fingerprint == fingerprint and hdfs_dir not in self._recheck:
+            self.lc.set_remote_dir(hdfs_dir, mtime, new_fingerprint)
+            return []
+        listed = {os.path.basename(m['path'].rstrip('/')): m for m in metas}
+        children = self.lc.get_remote_children(hdfs_dir)
+        new_dirs, fetched, changed = [], [], []
+
+        for name, meta in sorted(listed.items()):
+            rp = customize_path(hdfs_dir, name)
+            self._missing.discard(rp)
+            if self.excluded(rp, outputs):
+                continue
+            row = children.get(name)
+            if row is None:
+                if self.lc.check_record_exists(self.lc.HDFS, rp):
+                    continue        # created locally, its tuple is still buffered
+                if meta['kind'] == 'dir':
+                    lp = self.create_dir(customize_path(local_dir, name), rp)
+                    if lp is not None:
+                        new_dirs.append((rp, lp, meta['mtime'], None))
+                else:
+                    obj = MRBoxObject(customize_path(local_dir, name), self.local.localFileLimit, rp, meta['size'],
+                                      'file')
+                    if not obj.existsLoc and not os.path.exists(obj.localPath):
+                        fetched.append((obj, meta))
+            elif meta['kind'] == 'file' and row[self.lc.TYPE_LOC] in ('file', 'link') \
+                    and row[self.lc.CHK_HDFS] is not None \
+                    and (meta['size'], meta['mtime']) != (row[self.lc.SIZE_HDFS], row[self.lc.MTIME_HDFS]):
+                changed.append((row, rp, meta))
+
+        # files removed on HDFS, the ones still being uploaded have no HDFS checksum yet
+        recheck = False
+        for name, row in children.items():
+            rp = customize_path(hdfs_dir, name)
+            if name in listed or self.skipped(name) or row['packed'] or self.excluded(rp, outputs) \
+                    or (row[self.lc.TYPE_LOC] != 'dir' and row[self.lc.CHK_HDFS] is None):
+                continue
+            if rp in self._missing:
+                self._missing.discard(rp)
+                self.delete_local(row[self.lc.LOC])
+            else:
+                self._missing.add(rp)
+                recheck = True
+
+        self.fetch_new(fetched)
+        self.fetch_changed(changed)
+        if recheck:
+            self._recheck.add(hdfs_dir)
+        else:
+            self._recheck.discard(hdfs_dir)
+            self.lc.set_remote_dir(hdfs_dir, mtime, new_fingerprint)
+        return new_dirs
+
+    def create_dir(self, local_path, hdfs_path):
+        """ Creates the local copy of a dir created on HDFS, its tuple first so that its event finds it """
+        if os.path.exists(local_path):
+            return None
+        self.lc.insert_tuples_hdfs([(local_path, hdfs_path, None, 'dir')])
+        os.mkdir(local_path)
+        return local_path
+
+    def fetch_new(self, fetched):
+        """ Fetches / links the files created on HDFS, as the outputs of a job in sync_remote_dir """
+        if not fetched:
+            return
+        self.lc.insert_tuples_hdfs([(obj.localPath, obj.remotePath, None, obj.localType) for obj, _ in fetched])
+        transfers = [t for t in (self.hadoop.get_async(obj, self.record_fetched(obj.localPath, obj.remotePath, meta))
+                                 for obj, meta in fetched) if t is not None]
+        for obj, meta in fetched:
+            if obj.is_link():
+                self.hadoop.record_link(self.lc, obj.localPath, obj.remotePath, meta,
+                                        self.hadoop.checksum(obj.remotePath, 'file', meta))
+        if self.hadoop.transfers is not None:
+            self.hadoop.transfers.wait_all(transfers)
+        for obj, _ in fetched:
+            self.ops['linked' if obj.is_link() else 'fetched'] += 1
+
+    def fetch_changed(self, changed):
+        """
+        Fetches again the files modified on HDFS, unless they were also modified locally since their last sync.
+        The size + mtime of the files whose checksum did not change are recorded, e.g. of the rows of an older schema
+        """
+        refetched = []
+        for row, rp, meta in changed:
+            lp = row[self.lc.LOC]
+            chk = self.hadoop.checksum(rp, 'file', meta)
+            if chk == row[self.lc.CHK_HDFS]:
+                self.lc.update_tuple_hdfs(lp, chk, meta['size'], meta['mtime'])
+                continue        # rewritten with the same content
+            if row[self.lc.TYPE_LOC] == 'link':
+                self.hadoop.record_link(self.lc, lp, rp, meta, chk)
+                self.ops['updated'] += 1    # the link reads the new version
+                continue
+            try:
+                st = os.stat(lp)
+            except FileNotFoundError:
+                continue
+            if (st.st_size, st.st_mtime_ns) != (row[self.lc.SIZE_LOC], row[self.lc.MTIME_LOC]):
+                print("Conflict on " + lp + ": modified locally + on HDFS, the local copy is uploaded")
+                self.lc.update_tuple_hdfs(lp, chk, meta['size'], meta['mtime'])
+                continue
+            obj = MRBoxObject(lp, self.local.localFileLimit, rp, meta['size'], 'file')
+            refetched.append(self.hadoop.get_async(obj, self.record_fetched(lp, rp, meta)))
+        if self.hadoop.transfers is not None:
+            self.hadoop.transfers.wait_all([t for t in refetched if t is not None])
+        self.ops['updated'] += len(refetched)
+
+    def record_fetched(self, local_path, hdfs_path, meta):
+        """
+        :return: the callback that records the state of a fetched file in the catalog, called once the file is
+        complete but before it is moved to its local path, so that its event finds it in sync and does not upload it
+        """
+        def record(staged_path, hdfs_chk, local_chk):
+            st = os.stat(staged_path)       # the rename keeps the size + mtime
+            self.lc.update_tuple_hdfs(local_path, self.hadoop.fetched_checksum(hdfs_path, meta, hdfs_chk),
+                                      meta['size'], meta['mtime'])
+            if local_chk is None:
+                local_chk = crc32c_file_checksum(staged_path, 'file')
+            self.lc.update_tuple_local(local_path, local_chk, st.st_size, st.st_mtime_ns)
+        return record
+
+    def modified_locally(self, local_path):
+        """
+        :return: set of the local files at or under local_path that changed since their last sync or that were
+        never synced, e.g. ignored, which are kept when their copy on HDFS is removed
+        """
+        states = self.lc.get_subtree_states(local_path)
+        if os.path.isdir(local_path):
+            paths = [os.path.join(root, name) for root, _, files in os.walk(local_path) for name in files]
+        else:
+            paths = [local_path] if os.path.lexists(local_path) else []
+        kept = set()
+        for path in paths:
+            state = states.get(path)
+            if state is None:
+                kept.add(path)
+                continue
+            if state[0] != 'file':
+                continue        # links are only fetched
+            try:
+                st = os.stat(path)
+            except FileNotFoundError:
+                continue
+            if (st.st_size, st.st_mtime_ns) != tuple(state[1:]):
+                kept.add(path)
+        return kept
+
+    def delete_local(self, local_path):
+        """
+        Removes the local copy of a file / dir removed on HDFS, its tuples first so that its event is a no-op.
+        The files modified locally since their last sync are kept, out of sync, so that their event uploads them again
+        """
+        kept = self.modified_locally(local_path)
+        if not kept:
+            print("removed on hdfs: " + local_path)
+            self.lc.delete_subtree(local_path)
+            try:
+                if os.path.isdir(local_path):
+                    shutil.rmtree(local_path)
+                else:
+                    os.remove(local_path)
+            except FileNotFoundError:
+                pass
+            self.ops['deleted'] += 1
+            return
+        for path in sorted(kept):
+            print("Conflict on " + path + ": removed on HDFS + changed locally since its last sync, it is kept")
+            if self.lc.check_local_path_exists(path):
+                self.lc.update_tuple_hdfs(path, None)
+        if not os.path.isdir(local_path):
+            return
+        for root, _, files in os.walk(local_path, topdown=False):
+            for name in files:
+                path = os.path.join(root, name)
+                if path not in kept:
+                    self.delete_local(path)
+            if not any(path.startswith(root + '/') for path in kept):
+                self.delete_local(root)
@@ -0,0 +1,128 @@
+import os
+import time
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from watchdog.events import FileCreatedEvent, DirCreatedEvent, FileModifiedEvent, FileDeletedEvent, \
+    DirDeletedEvent
+
+
+class Reconciler(threading.Thread):
+    """
+    Brings HDFS + the catalog up to date with the changes made in the local /mrbox folder while mrbox was not running.
+    Runs in the background at start-up: the local folder is scanned with parallel os.scandir calls, and only the files
+    whose (size, mtime) differ from the catalog are hashed again. The remote tree is listed once.
+    The resulting operations are emitted as watchdog events into the event queue, where they are coalesced with the
+    live events.
+    """
+    def __init__(self, local_dir, hadoop, lc, hash_pool, dispatch, workers=8):
+        """
+        :param local_dir: MRBoxObject of the local /mrbox folder
+        :param hadoop: HadoopInterface
+        :param lc: LocalCatalog
+        :param hash_pool: ChecksumPool to hash the changed files
+        :param dispatch: callable that takes a watchdog event, e.g. EventQueue.dispatch
+        :param workers: number of dirs listed concurrently, locally and on hdfs
+        """
+        super().__init__(name='reconciler', daemon=True)
+        self.local = local_dir
+        self.hadoop = hadoop
+        self.lc = lc
+        self.hashPool = hash_pool
+        self.dispatch = dispatch
+        self.workers = workers
+        self.ops = {'created': 0, 'modified': 0, 'deleted': 0, 'touched': 0}
+
+    def run(self):
+        start = time.monotonic()
+        try:
+            self.reconcile()
+        except Exception as e:
+            print("Reconciliation failed: " + repr(e))
+            return
+        print("Reconciliation done in %.1f secs: %s" % (time.monotonic() - start, self.ops))
+
+    @staticmethod
+    def scan_parallel(root, list_dir, workers):
+        """
+        Lists a tree breadth first, listing the dirs of each level concurrently
+        :param list_dir: callable that returns a list of (path, is_dir, info) of the entries of a dir
+        :return: dict of path -> (is_dir, info) of all the entries under root
+        """
+        entries = {}
+        level = [root]
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            while level:
+                next_level = []
+                for listing in executor.map(list_dir, level):
+                    for path, is_dir, info in listing:
+                        entries[path] = (is_dir, info)
+                        if is_dir:
+                            next_level.append(path)
+                level = next_level
+        return entries
+
+    @staticmethod
+    def list_local_dir(path):
+        try:
+            with os.scandir(path) as it:
+                ret = []
+                for entry in it:
+                    st = entry.stat(follow_symlinks=False)
+                    ret.append((entry.path, entry.is_dir(follow_symlinks=False), (st.st_size, st.st_mtime_ns)))
+                return ret
+        except FileNotFoundError:
+            return []
+
+    def list_remote_dir(self, path):
+        return [(m['path'], m['kind'] == 'dir', m) for m in self.hadoop.metadata.stat_dir(path)]
+
+    def reconcile(self):
+        local = self.scan_parallel(self.local.localPath, self.list_local_dir, self.workers)
+        remote = self.scan_parallel(self.local.remotePath, self.list_remote_dir, self.workers)
+        catalog = self.lc.get_local_states()
+        print("Reconciling %d local entries, %d remote entries, %d catalog tuples"
+              % (len(local), len(remote), len(catalog)))
+
+        # deleted while down: only the topmost deleted path, the handling of a dir delete covers its subtree
+        for lp in sorted(catalog):
+            if lp == self.local.localPath or lp in local:
+                continue
+            parent = os.path.dirname(lp)
+            if parent in catalog and parent not in local and parent != self.local.localPath:
+                continue
+            row = catalog[lp]
+            self.emit(DirDeletedEvent(lp) if row[self.lc.TYPE_LOC] == 'dir' else FileDeletedEvent(lp), 'deleted')
+
+        # created while down or never synced
+        changed = []
+        for lp in sorted(local):
+            is_dir, (size, mtime) = local[lp]
+            row = catalog.get(lp)
+            if row is None:
+                self.emit(DirCreatedEvent(lp) if is_dir else FileCreatedEvent(lp), 'created')
+            elif row[self.lc.HDFS] not in remote and not self.lc.is_packed(row[self.lc.HDFS]):
+                # lost on HDFS, uploaded / created again, packed files are in the containers of their dir
+                if not is_dir:
+                    self.lc.update_tuple_hdfs(lp, None)     # out of sync, so that it is not skipped as unchanged
+                self.emit(DirCreatedEvent(lp) if is_dir else FileModifiedEvent(lp), 'modified')
+            elif not is_dir and row[self.lc.TYPE_LOC] == 'file' \
+                    and (row[self.lc.SIZE_LOC], row[self.lc.MTIME_LOC]) != (size, mtime):
+                changed.append((lp, size, mtime, row))
+
+        # only the files with a different (size, mtime) are hashed, concurrently
+        futures = [(lp, size, mtime, row, self.hashPool.submit(lp, 'file', size)) for lp, size, mtime, row in changed]
+        for lp, size, mtime, row, future in futures:
+            try:
+                chk = future.result()
+            except FileNotFoundError:
+                continue        # deleted since, handled by the live events
+            if chk != row[self.lc.CHK_LOC] or chk != row[self.lc.CHK_HDFS]:
+                self.emit(FileModifiedEvent(lp), 'modified')
+            else:
+                # touched but not changed
+                self.lc.update_tuple_local(lp, chk, size, mtime)
+                self.ops['touched'] += 1
+
+    def emit(self, event, op):
+        self.ops[op] += 1
+        self.dispatch(event)
@@ -0,0 +1,406 @@
+import os
+import time
+import threading
+import uuid
+import crc32c
+from collections import OrderedDict, deque
+from concurrent.futures import Future
+from core.codec import read_chunks, transcode
+from utils.file_util import crc32c_combine
+
+MB = 1024 * 1024
+# priority classes of the transfers, a class is only served when the classes before it have nothing pending
+PRIORITY_JOB = 0        # inputs of a job that was issued
+PRIORITY_SMALL = 1
+PRIORITY_NORMAL = 2
+PRIORITY_BULK = 3
+PRIORITIES = (PRIORITY_JOB, PRIORITY_SMALL, PRIORITY_NORMAL, PRIORITY_BULK)
+HOT_SECS = 600          # how long the new transfers under the input of an issued job keep the job priority
+
+
+class TokenBucket:
+    """
+    Bandwidth limit of a direction, shared by all its streams: every read / write takes its bytes from the bucket,
+    which is refilled at `rate` bytes per sec up to `burst` bytes, and waits while the bucket is in debt.
+    The limit may only apply in some hours of the day, e.g. the business hours of a shared uplink.
+    """
+    def __init__(self, rate, burst=None, hours=None, weekdays_only=False):
+        """
+        :param rate: bytes per sec, 0 for no limit
+        :param burst: max bytes taken at once without waiting, one sec of rate by default
+        :param hours: (start, end) hours of the day, local time, in which the limit applies, None for all day
+        :param weekdays_only: if True the limit does not apply on saturdays + sundays
+        """
+        self.rate = rate
+        self.burst = burst or rate
+        self.hours = hours
+        self.weekdaysOnly = weekdays_only
+        self._lock = threading.Lock()
+        self._tokens = self.burst
+        self._last = time.monotonic()
+
+    def active(self, now=None):
+        """ :return: True if the limit applies at the time now (epoch secs, current time if None) """
+        if not self.rate:
+            return False
+        t = time.localtime(now)
+        if self.weekdaysOnly and t.tm_wday >= 5:
+            return False
+        if self.hours is None:
+            return True
+        start, end = self.hours
+        return start <= t.tm_hour < end if start <= end else (t.tm_hour >= start or t.tm_hour < end)
+
+    def consume(self, n):
+        """ Takes n bytes from the bucket, sleeps until they are covered by the rate if it is in debt """
+        if not self.active():
+            return
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(self.burst, self._tokens + (now - self._last) * self.rate)
+            self._last = now
+            self._tokens -= n
+            wait = -self._tokens / self.rate if self._tokens < 0 else 0
+        if wait > 0:
+            time.sleep(wait)
+
+
+class TransferQueue:
+    """
+    The streams of the transfer engine: the pending tasks are run by priority class, and within a class round robin
+    across their dirs, so that a bulk copy into one dir does not hold back the transfers of the others.
+    """
+    def __init__(self, streams):
+        self._cond = threading.Condition()
+        self._queues = [OrderedDict() for _ in PRIORITIES]     # per class: dir -> deque of its pending tasks
+        self._stopping = False
+        self._threads = [threading.Thread(target=self._work, name='transfer-%d' % i, daemon=True)
+                         for i in range(streams)]
+        for t in self._threads:
+            t.start()
+
+    def submit(self, priority, local_path, fn, *args):
+        """
+        :param local_path: the local path of the file, its dir is the share of the task
+        :return: a Future of fn(*args)
+        """
+        future = Future()
+        task = (future, local_path, fn, args)
+        with self._cond:
+            self._queues[priority].setdefault(os.path.dirname(local_path), deque()).append(task)
+            self._cond.notify()
+        return future
+
+    def prioritize(self, prefix, priority):
+        """ Moves the pending tasks of the local paths under prefix up to the priority class """
+        with self._cond:
+            for queues in self._queues[priority + 1:]:
+                for d in list(queues):
+                    tasks = queues[d]
+                    moved = [t for t in tasks if t[1] == prefix or t[1].startswith(prefix + '/')]
+                    if not moved:
+                        continue
+                    for t in moved:
+                        tasks.remove(t)
+                    if not tasks:
+                        del queues[d]
+                    self._queues[priority].setdefault(d, deque()).extend(moved)
+
+    def pending(self):
+        """ :return: list of the number of pending tasks per priority class """
+        with self._cond:
+            return [sum(len(tasks) for tasks in queues.values()) for queues in self._queues]
+
+    def _next(self):
+        for queues in self._queues:
+            if queues:
+                d, tasks = queues.popitem(last=False)
+                task = tasks.popleft()
+                if tasks:
+                    queues[d] = tasks       # to the end of the round
+                return task
+        return None
+
+    def _work(self):
+        while True:
+            with self._cond:
+                task = self._next()
+                while task is None:
+                    if self._stopping:
+                        return
+                    self._cond.wait()
+                    task = self._next()
+            future, _, fn, args = task
+            if not future.set_running_or_notify_cancel():
+                continue
+            try:
+                future.set_result(fn(*args))
+            except BaseException as e:
+                future.set_exception(e)
+
+    def shutdown(self, wait=True):
+        """ Runs the pending tasks and stops the streams """
+        with self._cond:
+            self._stopping = True
+            self._cond.notify_all()
+        if wait:
+            for t in self._threads:
+                t.join()
+
+
+class TransferProgress:
+    """ Bytes and files moved by the transfer engine, per direction """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.bytes = {'up': 0, 'down': 0}
+        self.files = {'up': 0, 'down': 0}
+        self.retries = 0
+        self.started = time.monotonic()
+
+    def add_bytes(self, direction, n):
+        with self._lock:
+            self.bytes[direction] += n
+
+    def add_file(self, direction):
+        with self._lock:
+            self.files[direction] += 1
+
+    def add_retry(self):
+        with self._lock:
+            self.retries += 1
+
+    def report(self):
+        elapsed = max(time.monotonic() - self.started, 1e-6)
+        with self._lock:
+            return "up: %d files / %.1f MB, down: %d files / %.1f MB, %.1f MB/s, %d retries" % (
+                self.files['up'], self.bytes['up'] / MB, self.files['down'], self.bytes['down'] / MB,
+                (self.bytes['up'] + self.bytes['down']) / MB / elapsed, self.retries)
+
+
+class Transfer:
+    """ A file transfer in progress, split in one or more chunk tasks """
+    def __init__(self, src, dest, futures, on_done=None, on_fail=None):
+        self.src = src
+        self.dest = dest
+        self.futures = futures
+        self.onDone = on_done
+        self.onFail = on_fail
+
+    def result(self):
+        """ Waits for all the chunks of the transfer, raises the error of the first failed chunk """
+        errors = [f.exception() for f in self.futures]
+        errors = [e for e in errors if e is not None]
+        if errors:
+            if self.onFail is not None:
+                self.onFail()
+                self.onFail = None
+            raise errors[0]
+        if self.onDone is not None:
+            self.onDone()
+            self.onDone = None
+
+
+class TransferEngine:
+    """
+    Moves files between the local fs and HDFS on a pool of concurrent streams through hdfs3, with large buffers.
+    Transfers are scheduled by priority class: the inputs of issued jobs first, then small files, then the others,
+    files over bulk_size last, and share the streams fairly across dirs, see TransferQueue. The bytes of each direction
+    may be capped by a TokenBucket.
+    Downloads are split in chunks of chunk_size that are read in parallel, each with its own seek on HDFS, and
+    written in place into a staging file that is renamed to its final path once complete, so that the observer
+    sees a single created event of the whole file. The CRC32C of every chunk is computed as it is read and the chunk
+    CRCs are combined, so that the checksum of a fetched file needs no second read of it.
+    Uploads are streamed per file, as HDFS files have a single writer.
+    A file that is compressed / decompressed on the way is streamed in a single task.
+    A failed chunk (or upload) is retried up to `retries` times.
+    """
+    def __init__(self, hdfs_con, staging_dir, streams=4, chunk_size=64 * MB, buffer_size=4 * MB, retries=3,
+                 limits=None, small_size=MB, bulk_size=256 * MB):
+        """
+        :param hdfs_con: from hdfs3
+        :param staging_dir: local dir for partial downloads, on the same fs as the /mrbox folder but outside it
+        :param streams: number of concurrent reads / writes on HDFS
+        :param chunk_size: size in bytes of the chunks that a download is split into
+        :param buffer_size: size in bytes of every read / write call
+        :param retries: attempts of a failed chunk after the first one
+        :param limits: dict of 'up' / 'down' -> TokenBucket of the direction, a direction without one is not limited
+        :param small_size: size in bytes up to which a file has the small file priority
+        :param bulk_size: size in bytes from which a file has the bulk priority
+        """
+        self.hdfsCon = hdfs_con
+        self.stagingDir = staging_dir
+        self.chunkSize = chunk_size
+        self.bufferSize = buffer_size
+        self.retries = retries
+        self.limits = limits or {}
+        self.smallSize = small_size
+        self.bulkSize = bulk_size
+        self.progress = TransferProgress()
+        self.executor = TransferQueue(streams)
+        self._hot = {}      # local prefix -> monotonic time until which its new transfers have the job priority
+        self._hot_lock = threading.Lock()
+        os.makedirs(self.stagingDir, exist_ok=True)
+
+    def priority(self, local_path, size):
+        """ :return: the priority class of the transfer of a file of size bytes """
+        now = time.monotonic()
+        with self._hot_lock:
+            for prefix, until in list(self._hot.items()):
+                if until < now:
+                    del self._hot[prefix]
+                elif local_path == prefix or local_path.startswith(prefix + '/'):
+                    return PRIORITY_JOB
+        if size is not None and size <= self.smallSize:
+            return PRIORITY_SMALL
+        if size is not None and size >= self.bulkSize:
+            return PRIORITY_BULK
+        return PRIORITY_NORMAL
+
+    def prioritize(self, local_prefix):
+        """
+        Gives the job priority to the pending transfers under a local path, e.g. the input of a job that was issued,
+        and to its new transfers for HOT_SECS
+        """
+        local_prefix = local_prefix.rstrip('/')
+        with self._hot_lock:
+            self._hot[local_prefix] = time.monotonic() + HOT_SECS
+        self.executor.prioritize(local_prefix, PRIORITY_JOB)
+
+    def _throttle(self, direction, n):
+        limit = self.limits.get(direction)
+        if limit is not None:
+            limit.consume(n)
+
+    def _with_retries(self, fn, *args):
+        attempt = 0
+        while True:
+            try:
+                return fn(*args)
+            except Exception as e:
+                if attempt >= self.retries:
+                    raise
+                attempt += 1
+                self.progress.add_retry()
+                print("Transfer failed (%s), retry %d of %d" % (repr(e), attempt, self.retries))
+                time.sleep(min(2 ** attempt, 30))
+
+    def upload(self, local_path, hdfs_path, codec=None, encode=True):
+        """
+        :param codec: Codec that the file is encoded with on the way if encode, else decoded with, optional
+        :return: a Transfer uploading local_path to hdfs_path, overwriting hdfs_path if it exists
+        """
+        priority = self.priority(local_path, os.path.getsize(local_path))
+        future = self.executor.submit(priority, local_path, self._with_retries, self._upload, local_path, hdfs_path,
+                                      codec, encode)
+        return Transfer(local_path, hdfs_path, [future])
+
+    def _upload(self, local_path, hdfs_path, codec=None, encode=True):
+        done = 0
+        with open(local_path, 'rb') as lf, self.hdfsCon.open(hdfs_path, 'wb', buff=self.bufferSize) as hf:
+            for buf in transcode(read_chunks(lf, self.bufferSize), codec, encode):
+                self._throttle('up', len(buf))
+                hf.write(buf)
+                done += len(buf)
+        self.progress.add_bytes('up', done)
+        self.progress.add_file('up')
+
+    def staging_path(self):
+        """ :return: a new path in the staging dir, for a file that is renamed into /mrbox once complete """
+        return os.path.join(self.stagingDir, uuid.uuid4().hex)
+
+    def download(self, hdfs_path, local_path, size=None, codec=None, encode=True, on_staged=None):
+        """
+        :param size: size of the HDFS file in bytes if already known
+        :param codec: Codec that the file is encoded with on the way if encode, else decoded with, optional
+        :param on_staged: called with (staging path, CRC32C of the bytes read from HDFS, CRC32C of the bytes written
+        locally) as hex strs once the file is complete, before it is renamed to local_path, e.g. to record its state
+        in the catalog so that its event finds it in sync
+        :return: a Transfer downloading hdfs_path to local_path
+        """
+        staging_path = self.staging_path()
+        if size is None:
+            size = self.hdfsCon.info(hdfs_path)['size']
+        priority = self.priority(local_path, size)
+        lengths = []
+        if codec is not None:
+            futures = [self.executor.submit(priority, local_path, self._with_retries, self._download_stream,
+                                            hdfs_path, staging_path, codec, encode)]
+        else:
+            with open(staging_path, 'wb') as f:
+                f.truncate(size)
+            lengths = [min(self.chunkSize, size - offset) for offset in range(0, size, self.chunkSize)]
+            futures = [self.executor.submit(priority, local_path, self._with_retries, self._download_chunk,
+                                            hdfs_path, staging_path, offset, length)
+                       for offset, length in zip(range(0, size, self.chunkSize), lengths)]
+
+        def finish():
+            if on_staged is not None:
+                if codec is not None:
+                    hdfs_crc, local_crc = futures[0].result()
+                else:
+                    hdfs_crc = 0
+                    for f, length in zip(futures, lengths):
+                        hdfs_crc = crc32c_combine(hdfs_crc, f.result(), length)
+                    local_crc = hdfs_crc
+                on_staged(staging_path, "%08x" % hdfs_crc, "%08x" % local_crc)
+            os.replace(staging_path, local_path)
+            self.progress.add_file('down')
+
+        def cleanup():
+            if os.path.exists(staging_path):
+                os.remove(staging_path)
+        return Transfer(hdfs_path, local_path, futures, finish, cleanup)
+
+    def _download_chunk(self, hdfs_path, staging_path, offset, length):
+        """ :return: the CRC32C of the chunk """
+        crc = 0
+        fd = os.open(staging_path, os.O_WRONLY)
+        try:
+            with self.hdfsCon.open(hdfs_path, 'rb', buff=self.bufferSize) as hf:
+                hf.seek(offset)
+                pos = offset
+                end = offset + length
+                while pos < end:
+                    self._throttle('down', min(self.bufferSize, end - pos))
+                    buf = hf.read(min(self.bufferSize, end - pos))
+                    if not buf:
+                        raise IOError("Unexpected end of %s at byte %d" % (hdfs_path, pos))
+                    os.pwrite(fd, buf, pos)
+                    crc = crc32c.crc32c(buf, crc)
+                    pos += len(buf)
+        finally:
+            os.close(fd)
+        self.progress.add_bytes('down', length)
+        return crc & 0xFFFFFFFF
+
+    def _download_stream(self, hdfs_path, staging_path, codec, encode):
+        """ :return: (CRC32C of the bytes read from HDFS, CRC32C of the bytes written locally) """
+        crcs = [0, 0]
+        with self.hdfsCon.open(hdfs_path, 'rb', buff=self.bufferSize) as hf, open(staging_path, 'wb') as lf:
+            for buf in transcode(self._throttled_chunks(hf, crcs), codec, encode):
+                lf.write(buf)
+                crcs[1] = crc32c.crc32c(buf, crcs[1])
+            self.progress.add_bytes('down', hf.tell())     # bytes read from HDFS
+        return crcs[0] & 0xFFFFFFFF, crcs[1] & 0xFFFFFFFF
+
+    def _throttled_chunks(self, hf, crcs):
+        """ :param crcs: list whose first item is updated with the CRC32C of the bytes read """
+        for buf in read_chunks(hf, self.bufferSize):
+            self._throttle('down', len(buf))
+            crcs[0] = crc32c.crc32c(buf, crcs[0])
+            yield buf
+
+    def wait_all(self, transfers):
+        """ Waits for all the given transfers, raises the first error after all of them have finished """
+        error = None
+        for t in transfers:
+            try:
+                t.result()
+            except Exception as e:
+                print("Transfer of " + t.src + " failed: " + repr(e))
+                error = error or e
+        if error is not None:
+            raise error
+
+    def shutdown(self):
+        self.executor.shutdown(wait=True)
@@ -0,0 +1,8 @@
+import os
+import sys
+
+# the modules import `core.*` from src + `utils.*` from the repo root, as when mrbox is run from src
+ROOT = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
+for path in (ROOT, os.path.join(ROOT, 'src')):
+    if path not in sys.path:
+        sys.path.insert(0, path)
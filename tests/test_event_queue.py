@@ -0,0 +1,82 @@
+import pytest
+from watchdog.events import FileCreatedEvent, FileModifiedEvent, FileDeletedEvent, FileMovedEvent, \
+    DirCreatedEvent, DirDeletedEvent
+from core.event_queue import EventQueue
+from core.ignore import IgnoreMatcher
+
+
+class Recorder:
+    """ The handler of the queue, records the events it is handed """
+    def __init__(self):
+        self.events = []
+
+    def dispatch(self, event):
+        self.events.append((event.event_type, event.src_path) if event.event_type != 'moved'
+                           else (event.event_type, event.src_path, event.dest_path))
+
+
+def run(events, ignore=None):
+    """
+    Feeds the events to a queue whose delay never expires, so that they are all coalesced,
+    then stops it to hand the pending events to the handler
+    :return: the events handed to the handler, in order
+    """
+    handler = Recorder()
+    queue = EventQueue(handler, workers=1, delay=60, ignore=ignore)
+    for event in events:
+        queue.dispatch(event)
+    queue.stop()
+    return handler.events
+
+
+@pytest.mark.parametrize('events, expected', [
+    ([FileCreatedEvent('/m/a'), FileModifiedEvent('/m/a'), FileModifiedEvent('/m/a')],
+     [('created', '/m/a')]),
+    ([FileModifiedEvent('/m/a'), FileModifiedEvent('/m/a')],
+     [('modified', '/m/a')]),
+    ([FileModifiedEvent('/m/a'), FileDeletedEvent('/m/a')],
+     [('deleted', '/m/a')]),
+    # a new file, or a temp file renamed over a synced file: the handler skips the delete of the first
+    ([FileCreatedEvent('/m/a'), FileModifiedEvent('/m/a'), FileDeletedEvent('/m/a')],
+     [('deleted', '/m/a')]),
+    ([FileDeletedEvent('/m/a'), FileCreatedEvent('/m/a'), FileModifiedEvent('/m/a')],
+     [('modified', '/m/a')]),
+    ([FileCreatedEvent('/m/a'), FileMovedEvent('/m/a', '/m/b')],
+     [('deleted', '/m/a'), ('created', '/m/b')]),
+    ([FileCreatedEvent('/m/a'), FileMovedEvent('/m/a', '/m/b'), FileMovedEvent('/m/b', '/m/c')],
+     [('deleted', '/m/a'), ('deleted', '/m/b'), ('created', '/m/c')]),
+    # a file moved aside + deleted
+    ([FileMovedEvent('/m/a', '/m/a.bak'), FileDeletedEvent('/m/a.bak')],
+     [('deleted', '/m/a')]),
+    # an editor save through a backup copy: moved aside, written again under its name, backup deleted
+    ([FileMovedEvent('/m/a', '/m/a.bak'), FileCreatedEvent('/m/a'), FileModifiedEvent('/m/a'),
+      FileDeletedEvent('/m/a.bak')],
+     [('modified', '/m/a')]),
+    ([FileMovedEvent('/m/a', '/m/b'), FileModifiedEvent('/m/b')],
+     [('moved', '/m/a', '/m/b'), ('modified', '/m/b')]),
+    # dirs are not coalesced, their events apply to their subtree
+    ([DirCreatedEvent('/m/d'), DirDeletedEvent('/m/d')],
+     [('created', '/m/d'), ('deleted', '/m/d')]),
+    ([FileCreatedEvent('/m/a'), FileCreatedEvent('/m/b'), FileModifiedEvent('/m/a')],
+     [('created', '/m/a'), ('created', '/m/b')]),
+])
+def test_coalesce(events, expected):
+    assert run(events) == expected
+
+
+def test_ignored_paths(tmp_path):
+    root = str(tmp_path)
+    ignore = IgnoreMatcher(root)
+    a, b, swap = root + '/a', root + '/b', root + '/.a.swp'
+    # a move from an ignored path is a create at its dest, a move to an ignored path a delete of its src
+    events = [FileCreatedEvent(swap), FileModifiedEvent(swap), FileMovedEvent(swap, a),
+              FileMovedEvent(b, root + '/b~'), FileCreatedEvent(root + '/c~')]
+    assert run(events, ignore=ignore) == [('created', a), ('deleted', b)]
+
+
+def test_ignore_file_reloaded(tmp_path):
+    root = str(tmp_path)
+    ignore = IgnoreMatcher(root)
+    (tmp_path / '.mrboxignore').write_text('*.log\n')
+    events = [FileCreatedEvent(root + '/.mrboxignore'), FileCreatedEvent(root + '/out.log')]
+    assert run(events, ignore=ignore) == [('created', root + '/.mrboxignore')]
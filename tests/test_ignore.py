@@ -0,0 +1,122 @@
+import re
+import pytest
+from core.ignore import IgnoreMatcher, pattern_to_regex, IGNORE_FILE
+
+
+@pytest.mark.parametrize('pattern, path, matches', [
+    ('*.log', 'out.log', True),
+    ('*.log', 'a/b/out.log', True),
+    ('*.log', 'out.log.gz', False),
+    ('*.log', 'logs/out.txt', False),
+    ('?.txt', 'a.txt', True),
+    ('?.txt', 'ab.txt', False),
+    ('[ab].txt', 'b.txt', True),
+    ('[!ab].txt', 'b.txt', False),
+    ('[!ab].txt', 'c.txt', True),
+    # unanchored: matches at any depth, with the paths under it
+    ('build', 'build', True),
+    ('build', 'src/build/x.o', True),
+    # anchored by a leading / or a / in the middle: relative to the dir of the ignore file only
+    ('/build', 'build/x.o', True),
+    ('/build', 'src/build/x.o', False),
+    ('src/build', 'src/build/x.o', True),
+    ('src/build', 'a/src/build', False),
+    ('src/*.o', 'src/x.o', True),
+    ('src/*.o', 'src/sub/x.o', False),
+    # ** across dirs
+    ('**/tmp', 'a/b/tmp', True),
+    ('**/tmp', 'tmp', True),
+    ('data/**/*.csv', 'data/x.csv', True),
+    ('data/**/*.csv', 'data/a/b/x.csv', True),
+    ('data/**/*.csv', 'other/x.csv', False),
+    ('data/**', 'data/a/b', True),
+    # dirs are matched with a trailing /
+    ('cache/', 'cache/', True),
+    ('cache/', 'cache/f', True),
+    ('cache/', 'cache', False),
+])
+def test_pattern_to_regex(pattern, path, matches):
+    assert (re.match('(?:%s)$' % pattern_to_regex(pattern), path) is not None) == matches
+
+
+def matcher(tmp_path, ignore_files, defaults=True):
+    """
+    :param ignore_files: dict of dir relative to the root -> content of its ignore file
+    """
+    for d, content in ignore_files.items():
+        (tmp_path / d).mkdir(parents=True, exist_ok=True)
+        (tmp_path / d / IGNORE_FILE).write_text(content)
+    return IgnoreMatcher(str(tmp_path), defaults)
+
+
+@pytest.mark.parametrize('ignore_files, path, is_dir, ignored', [
+    ({}, 'a.txt', False, False),
+    # defaults
+    ({}, '.a.txt.swp', False, True),
+    ({}, 'sub/a.txt~', False, True),
+    ({}, 'sub/.DS_Store', False, True),
+    ({}, 'sub/__pycache__', True, True),
+    ({}, 'sub/__pycache__/m.pyc', False, True),
+    ({}, '__pycache__', False, False),
+    # negation
+    ({'.': '*.csv\n!keep.csv\n'}, 'x.csv', False, True),
+    ({'.': '*.csv\n!keep.csv\n'}, 'sub/keep.csv', False, False),
+    ({'.': '# comment\n\n*.csv\n'}, 'x.csv', False, True),
+    ({'.': '\\#x\n'}, '#x', False, True),
+    # dir-only
+    ({'.': 'out/\n'}, 'out', True, True),
+    ({'.': 'out/\n'}, 'out', False, False),
+    ({'.': 'out/\n'}, 'a/out/part-0', False, True),
+    # anchored vs unanchored
+    ({'.': '/out\n'}, 'out', False, True),
+    ({'.': '/out\n'}, 'a/out', False, False),
+    ({'.': 'out\n'}, 'a/out', False, True),
+    # the patterns of an ignore file apply to its dir + subdirs only
+    ({'a': '*.bin\n'}, 'a/b/x.bin', False, True),
+    ({'a': '*.bin\n'}, 'x.bin', False, False),
+    ({'a': '/x.bin\n'}, 'a/x.bin', False, True),
+    ({'a': '/x.bin\n'}, 'a/b/x.bin', False, False),
+    ({'.': '*.bin\n', 'a': '!x.bin\n'}, 'a/x.bin', False, False),
+    ({'.': '*.bin\n', 'a': '!x.bin\n'}, 'x.bin', False, True),
+    # the last rule that matches wins
+    ({'.': '!a.log\n*.log\n'}, 'a.log', False, True),
+    ({'.': '*.log\n!a.log\n'}, 'a.log', False, False),
+    ({'.': '*.log\n!a.log\n*.log\n'}, 'a.log', False, True),
+    ({'.': 'out/\n!out/keep\n'}, 'out/keep', False, False),
+    ({'.': 'out/\n!out/keep\n'}, 'out/x', False, True),
+    ({'.': '!*.tmp\n'}, 'a.tmp', False, False),
+    # the rules of an ignore file come after the ones of the ignore files of its parent dirs
+    ({'.': '!x\n', 'a': 'x\n'}, 'a/x', False, True),
+    ({'.': '!x\n', 'a': 'x\n'}, 'x', False, False),
+    ({'.': 'x\n', 'a': '!x\n', 'a/b': 'x\n'}, 'a/b/x', False, True),
+    ({'.': 'x\n', 'a': '!x\n', 'a/b': 'x\n'}, 'a/c/x', False, False),
+    ({'a/b': '!*.csv\n', '.': '*.csv\n'}, 'a/b/x.csv', False, False),
+])
+def test_is_ignored(tmp_path, ignore_files, path, is_dir, ignored):
+    m = matcher(tmp_path, ignore_files)
+    assert m.is_ignored(str(tmp_path / path), is_dir) == ignored
+
+
+def test_no_defaults(tmp_path):
+    m = matcher(tmp_path, {}, defaults=False)
+    assert not m.is_ignored(str(tmp_path / 'a.swp'))
+
+
+def test_update(tmp_path):
+    m = matcher(tmp_path, {'a': '*.log\n'})
+    path = str(tmp_path / 'a' / 'x.log')
+    assert m.is_ignored(path)
+    # modified
+    (tmp_path / 'a' / IGNORE_FILE).write_text('*.out\n')
+    m.update(str(tmp_path / 'a' / IGNORE_FILE))
+    assert not m.is_ignored(path)
+    assert m.is_ignored(str(tmp_path / 'a' / 'x.out'))
+    # created
+    (tmp_path / IGNORE_FILE).write_text('*.log\n')
+    m.update(str(tmp_path / IGNORE_FILE))
+    assert m.is_ignored(path)
+    # deleted
+    (tmp_path / IGNORE_FILE).unlink()
+    m.update(str(tmp_path / IGNORE_FILE))
+    assert not m.is_ignored(path)
+    assert m.is_ignored(str(tmp_path / 'a' / 'x.out'))
@@ -0,0 +1,159 @@
+import sqlite3
+import pytest
+from core.local_catalogue import LocalCatalog
+
+L, R = '/home/u/mrbox', '/user/u/mrbox'
+
+
+@pytest.fixture
+def lc(tmp_path):
+    catalog = LocalCatalog(str(tmp_path / 'mrbox.db'), flush_interval=0)
+    yield catalog
+    catalog.close()
+
+
+def orphans(lc):
+    """ :return: the path nodes whose parent is missing + the rows of all tables that refer to a missing node """
+    lc.flush()
+    conn = lc.create_connection()
+    nodes = 'SELECT id FROM %s' % lc.PATHS_TABLE
+    ret = conn.execute('SELECT id, parent, name FROM %s WHERE parent != ? AND parent NOT IN (%s)'
+                       % (lc.PATHS_TABLE, nodes), (lc.ROOT,)).fetchall()
+    for table, col in [(lc.TABLE_NAME, lc.LOC), (lc.TABLE_NAME, lc.HDFS), (lc.LINE_INDEX_TABLE, lc.HDFS),
+                       (lc.PACKED_TABLE, lc.HDFS), (lc.CONTAINERS_TABLE, 'container'),
+                       (lc.REMOTE_DIRS_TABLE, lc.HDFS)]:
+        ret += [(table, col) + tuple(row) for row in
+                conn.execute('SELECT %s FROM %s WHERE %s NOT IN (%s)' % (col, table, col, nodes))]
+    return ret
+
+
+def node_paths(lc):
+    conn = lc.create_connection()
+    return {lc._path_of(conn, row[0]) for row in conn.execute('SELECT id FROM %s' % lc.PATHS_TABLE)}
+
+
+# the catalog as written before the path nodes: full paths as TEXT, hex checksums, datetime strings,
+# and the string 'None' for the values not set yet
+V1_ROWS = [
+    (L + '/a.txt', R + '/a.txt', '2020-11-05 10:00:00', 'None', 'e3069283', 'e3069283', 'file'),
+    (L + '/d', R + '/d', '2020-11-05 10:00:01', 'None', 'None', 'None', 'dir'),
+    (L + '/d/big.csv', R + '/d/big.csv', 'None', '2020-11-05 11:30:00', 'None', '0000abcd', 'link'),
+    (L + '/d/e/f', R + '/d/e/f', 'None', 'None', 'deadbeef', 'None', 'file'),
+]
+
+
+def test_migrate_v1(tmp_path):
+    db = str(tmp_path / 'mrbox.db')
+    conn = sqlite3.connect(db)
+    conn.execute('CREATE TABLE mrbox_files (id INTEGER PRIMARY KEY, local TEXT UNIQUE, hdfs TEXT UNIQUE, '
+                 'time_local DATETIME, time_hdfs DATETIME, chk_local TEXT, chk_hdfs TEXT, type_loc TEXT)')
+    conn.executemany('INSERT INTO mrbox_files (local, hdfs, time_local, time_hdfs, chk_local, chk_hdfs, type_loc) '
+                     'VALUES (?, ?, ?, ?, ?, ?, ?)', V1_ROWS)
+    conn.commit()
+    conn.close()
+
+    lc = LocalCatalog(db, flush_interval=0)
+    try:
+        conn = lc.create_connection()
+        assert conn.execute('PRAGMA user_version').fetchone()[0] == lc.SCHEMA_VERSION
+        assert not lc.check_table_exists(lc.TABLE_NAME + '_v1')
+        assert lc.get_tuple(L + '/a.txt') == {lc.LOC: L + '/a.txt', lc.HDFS: R + '/a.txt',
+                                               lc.TIME_LOC: 1604570400, lc.TIME_HDFS: None,
+                                               lc.CHK_LOC: 'e3069283', lc.CHK_HDFS: 'e3069283',
+                                               lc.TYPE_LOC: 'file', lc.SIZE_LOC: None, lc.MTIME_LOC: None,
+                                               lc.SIZE_HDFS: None, lc.MTIME_HDFS: None}
+        link = lc.get_tuple(L + '/d/big.csv')
+        assert (link[lc.TIME_LOC], link[lc.TIME_HDFS], link[lc.CHK_LOC], link[lc.CHK_HDFS], link[lc.TYPE_LOC]) \
+            == (None, 1604575800, None, '0000abcd', 'link')
+        assert lc.get_loc_chk(L + '/d/e/f') == 'deadbeef'
+        assert lc.get_val_by_rem_path(lc.LOC, R + '/d/e/f') == L + '/d/e/f'
+        states = lc.get_local_states()
+        assert sorted(states) == sorted(row[0] for row in V1_ROWS)
+        assert all(states[row[0]][lc.HDFS] == row[1] for row in V1_ROWS)
+        assert orphans(lc) == []
+    finally:
+        lc.close()
+
+    # opened again at the current schema, nothing is migrated
+    lc = LocalCatalog(db, flush_interval=0)
+    try:
+        assert sorted(lc.get_local_states()) == sorted(row[0] for row in V1_ROWS)
+    finally:
+        lc.close()
+
+
+def insert_tree(lc, paths):
+    for p in paths:
+        lc.insert_tuple_local(L + p, R + p, '%08x' % len(p), 'dir' if p.endswith('d') else 'file')
+
+
+def test_move_subtree(lc):
+    insert_tree(lc, ['/d', '/d/a', '/d/e', '/d/e/f', '/x', '/m'])
+    lc.set_remote_dir(R + '/d/e', 1, 'fp')
+    lc.set_line_index(R + '/d/e/f', '00000001', 10, 2, b'', b'')
+
+    lc.move_subtree(L + '/d', L + '/m/d2', R + '/d', R + '/m/d2')
+    assert lc.get_tuple(L + '/d/a') is None
+    assert lc.get_tuple(L + '/d/e/f') is None
+    assert lc.get_remote_file_path(L + '/m/d2/e/f') == R + '/m/d2/e/f'
+    assert lc.get_loc_chk(L + '/m/d2/e/f') == '%08x' % len('/d/e/f')
+    assert lc.get_remote_dir(R + '/m/d2/e') == (1, 'fp')
+    assert lc.get_line_index(R + '/m/d2/e/f') is not None
+    assert orphans(lc) == []
+
+    # overwrites the tuple at its dest
+    lc.move_subtree(L + '/x', L + '/m/d2/a', R + '/x', R + '/m/d2/a')
+    assert lc.get_tuple(L + '/x') is None
+    assert lc.get_loc_chk(L + '/m/d2/a') == '%08x' % len('/x')
+    assert len(lc.get_local_states()) == 5
+    assert orphans(lc) == []
+
+    # back to where it was, under a dir whose nodes were dropped
+    lc.move_subtree(L + '/m/d2', L + '/d', R + '/m/d2', R + '/d')
+    assert lc.get_remote_file_path(L + '/d/e/f') == R + '/d/e/f'
+    assert not [p for p in node_paths(lc) if '/d2' in p]
+    assert orphans(lc) == []
+
+
+def test_move_subtree_rolled_back(lc, monkeypatch):
+    insert_tree(lc, ['/d', '/d/a'])
+    move_node = lc._move_node
+
+    def fail_remote(conn, src, dest):
+        move_node(conn, src, dest)
+        if src.startswith(R):
+            raise sqlite3.OperationalError('disk I/O error')
+    monkeypatch.setattr(lc, '_move_node', fail_remote)
+    # the dest ancestors are created + rolled back
+    lc.move_subtree(L + '/d', L + '/new/sub/d', R + '/d', R + '/new/sub/d')
+    monkeypatch.undo()
+    assert lc.get_remote_file_path(L + '/d/a') == R + '/d/a'
+    assert lc.get_tuple(L + '/new/sub/d/a') is None
+
+    insert_tree(lc, ['/new/sub/x'])
+    assert lc.get_remote_file_path(L + '/new/sub/x') == R + '/new/sub/x'
+    assert orphans(lc) == []
+
+
+def test_delete_subtree(lc):
+    insert_tree(lc, ['/d', '/d/a', '/d/e', '/d/e/f', '/x'])
+    lc.set_remote_dir(R + '/d/e', 1, 'fp')
+    lc.set_line_index(R + '/d/e/f', '00000001', 10, 2, b'', b'')
+    lc.set_packed(R + '/d/a', R + '/d/.container', 0, 10, 0, 10)
+
+    lc.delete_subtree(L + '/d')
+    assert list(lc.get_local_states()) == [L + '/x']
+    assert lc.get_tuple(L + '/d/e/f') is None
+    assert lc.get_remote_dir(R + '/d/e') == (None, None)
+    assert lc.get_line_index(R + '/d/e/f') is None
+    assert not lc.is_packed(R + '/d/a')
+    assert not [p for p in node_paths(lc) if p.startswith((L + '/d', R + '/d'))]
+    assert orphans(lc) == []
+
+    # a file
+    lc.delete_subtree(L + '/x')
+    assert lc.get_local_states() == {}
+    assert orphans(lc) == []
+    # not in the catalog
+    lc.delete_subtree(L + '/nothing')
+    assert orphans(lc) == []
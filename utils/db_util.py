@@ -1,16 +1,17 @@
-# prints part of an sql command based on the keys/values of the given dictionary
-# Sample output: '(alpha, beta) VALUES ("gamma", "delta")'
-def insert_substr(dic):
-    items = dic.items()
-    cols = [x[0] for x in items]
-    vals = [x[1] for x in items]
-    return '(' + ', '.join(cols) + ') VALUES (' + ', '.join(vals) + ')'
+import time
 
 
-def update_substr(dic):
-    return ', '.join([str(x) + '=' + str(dic[x]) for x in dic])
+# prints part of a parameterized sql command based on the given column names
+# Sample output: '(alpha, beta) VALUES (?, ?)'
+def insert_substr(cols):
+    return '(' + ', '.join(cols) + ') VALUES (' + ', '.join('?' * len(cols)) + ')'
 
 
-def asstr(s, qmark='"'):
-    val = qmark + str(s) + qmark
-    return val
+# Sample output: 'alpha=?, beta=?'
+def update_substr(cols):
+    return ', '.join([str(x) + '=?' for x in cols])
+
+
+def epoch_now():
+    """ Current time in epoch secs """
+    return int(time.time())
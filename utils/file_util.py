@@ -1,21 +1,115 @@
 import crc32c
 import os
+from concurrent.futures import ThreadPoolExecutor
 
 # todo: change str to globals taken from mrbox_obj
 
+CHUNK_SIZE = 4 * 1024 * 1024    # bytes read per iteration when hashing, bounds the memory used per file
 
-def crc32c_file_checksum(filepath, ftype):
+
+def crc32c_file_checksum(filepath, ftype, length=None):
     """
     Calculates the CRC32C checksum of a file locally
     :param ftype: 'dir' or 'file'
     :param filepath: local absolute filepath
+    :param length: number of bytes from the start of the file to hash, None for the whole file
     :return:
     """
     if ftype == 'dir':
         return None
-    buf = open(filepath, 'rb').read()
-    ret = "%08x" % (crc32c.crc32c(buf) & 0xFFFFFFFF)
-    return ret
+    return "%08x" % crc32c_stream(filepath, length)
+
+
+def crc32c_stream(filepath, length=None, offset=0, crc=0, chunk_size=CHUNK_SIZE):
+    """
+    Incrementally calculates the CRC32C of a file, reading it in chunks into a single reusable buffer
+    :param filepath: local absolute filepath
+    :param length: number of bytes to hash, None to hash until the end of the file
+    :param offset: position of the file to start hashing from
+    :param crc: the CRC32C of the bytes before offset, to continue from
+    :param chunk_size: size of the read buffer in bytes
+    :return: the checksum as an unsigned int
+    """
+    buf = memoryview(bytearray(chunk_size))
+    with open(filepath, 'rb', buffering=0) as f:
+        f.seek(offset)
+        remaining = length
+        while remaining is None or remaining > 0:
+            want = chunk_size if remaining is None else min(chunk_size, remaining)
+            n = f.readinto(buf[:want])
+            if not n:
+                break
+            crc = crc32c.crc32c(buf[:n], crc)
+            if remaining is not None:
+                remaining -= n
+    return crc & 0xFFFFFFFF
+
+
+def _gf2_times(mat, vec):
+    out, i = 0, 0
+    while vec:
+        if vec & 1:
+            out ^= mat[i]
+        vec >>= 1
+        i += 1
+    return out
+
+
+def _gf2_square(mat):
+    return [_gf2_times(mat, mat[n]) for n in range(32)]
+
+
+def crc32c_combine(crc1, crc2, len2):
+    """
+    The CRC32C of the concatenation of two blocks from their CRC32Cs, as zlib's crc32_combine, so that the chunks of
+    a file read concurrently are hashed on their own
+    :param len2: length in bytes of the second block
+    :return: the checksum as an unsigned int
+    """
+    if len2 <= 0:
+        return crc1
+    odd = [0x82F63B78] + [1 << n for n in range(31)]    # the operator of one zero bit
+    even = _gf2_square(odd)
+    odd = _gf2_square(even)
+    # crc1 is shifted by len2 zero bytes, one squaring of the operator per bit of len2
+    while True:
+        even = _gf2_square(odd)
+        if len2 & 1:
+            crc1 = _gf2_times(even, crc1)
+        len2 >>= 1
+        if not len2:
+            break
+        odd = _gf2_square(even)
+        if len2 & 1:
+            crc1 = _gf2_times(odd, crc1)
+        len2 >>= 1
+        if not len2:
+            break
+    return (crc1 ^ crc2) & 0xFFFFFFFF
+
+
+class ChecksumPool:
+    """
+    Hashes local files on a pool of threads, so that files created at the same time are hashed concurrently
+    and the caller can overlap hashing with HDFS transfers. crc32c releases the GIL while hashing large buffers.
+    """
+    def __init__(self, workers=4):
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='crc32c')
+
+    def submit(self, filepath, ftype, length=None):
+        """ :return: a Future with the result of crc32c_file_checksum(filepath, ftype, length) """
+        return self.executor.submit(crc32c_file_checksum, filepath, ftype, length)
+
+    def checksums(self, paths_types):
+        """
+        :param paths_types: list of (filepath, ftype) tuples
+        :return: list of checksums in the same order
+        """
+        futures = [self.submit(fp, ft) for fp, ft in paths_types]
+        return [f.result() for f in futures]
+
+    def shutdown(self):
+        self.executor.shutdown(wait=True)
 
 
 def bytes_to_mb(file_size_bytes):